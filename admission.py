@@ -0,0 +1,95 @@
+import logging
+
+from flow_scheduler import TokenBucket
+
+LOG = logging.getLogger(__name__)
+
+# levels of the limits, checked in this order so that a noisy source
+# is shed by its own limit before it takes the tokens of its port and
+# datapath
+IP = 'source IP'
+MAC = 'source MAC'
+PORT = 'port'
+DATAPATH = 'datapath'
+LEVELS = (IP, MAC, PORT, DATAPATH)
+
+
+class Admission(object):
+    '''
+        token buckets of packet ins per datapath, per ingress port and
+        per source MAC and IP address; a packet in beyond any of them is
+        shed, but one in 'sample' of those is let through anyway
+    '''
+    def __init__(self, limits, sample):
+        self.limits = limits        # limits[level] = (rate, burst)
+        self.sample = sample        # 0 to shed all of them
+        # buckets[level][key] = TokenBucket, see admit for the keys
+        self.buckets = dict((level, {}) for level in LEVELS)
+        # suppressed[(level, key)] = time the suppression ends
+        self.suppressed = {}
+        self.admitted = 0
+        self.shed = dict((level, 0) for level in LEVELS)
+        self.sampled = 0
+        self._over = 0
+
+    def admit(self, dpid, in_port, mac_src, ip_src, now):
+        '''
+            return None if the packet in is admitted, or (level, key) of
+            the limit it's over; ip_src is None if it's not IP; keys are
+            tuples starting with dpid, sources are told by their ports
+            as well
+        '''
+        keys = {DATAPATH: (dpid,), PORT: (dpid, in_port),
+                MAC: (dpid, in_port, mac_src)}
+        if ip_src is not None:
+            keys[IP] = (dpid, in_port, ip_src)
+        for level in LEVELS:
+            if level not in keys or level not in self.limits:
+                continue
+            buckets = self.buckets[level]
+            bucket = buckets.get(keys[level], None)
+            if bucket is None:
+                rate, burst = self.limits[level]
+                bucket = TokenBucket(rate, burst, now)
+                buckets[keys[level]] = bucket
+            if not bucket.take(now):
+                self._over += 1
+                if self.sample and self._over % self.sample == 0:
+                    self.sampled += 1
+                    break
+                self.shed[level] += 1
+                return level, keys[level]
+        self.admitted += 1
+        return None
+
+    def suppress(self, level, key, now, timeout):
+        '''
+            return True if the source or port isn't suppressed yet, and
+            remember it is until 'timeout' passes
+        '''
+        if now < self.suppressed.get((level, key), 0):
+            return False
+        self.suppressed[level, key] = now + timeout
+        return True
+
+    def expire(self, now):
+        '''
+            forget the buckets which are full again, and the ended
+            suppressions
+        '''
+        for level, buckets in self.buckets.iteritems():
+            if level not in self.limits:
+                continue
+            rate, burst = self.limits[level]
+            for key in [k for k, b in buckets.iteritems()
+                        if (now - b.updated) * rate + b.tokens >= burst]:
+                del buckets[key]
+        for key in [k for k, t in self.suppressed.iteritems() if now >= t]:
+            del self.suppressed[key]
+
+    def remove_switch(self, dpid):
+        for buckets in self.buckets.itervalues():
+            for key in [k for k in buckets if k[0] == dpid]:
+                del buckets[key]
+        for key in [k for k in self.suppressed if k[1][0] == dpid]:
+            del self.suppressed[key]
@@ -1,15 +1,61 @@
 import time
+import heapq
 import logging
 
+try:
+    import numpy
+except ImportError:
+    # only needed by AllPairs
+    numpy = None
+
 LOG = logging.getLogger(__name__)
 
+# distances summed in another order, as in the table of AllPairs, may
+# differ in the last bits; paths within this relative difference are
+# of equal cost
+EQUAL_COST_TOLERANCE = 1e-9
+
+
+def hash_path(next_hops, src, dst, flow_hash):
+    '''
+        pick one path from src to dst in the DAG returned by
+        find_multipath, by the hash of the flow; return
+        (switch_list, outports, exact), where outports[i] is the port of
+        switch_list[i] towards switch_list[i+1] and exact[i] is True if
+        switch_list[i] has several next hops, i.e. the paths diverge there;
+        return (None, None, None) if no path is found
+    '''
+    switch_list = [src]
+    outports = []
+    exact = []
+    visited = set([src.dp.id])
+    switch = src
+    while switch.dp.id != dst.dp.id:
+        hops = next_hops.get(switch.dp.id, [])
+        # zero cost links might make loops of equal cost
+        candidates = [h for h in hops if h[1].dp.id not in visited]
+        if not candidates:
+            return None, None, None
+        # mix the dpid in, so the choices of successive switches are not
+        # related to each other
+        port_no, switch = \
+            candidates[hash((flow_hash, switch.dp.id)) % len(candidates)]
+        visited.add(switch.dp.id)
+        switch_list.append(switch)
+        outports.append(port_no)
+        exact.append(len(hops) > 1)
+    return switch_list, outports, exact
+
 
 class Algorithm(object):
     '''
-        algorithm base class
+        algorithm base class;
+        algorithms work on the integer indexes of graph.Graph, which is
+        kept in sync with dpid_to_switch by the topology event handlers
     '''
-    def __init__(self, dpid_to_switch):
+    def __init__(self, dpid_to_switch, graph):
         self.dpid_to_switch = dpid_to_switch
+        self.graph = graph
         self.topology_last_update = time.time()
 
     def find_route(self, src, dst):
@@ -21,132 +67,688 @@ class Algorithm(object):
         LOG.error('If you see this message, your algorithm is not enabled.')
         return None
 
+    def link_changed(self, src_dpid, dst_dpid):
+        '''
+            called after the link src_dpid -> dst_dpid has been added,
+            deleted or has got a new cost in the graph;
+            return a set of (src_dpid, dst_dpid) whose routes changed, or
+            None if every route should be considered changed
+        '''
+        self.topology_last_update = time.time()
+        return None
+
+    def switch_removed(self, dpid):
+        '''
+            called after the switch has been removed from the graph,
+            returns the same as link_changed
+        '''
+        self.topology_last_update = time.time()
+        return None
+
+    def _indexes(self, src, dst):
+        # indexes of two Switch objects, None if not in the graph
+        if self.graph.alive(src.dp.id) and self.graph.alive(dst.dp.id):
+            return self.graph.index[src.dp.id], self.graph.index[dst.dp.id]
+        return None, None
+
+    def _to_switches(self, path):
+        # list of indexes -> list of Switch objects
+        dpids = self.graph.dpids
+        return [self.dpid_to_switch[dpids[i]] for i in path]
+
     
 class Dijkstra(Algorithm):
+    def __init__(self, dpid_to_switch, graph, cache_tree=False):
+        # if cache_tree is True, the whole shortest path tree rooted at
+        # a source is calculated once and every destination is answered
+        # by walking predecessors in that tree
+        super(Dijkstra, self).__init__(dpid_to_switch, graph)
+        self.cache_tree = cache_tree
+        self.path = {}  # path[(src, dest)] = [list of indexes src to dest]
+        self.tree = {}  # tree[src] = {index: previous index/None}
+        self.to_dst = {}    # to_dst[dst] = {index: distance to dst}
+        # multipaths[dst] = {index: frozenset of (outport_no, index) of
+        # the next hops on the equal cost paths to dst}, as to_dst
+        self.multipaths = {}
+        self.route_last_update = time.time()
+
+    def _check_topology(self):
+        if self.route_last_update < self.topology_last_update:
+            self.path = {}
+            self.tree = {}
+            self.to_dst = {}
+            self.multipaths = {}
+            self.route_last_update = time.time()
 
-    class Heap(object):
+    def shortest_path_tree(self, src):
         '''
-            a minimal heap stores tuple (switch, distance)
+            calculate the shortest path tree rooted at index src, using
+            a binary heap with lazy deletion, i.e. stale heap items are
+            skipped when popped instead of being updated in place;
+            return dicts distance[index] = distance and
+            previous[index] = previous index/None
         '''
-        def __init__(self):
-            self.heap = []
-            self.switch_to_position = {}    # maps switch to index in the heap
+        offset, neighbor, cost, reverse = self.graph.csr()
+        distance = {src: 0}
+        previous = {src: None}
+        done = set()
+        pq = [(0, src)]
+        while pq:
+            dist, i = heapq.heappop(pq)
+            if i in done:
+                continue
+            done.add(i)
 
-        def insert(self, switch, dist):
-            self.heap.append((switch, dist))
-            self.switch_to_position[switch] = len(self.heap) - 1
-            self._shift_to_root(len(self.heap) - 1)
+            for e in xrange(offset[i], offset[i + 1]):
+                j = neighbor[e]
+                if j < 0 or j in done:
+                    continue
+                d = dist + cost[e]
+                if d < distance.get(j, float('inf')):
+                    distance[j] = d
+                    previous[j] = i
+                    heapq.heappush(pq, (d, j))
+        return distance, previous
 
-        def _shift_to_root(self, position):
-            while position > 0 and \
-                    self.heap[position][1] < self.heap[(position-1)/2][1]:
-                self._exchange(position, (position-1)/2)
-                position = (position-1) / 2
+    def distance_to(self, dst):
+        '''
+            distances of all the switches to index dst, i.e. Dijkstra from
+            dst over the reverse links;
+            return dict distance[index] = distance
+        '''
+        try:
+            return self.to_dst[dst]
+        except KeyError:
+            pass
 
-        def pop(self):
-            length = len(self.heap)
-            if length == 0:
-                return None
+        offset, neighbor, cost, reverse = self.graph.csr()
+        distance = {dst: 0}
+        done = set()
+        pq = [(0, dst)]
+        while pq:
+            dist, i = heapq.heappop(pq)
+            if i in done:
+                continue
+            done.add(i)
 
-            ans = self.heap[0]
+            for e in xrange(offset[i], offset[i + 1]):
+                j, r = neighbor[e], reverse[e]
+                if j < 0 or r < 0 or j in done:
+                    continue
+                d = dist + cost[r]
+                if d < distance.get(j, float('inf')):
+                    distance[j] = d
+                    heapq.heappush(pq, (d, j))
+        self.to_dst[dst] = distance
+        self.multipaths[dst] = self._next_hops_to(distance)
+        return distance
 
-            self.heap[0] = self.heap[length - 1]
-            self.switch_to_position[self.heap[0][0]] = 0
-            self.heap.pop()
-            del self.switch_to_position[ans[0]]
+    def _next_hops_to(self, distance):
+        offset, neighbor, cost, reverse = self.graph.csr()
+        local_port = self.graph.local_port
+        next_hops = {}
+        for i, d in distance.iteritems():
+            next_hops[i] = frozenset(
+                (local_port[e], neighbor[e])
+                for e in xrange(offset[i], offset[i + 1])
+                if neighbor[e] in distance and
+                cost[e] + distance[neighbor[e]] - d <=
+                EQUAL_COST_TOLERANCE * d)
+        return next_hops
 
-            self._shift_to_leaf(0)
-                        
-            return ans
+    def _multipaths_changed(self, dpids, link=None):
+        '''
+            calculate the distances to the destinations asked for again,
+            after the link (src index, dst index), or any switch, changed;
+            'dpids' maps indexes to dpids, including a removed switch;
+            return a set of (src_dpid, dst_dpid) whose equal cost paths,
+            as find_multipath returns them, changed
+        '''
+        old_to_dst, old_multipaths = self.to_dst, self.multipaths
+        self.to_dst, self.multipaths = {}, {}
+        ans = set()
+        for t, old_distance in old_to_dst.iteritems():
+            old = old_multipaths[t]
+            if link is not None:
+                u, v = link
+                inf = float('inf')
+                if all(j != v for port_no, j in old.get(u, ())) and \
+                        self._link_cost(u, v) + old_distance.get(v, inf) > \
+                        old_distance.get(u, inf):
+                    # neither on the paths before, nor on them now
+                    self.to_dst[t], self.multipaths[t] = old_distance, old
+                    continue
+            if dpids[t] is None or not self.graph.alive(dpids[t]):
+                new = {}
+            else:
+                self.distance_to(t)
+                new = self.multipaths[t]
 
-        def _shift_to_leaf(self, position):
-            length = len(self.heap)
-            while position*2+1 < length:
-                if position*2+2 < length:
-                    if self.heap[position*2+1][1] < self.heap[position*2+2][1]:
-                        if self.heap[position][1] > self.heap[position*2+1][1]:
-                            self._exchange(position, position*2+1)
-                            LOG.debug('Exchange position %s %s', position, position*2+1)
-                            position = position * 2 + 1
-                        else:
-                            break
-                    else:
-                        if self.heap[position][1] > self.heap[position*2+2][1]:
-                            self._exchange(position, position*2+2)
-                            LOG.debug('Exchange position %s %s', position, position*2+2)
-                            position = position * 2 + 2
-                        else:
-                            break
-                else:
-                    if self.heap[position][1] > self.heap[position*2+1][1]:
-                        self._exchange(position, position*2+1)
-                        position = position * 2 + 1
-                    else:
-                        break
-
-        def _exchange(self, x, y):
-            # x and y are positions in self.heap
-            self.heap[x], self.heap[y] = self.heap[y], self.heap[x]
-            self.switch_to_position[self.heap[x][0]] = x
-            self.switch_to_position[self.heap[y][0]] = y
-
-        def update(self, switch, distance):
-            position = self.switch_to_position[switch]
-            self.heap[position] = (switch, distance)
-            self._shift_to_leaf(position)
-            self._shift_to_root(position)
-
-
-    def __init__(self, *args, **kwargs):
-        super(Dijkstra, self).__init__(*args, **kwargs)
-        self.path = {}  # path[(src, dest)] = [list of path from src to dest]
-        self.route_last_update = time.time()
+            # the sources whose paths pass a switch with other next hops
+            previous = {}
+            for next_hops in (old, new):
+                for i, hops in next_hops.iteritems():
+                    for port_no, j in hops:
+                        previous.setdefault(j, set()).add(i)
+            stack = [i for i in set(old) | set(new)
+                     if old.get(i) != new.get(i)]
+            changed = set(stack)
+            while stack:
+                for i in previous.get(stack.pop(), ()):
+                    if i not in changed:
+                        changed.add(i)
+                        stack.append(i)
+            ans.update((dpids[i], dpids[t]) for i in changed)
+        return ans
+
+    def _distance(self, i, j):
+        # from index i to index j
+        return self.distance_to(j).get(i, float('inf'))
+
+    def path_cost(self, src, dst):
+        '''
+            cost of the shortest path from switch src to switch dst,
+            inf if dst is not reachable
+        '''
+        self._check_topology()
+        s, t = self._indexes(src, dst)
+        if s is None:
+            return float('inf')
+        return self.distance_to(t).get(s, float('inf'))
+
+    def loop_free_alternate(self, switch, dst, primary_port):
+        '''
+            a backup next hop of switch towards dst for when the link of
+            primary_port fails, i.e. a neighbor n satisfying
+                dist(n, dst) < dist(n, switch) + dist(switch, dst)
+            so the shortest path of n never comes back through switch
+            (loop-free alternate, RFC 5286); the cheapest one is chosen;
+            return (outport_no, next switch), or None if there is none
+        '''
+        self._check_topology()
+        s, t = self._indexes(switch, dst)
+        if s is None:
+            return None
+        distance = self._distance(s, t)
+        if distance == float('inf'):
+            return None
+
+        offset, neighbor, cost, reverse = self.graph.csr()
+        local_port = self.graph.local_port
+        best, ans = float('inf'), None
+        for e in xrange(offset[s], offset[s + 1]):
+            n = neighbor[e]
+            if n < 0 or local_port[e] == primary_port:
+                continue
+            to_dst = self._distance(n, t)
+            if to_dst < self._distance(n, s) + distance and \
+                    cost[e] + to_dst < best:
+                best = cost[e] + to_dst
+                ans = local_port[e], \
+                    self.dpid_to_switch[self.graph.dpids[n]]
+        return ans
+
+    def find_multipath(self, src, dst):
+        '''
+            all the equal cost shortest paths from src to dst, as a DAG
+            next_hops[dpid] = [(outport_no, next switch), ...]
+            for every switch on those paths except dst; return None if
+            dst is not reachable
+        '''
+        self._check_topology()
+        s, t = self._indexes(src, dst)
+        if s is None:
+            return None
+        distance = self.distance_to(t)
+        if s not in distance:
+            return None
+
+        offset, neighbor, cost, reverse = self.graph.csr()
+        local_port = self.graph.local_port
+        dpids = self.graph.dpids
+        next_hops = {}
+        stack = [s]
+        while stack:
+            i = stack.pop()
+            if i == t or dpids[i] in next_hops:
+                continue
+            hops = []
+            for e in xrange(offset[i], offset[i + 1]):
+                j = neighbor[e]
+                if j >= 0 and j in distance and \
+                        cost[e] + distance[j] - distance[i] <= \
+                        EQUAL_COST_TOLERANCE * distance[i]:
+                    hops.append((local_port[e],
+                                 self.dpid_to_switch[dpids[j]]))
+                    stack.append(j)
+            next_hops[dpids[i]] = hops
+        return next_hops
+
+    def _find_route_in_tree(self, src, dst):
+        try:
+            previous = self.tree[src]
+        except KeyError:
+            distance, previous = self.shortest_path_tree(src)
+            self.tree[src] = previous
+
+        if dst not in previous:
+            return None
+        path = []
+        while dst is not None:
+            path.append(dst)
+            dst = previous[dst]
+        path.reverse()
+        return path
 
     def find_route(self, src, dst):
-        if self.route_last_update < self.topology_last_update:
-            self.path = {}
-            self.route_last_update = time.time()
+        self._check_topology()
 
+        src, dst = self._indexes(src, dst)
+        if src is None:
+            return None
+
+        if self.cache_tree:
+            path = self._find_route_in_tree(src, dst)
+        else:
+            path = self._find_route(src, dst)
+        if path is None:
+            return None
+        path = self._to_switches(path)
+        LOG.debug('Calculated path: %s', path)
+        return path
+
+    def _find_route(self, src, dst):
         try:
             path = self.path[src, dst]
             return path
         except:
             pass
 
-        pq = Dijkstra.Heap()
-        distance = {}   # distance[switch] = distance
-        previous = {}   # previous[switch] = switch/None
-        for dpid, switch in self.dpid_to_switch.iteritems():
-            if switch != src:
-                distance[switch] = float('inf')
-            else:
-                distance[switch] = 0
-
-            previous[switch] = None
-            pq.insert(switch, distance[switch])
-        while True:
-            x = pq.pop()
-            if x is None:
-                break
-
-            switch, dist = x
-            if switch == dst:
+        # the heap has lazy deletion as in shortest_path_tree, and the
+        # search stops once dst is popped
+        offset, neighbor, cost, reverse = self.graph.csr()
+        distance = {src: 0}     # distance[index] = distance
+        previous = {src: None}  # previous[index] = index/None
+        done = set()
+        pq = [(0, src)]
+        while pq:
+            dist, i = heapq.heappop(pq)
+            if i in done:
+                continue
+            if i == dst:
                 path = [dst]
-                while previous[switch]:
-                    path.insert(0, previous[switch])
-                    switch = previous[switch]
+                while previous[i] is not None:
+                    path.insert(0, previous[i])
+                    i = previous[i]
                 self.path[src, dst] = path
-                LOG.debug('Calculated path: %s', path)
                 return path
+            done.add(i)
 
-            for port_no, port in switch.ports.iteritems():
-                peer_switch = self.dpid_to_switch.get(port.peer_switch_dpid,
-                                                      None)
-                if peer_switch is None:
+            for e in xrange(offset[i], offset[i + 1]):
+                j = neighbor[e]
+                if j < 0 or j in done:
                     continue
-                if dist + port.cost < distance[peer_switch]:
-                    distance[peer_switch] = dist + port.cost
-                    pq.update(peer_switch, dist + port.cost)
-                    previous[peer_switch] = switch
-            
+                d = dist + cost[e]
+                if d < distance.get(j, float('inf')):
+                    distance[j] = d
+                    previous[j] = i
+                    heapq.heappush(pq, (d, j))
+
         return None
+
+
+class IncrementalSPF(Dijkstra):
+    '''
+        keeps the shortest path tree of every source that has been asked
+        for, and repairs only the affected part of each tree when a link
+        is added, deleted or changes its cost (Ramalingam-Reps style),
+        instead of dropping all the trees on every topology event
+    '''
+
+    class Tree(object):
+        '''
+            shortest path tree rooted at a source, all keyed by index
+        '''
+        def __init__(self, root, distance, previous):
+            self.root = root
+            self.distance = distance    # distance[index] = distance
+            self.previous = previous    # previous[index] = index/None
+            self.children = {}          # children[index] = set of index
+            for i, prev in previous.iteritems():
+                if prev is not None:
+                    self.children.setdefault(prev, set()).add(i)
+
+        def _detach(self, i, prev):
+            children = self.children.get(prev, None)
+            if children:
+                children.discard(i)
+
+        def set_previous(self, i, prev):
+            self._detach(i, self.previous.get(i, None))
+            self.previous[i] = prev
+            if prev is not None:
+                self.children.setdefault(prev, set()).add(i)
+
+        def remove(self, i):
+            self._detach(i, self.previous.pop(i, None))
+            self.distance.pop(i, None)
+            self.children.pop(i, None)
+
+        def subtree(self, i):
+            ans = [i]
+            k = 0
+            while k < len(ans):
+                ans.extend(self.children.get(ans[k], ()))
+                k += 1
+            return ans
+
+    def __init__(self, dpid_to_switch, graph):
+        super(IncrementalSPF, self).__init__(dpid_to_switch, graph,
+                                             cache_tree=True)
+
+    def _get_tree(self, src):
+        try:
+            return self.tree[src]
+        except KeyError:
+            distance, previous = self.shortest_path_tree(src)
+            tree = IncrementalSPF.Tree(src, distance, previous)
+            self.tree[src] = tree
+            return tree
+
+    def _find_route_in_tree(self, src, dst):
+        tree = self._get_tree(src)
+        if dst not in tree.previous:
+            return None
+        path = []
+        while dst is not None:
+            path.append(dst)
+            dst = tree.previous[dst]
+        path.reverse()
+        return path
+
+    def _link_cost(self, src, dst):
+        # the cheapest of the (possibly parallel) links src -> dst
+        offset, neighbor, cost, reverse = self.graph.csr()
+        ans = float('inf')
+        if src >= len(offset) - 1:
+            return ans
+        for e in xrange(offset[src], offset[src + 1]):
+            if neighbor[e] == dst and cost[e] < ans:
+                ans = cost[e]
+        return ans
+
+    def _relax(self, tree, pq, moved):
+        # plain Dijkstra from the items already in pq; the first previous
+        # hop of every switch that gets a new one is kept in 'moved'
+        offset, neighbor, cost, reverse = self.graph.csr()
+        distance = tree.distance
+        while pq:
+            dist, i = heapq.heappop(pq)
+            if dist > distance.get(i, float('inf')):
+                continue
+            for e in xrange(offset[i], offset[i + 1]):
+                j = neighbor[e]
+                if j < 0:
+                    continue
+                d = dist + cost[e]
+                if d < distance.get(j, float('inf')):
+                    distance[j] = d
+                    prev = tree.previous.get(j, None)
+                    if prev != i:
+                        moved.setdefault(j, prev)
+                        tree.set_previous(j, i)
+                    heapq.heappush(pq, (d, j))
+
+    def _decrease(self, tree, src, dst, dist):
+        moved = {}
+        tree.distance[dst] = dist
+        prev = tree.previous.get(dst, None)
+        if prev != src:
+            moved[dst] = prev
+            tree.set_previous(dst, src)
+        self._relax(tree, [(dist, dst)], moved)
+
+        changed = set()
+        for i, prev in moved.iteritems():
+            if i not in changed and tree.previous[i] != prev:
+                changed.update(tree.subtree(i))
+        return changed
+
+    def _repair(self, tree, affected):
+        '''
+            the paths to all the switches in 'affected' (a whole subtree)
+            are no longer valid, find new ones from the rest of the tree
+        '''
+        offset, neighbor, cost, reverse = self.graph.csr()
+        old_previous = {}
+        for i in affected:
+            old_previous[i] = tree.previous.get(i, None)
+            tree.distance[i] = float('inf')
+        affected_set = set(affected)
+
+        pq = []
+        for i in affected:
+            # links are made of port pairs, so the links towards this
+            # switch are the reverse of its own links
+            best, best_prev = float('inf'), None
+            for e in xrange(offset[i], offset[i + 1]):
+                j, r = neighbor[e], reverse[e]
+                if j < 0 or r < 0 or j in affected_set:
+                    continue
+                d = tree.distance.get(j, float('inf')) + cost[r]
+                if d < best:
+                    best, best_prev = d, j
+            tree.distance[i] = best
+            if best_prev is not None:
+                tree.set_previous(i, best_prev)
+                heapq.heappush(pq, (best, i))
+        self._relax(tree, pq, {})
+
+        changed = set()
+        for i in affected:
+            if tree.distance[i] == float('inf'):
+                tree.remove(i)
+                changed.add(i)
+        # a path changed if the previous hop of the switch, or of any
+        # switch before it in the affected subtree, changed
+        same = set()
+        for i in affected_set - changed:
+            chain = []
+            while i in affected_set and i not in same and i not in changed:
+                chain.append(i)
+                if tree.previous[i] != old_previous[i]:
+                    changed.update(chain)
+                    chain = []
+                    break
+                i = tree.previous[i]
+            if i in changed:
+                changed.update(chain)
+            else:
+                same.update(chain)
+        return changed
+
+    def _to_dpid_pairs(self, root, changed):
+        dpids = self.graph.dpids
+        return set((dpids[root], dpids[i]) for i in changed)
+
+    def link_changed(self, src_dpid, dst_dpid):
+        self._check_topology()
+        if not (self.graph.alive(src_dpid) and self.graph.alive(dst_dpid)):
+            return set()
+        src = self.graph.index[src_dpid]
+        dst = self.graph.index[dst_dpid]
+        cost = self._link_cost(src, dst)
+        ans = self._multipaths_changed(self.graph.dpids, (src, dst))
+        for root, tree in self.tree.iteritems():
+            dist = tree.distance.get(src, float('inf')) + cost
+            old = tree.distance.get(dst, float('inf'))
+            if dist < old:
+                changed = self._decrease(tree, src, dst, dist)
+            elif dist > old and tree.previous.get(dst) == src:
+                changed = self._repair(tree, tree.subtree(dst))
+            else:
+                continue
+            ans.update(self._to_dpid_pairs(root, changed))
+        LOG.debug('Link %s -> %s changed routes: %s', src_dpid, dst_dpid, ans)
+        return ans
+
+    def switch_removed(self, dpid):
+        self._check_topology()
+        removed = self.graph.index.get(dpid, None)
+        dpids = list(self.graph.dpids)
+        if removed is not None:
+            dpids[removed] = dpid
+        ans = self._multipaths_changed(dpids)
+        tree = self.tree.pop(removed, None)
+        if tree is not None:
+            tree.remove(removed)
+            ans.add((dpid, dpid))
+            ans.update((dpid, self.graph.dpids[i]) for i in tree.previous)
+        for root, tree in self.tree.iteritems():
+            if removed not in tree.previous:
+                continue
+            affected = tree.subtree(removed)
+            for i in tree.children.pop(removed, ()):
+                tree.previous[i] = None
+            tree.remove(removed)
+            ans.add((self.graph.dpids[root], dpid))
+            ans.update(self._to_dpid_pairs(root,
+                                           self._repair(tree, affected[1:])))
+        return ans
+
+
+class AllPairs(IncrementalSPF):
+    '''
+        answers find_route by looking up a next hop table of all the
+        switch pairs, which is calculated outside the event loop (see
+        snapshot, compute and install); until the table of the current
+        topology is installed, routes come from IncrementalSPF
+    '''
+
+    class Table(object):
+        def __init__(self, generation, dpids, next_hop, dist):
+            self.generation = generation
+            self.dpids = dpids          # dpids[index] = dpid, as the graph
+            # next_hop[i, j] = index of the switch after i on the way to j,
+            # -1 if j is not reachable from i
+            self.next_hop = next_hop
+            self.dist = dist            # dist[i, j] = cost from i to j
+
+    def __init__(self, dpid_to_switch, graph):
+        super(AllPairs, self).__init__(dpid_to_switch, graph)
+        self.generation = 0     # increased on every topology change
+        self.table = None
+
+    def _check_topology(self):
+        if self.route_last_update < self.topology_last_update:
+            self.generation += 1
+        super(AllPairs, self)._check_topology()
+
+    def link_changed(self, src_dpid, dst_dpid):
+        self.generation += 1
+        return super(AllPairs, self).link_changed(src_dpid, dst_dpid)
+
+    def switch_removed(self, dpid):
+        self.generation += 1
+        return super(AllPairs, self).switch_removed(dpid)
+
+    def table_outdated(self):
+        self._check_topology()
+        return self.table is None or self.table.generation != self.generation
+
+    def snapshot(self):
+        '''
+            copy the graph into a cost matrix, must be called from the
+            event loop since the graph is not thread safe
+        '''
+        self._check_topology()
+        offset, neighbor, cost, reverse = self.graph.csr()
+        n = len(self.graph)
+        offset = numpy.frombuffer(offset, dtype=offset.typecode)
+        neighbor = numpy.frombuffer(neighbor, dtype=neighbor.typecode)
+        cost = numpy.frombuffer(cost, dtype=cost.typecode)
+        owner = numpy.repeat(numpy.arange(n), numpy.diff(offset))
+        alive = neighbor >= 0
+
+        matrix = numpy.empty((n, n))
+        matrix.fill(float('inf'))
+        # the cheapest of parallel links
+        numpy.minimum.at(matrix, (owner[alive], neighbor[alive]), cost[alive])
+        return self.generation, list(self.graph.dpids), matrix
+
+    @staticmethod
+    def compute(snapshot):
+        '''
+            Floyd-Warshall, each round relaxes the whole matrix through
+            one intermediate switch with numpy; safe to run in a worker
+            thread since it only touches the snapshot
+        '''
+        generation, dpids, dist = snapshot
+        n = len(dpids)
+        indexes = numpy.arange(n, dtype=numpy.int32)
+        next_hop = numpy.where(numpy.isfinite(dist), indexes[None, :],
+                               -1).astype(numpy.int32)
+        dist[indexes, indexes] = 0
+        next_hop[indexes, indexes] = indexes
+        for k in xrange(n):
+            alt = dist[:, k, None] + dist[k]
+            better = alt < dist
+            numpy.copyto(dist, alt, where=better)
+            numpy.copyto(next_hop, next_hop[:, k, None].copy(), where=better)
+        return AllPairs.Table(generation, dpids, next_hop, dist)
+
+    def install(self, table):
+        # a table calculated for an old topology is useless
+        if table.generation != self.generation:
+            LOG.debug('Route table of generation %s outdated',
+                      table.generation)
+            return False
+        self.table = table
+        LOG.debug('Route table of %s switches installed', len(table.dpids))
+        return True
+
+    def _distance(self, i, j):
+        table = self.table
+        if table is None or table.generation != self.generation or \
+                i >= len(table.dpids) or j >= len(table.dpids):
+            return super(AllPairs, self)._distance(i, j)
+        return table.dist[i, j]
+
+    def distance_to(self, dst):
+        '''
+            as Dijkstra.distance_to, but taken from the column of dst in
+            the table while it is current
+        '''
+        table = self.table
+        if table is None or table.generation != self.generation or \
+                dst >= len(table.dpids) or dst in self.to_dst:
+            return super(AllPairs, self).distance_to(dst)
+
+        dpids, column = table.dpids, table.dist[:, dst].tolist()
+        distance = dict((i, d) for i, d in enumerate(column)
+                        if d != float('inf') and dpids[i] is not None)
+        self.to_dst[dst] = distance
+        self.multipaths[dst] = self._next_hops_to(distance)
+        return distance
+
+    def find_route(self, src, dst):
+        self._check_topology()
+        table = self.table
+        if table is None or table.generation != self.generation:
+            return super(AllPairs, self).find_route(src, dst)
+
+        i, j = self._indexes(src, dst)
+        if i is None:
+            return None
+        if i >= len(table.dpids) or j >= len(table.dpids):
+            # switches joined after the table was calculated
+            return super(AllPairs, self).find_route(src, dst)
+
+        next_hop = table.next_hop
+        if next_hop[i, j] < 0:
+            return None
+        path = [i]
+        while i != j:
+            i = next_hop[i, j]
+            path.append(i)
+        return self._to_switches(path)
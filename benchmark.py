@@ -0,0 +1,1111 @@
+#!/usr/bin/env python
+"""
+    micro benchmarks on generated topologies, they do not need Ryu or
+    any switches to run, e.g.
+        python benchmark.py spt
+"""
+import sys
+import time
+import random
+import struct
+
+import algorithm
+import frr
+import headers
+from graph import Graph
+
+
+class FakeDatapath(object):
+    def __init__(self, dpid):
+        self.id = dpid
+
+
+class FakePort(object):
+    def __init__(self, dpid, port_no, peer_switch_dpid, peer_port_no, cost):
+        self.dpid = dpid
+        self.port_no = port_no
+        self.peer_switch_dpid = peer_switch_dpid
+        self.peer_port_no = peer_port_no
+        self.cost = cost
+        self.gateway = None
+
+
+class FakeSwitch(object):
+    '''
+        looks like a switch.Switch to the algorithm layer
+    '''
+    def __init__(self, dpid):
+        self.dp = FakeDatapath(dpid)
+        self.name = 's%s' % dpid
+        self.ports = {}
+        self.peer_to_local_port = {}
+
+    def __str__(self):
+        return '<Switch: %s>' % self.name
+
+    __repr__ = __str__
+
+
+def add_link(dpid_to_switch, graph, dpid1, dpid2, cost=1):
+    s1 = dpid_to_switch[dpid1]
+    s2 = dpid_to_switch[dpid2]
+    port_no1 = len(s1.ports) + 1
+    port_no2 = len(s2.ports) + 1
+    s1.ports[port_no1] = FakePort(dpid1, port_no1, dpid2, port_no2, cost)
+    s2.ports[port_no2] = FakePort(dpid2, port_no2, dpid1, port_no1, cost)
+    s1.peer_to_local_port[s2] = port_no1
+    s2.peer_to_local_port[s1] = port_no2
+    graph.update_port(s1.ports[port_no1])
+    graph.update_port(s2.ports[port_no2])
+
+
+def random_topology(n, degree=4, seed=1):
+    '''
+        a connected random topology of n switches: a random spanning tree
+        plus extra links until the average degree is reached;
+        return dpid_to_switch and its graph
+    '''
+    rand = random.Random(seed)
+    dpid_to_switch = {}
+    graph = Graph()
+    for dpid in xrange(1, n + 1):
+        dpid_to_switch[dpid] = FakeSwitch(dpid)
+        graph.add_switch(dpid)
+    for dpid in xrange(2, n + 1):
+        add_link(dpid_to_switch, graph, dpid, rand.randint(1, dpid - 1),
+                 rand.randint(1, 10))
+    for i in xrange(n * (degree - 2) / 2):
+        dpid1 = rand.randint(1, n)
+        dpid2 = rand.randint(1, n)
+        if dpid1 != dpid2:
+            add_link(dpid_to_switch, graph, dpid1, dpid2,
+                     rand.randint(1, 10))
+    return dpid_to_switch, graph
+
+
+def leaf_spine(leaves, spines, links=1):
+    '''
+        every leaf connects to every spine with 'links' parallel links;
+        leaves have dpid 1..leaves, spines follow
+    '''
+    dpid_to_switch = {}
+    graph = Graph()
+    for dpid in xrange(1, leaves + spines + 1):
+        dpid_to_switch[dpid] = FakeSwitch(dpid)
+        graph.add_switch(dpid)
+    for leaf in xrange(1, leaves + 1):
+        for spine in xrange(leaves + 1, leaves + spines + 1):
+            for i in xrange(links):
+                add_link(dpid_to_switch, graph, leaf, spine)
+    return dpid_to_switch, graph
+
+
+def add_gateways(dpid_to_switch):
+    '''
+        a host port on every switch, with gateway 10.x.y.1/24 and
+        2001:dpid::1/64; needs netaddr
+    '''
+    from gateway import Gateway
+
+    for dpid, switch in dpid_to_switch.iteritems():
+        port_no = len(switch.ports) + 1
+        port = FakePort(dpid, port_no, None, None, 1)
+        port.gateway = Gateway(ip='10.%d.%d.1' % (dpid / 256, dpid % 256),
+                               ipv6='2001:%x::1' % dpid, port_no=port_no,
+                               prefixlen=24, ipv6prefixlen=64)
+        switch.ports[port_no] = port
+
+
+def path_cost(path):
+    cost = 0
+    for this_switch, next_switch in zip(path, path[1:]):
+        # the cheapest of parallel links
+        cost += min(port.cost for port in this_switch.ports.itervalues()
+                    if port.peer_switch_dpid == next_switch.dp.id)
+    return cost
+
+
+def _timeit(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def bench_spt(sizes=(100, 1000, 5000), sources=10, queries=200):
+    '''
+        per (src, dst) search against shortest path trees cached per
+        source; 'queries' destinations are looked up from each source
+    '''
+    print '%8s %14s %14s %8s' % ('switches', 'per-pair(s)', 'tree(s)',
+                                 'speedup')
+    for n in sizes:
+        dpid_to_switch, graph = random_topology(n)
+        rand = random.Random(n)
+        pairs = [(dpid_to_switch[rand.randint(1, n)], None)
+                 for i in xrange(sources)]
+        pairs = [(src, dpid_to_switch[rand.randint(1, n)])
+                 for src, _ in pairs for i in xrange(queries)]
+
+        def run(algo):
+            for src, dst in pairs:
+                algo.find_route(src, dst)
+
+        per_pair = algorithm.Dijkstra(dpid_to_switch, graph)
+        tree = algorithm.Dijkstra(dpid_to_switch, graph, cache_tree=True)
+        # the per-pair search is slow on large topologies, so time a
+        # sample and scale it up
+        sample = pairs[::max(1, len(pairs) / 200)]
+        t1 = _timeit(lambda: [per_pair.find_route(s, d) for s, d in sample])
+        t1 = t1 * len(pairs) / len(sample)
+        t2 = _timeit(run, tree)
+        for src, dst in sample:
+            assert path_cost(per_pair.find_route(src, dst)) == \
+                path_cost(tree.find_route(src, dst))
+        print '%8d %14.3f %14.3f %7.1fx' % (n, t1, t2, t1 / t2)
+
+
+def bench_allpairs(sizes=(100, 500, 1000, 2000), queries=2000):
+    '''
+        background all-pairs precomputation: time and memory of the
+        table against fabric size, and the cost of a lookup afterwards
+    '''
+    print '%8s %12s %12s %14s %14s' % ('switches', 'compute(s)', 'table(MB)',
+                                       'lookup(us)', 'tree(us)')
+    for n in sizes:
+        dpid_to_switch, graph = random_topology(n)
+        rand = random.Random(n)
+        pairs = [(dpid_to_switch[rand.randint(1, n)],
+                  dpid_to_switch[rand.randint(1, n)])
+                 for i in xrange(queries)]
+
+        algo = algorithm.AllPairs(dpid_to_switch, graph)
+        start = time.time()
+        snapshot = algo.snapshot()
+        matrix_size = snapshot[2].nbytes
+        algo.install(algorithm.AllPairs.compute(snapshot))
+        t_compute = time.time() - start
+        # the cost matrix becomes the distance table, plus next hops
+        size = (matrix_size + algo.table.next_hop.nbytes) / 1024.0 / 1024
+
+        tree = algorithm.IncrementalSPF(dpid_to_switch, graph)
+        t_lookup = _timeit(lambda: [algo.find_route(s, d) for s, d in pairs])
+        t_tree = _timeit(lambda: [tree.find_route(s, d) for s, d in pairs])
+        for src, dst in pairs[:100]:
+            assert path_cost(algo.find_route(src, dst)) == \
+                path_cost(tree.find_route(src, dst))
+            # equal cost paths come from the distances of the table
+            assert algo.find_multipath(src, dst) == \
+                tree.find_multipath(src, dst)
+        print '%8d %12.3f %12.1f %14.1f %14.1f' % (
+            n, t_compute, size, t_lookup / queries * 1e6,
+            t_tree / queries * 1e6)
+
+
+def bench_ecmp(leaves=16, spines=4, links=2, flows=5000):
+    '''
+        link load of random leaf to leaf flows on a leaf-spine fabric,
+        single shortest path against per-flow hashing over equal cost
+        paths; with equal link capacities the fabric throughput is bound
+        by the most loaded link
+    '''
+    dpid_to_switch, graph = leaf_spine(leaves, spines, links)
+    rand = random.Random(1)
+    pairs = []
+    while len(pairs) < flows:
+        src, dst = rand.randint(1, leaves), rand.randint(1, leaves)
+        if src != dst:
+            five_tuple = ('10.0.%s.%s' % (src, rand.randint(2, 254)),
+                          '10.0.%s.%s' % (dst, rand.randint(2, 254)),
+                          6, rand.randint(1024, 65535), 80)
+            pairs.append((dpid_to_switch[src], dpid_to_switch[dst],
+                          five_tuple))
+
+    algo = algorithm.IncrementalSPF(dpid_to_switch, graph)
+    single = {}
+    multi = {}
+    start = time.time()
+    for src, dst, five_tuple in pairs:
+        path = algo.find_route(src, dst)
+        for this_switch, next_switch in zip(path, path[1:]):
+            link = this_switch.dp.id, \
+                this_switch.peer_to_local_port[next_switch]
+            single[link] = single.get(link, 0) + 1
+    t_single = time.time() - start
+    start = time.time()
+    for src, dst, five_tuple in pairs:
+        next_hops = algo.find_multipath(src, dst)
+        path, outports, exact = algorithm.hash_path(next_hops, src, dst,
+                                                    hash(five_tuple))
+        for this_switch, port_no in zip(path, outports):
+            link = this_switch.dp.id, port_no
+            multi[link] = multi.get(link, 0) + 1
+    t_multi = time.time() - start
+
+    n_links = 2 * leaves * spines * links
+    print '%d leaves, %d spines, %d links per pair, %d flows' % (
+        leaves, spines, links, flows)
+    print '%8s %10s %10s %10s %8s %12s' % ('', 'used', 'max load',
+                                           'mean load', 'jain',
+                                           'route(us)')
+    for name, load, t in (('single', single, t_single),
+                          ('ecmp', multi, t_multi)):
+        values = load.values() + [0] * (n_links - len(load))
+        mean = float(sum(values)) / len(values)
+        jain = sum(values) ** 2 / float(len(values) *
+                                        sum(v * v for v in values))
+        print '%8s %10d %10d %10.1f %8.3f %12.1f' % (
+            name, len(load), max(values), mean, jain, t / flows * 1e6)
+    print 'fabric throughput gain: %.1fx' % (
+        float(max(single.values())) / max(multi.values()))
+
+
+def bench_invalidation(leaves=16, spines=4, links=2, events=50):
+    '''
+        links of a leaf-spine fabric fail and come back while flows are
+        spread over equal cost paths; the routes reported changed must
+        be the ones through the link, and their cookie masked deletes
+        are counted per link event
+    '''
+    import flow_cookie
+
+    dpid_to_switch, graph = leaf_spine(leaves, spines, links)
+    algo = algorithm.IncrementalSPF(dpid_to_switch, graph)
+    cookies = flow_cookie.Cookies()
+    leaf_ids = range(1, leaves + 1)
+
+    def deploy():
+        for src in leaf_ids:
+            for dst in leaf_ids:
+                if src == dst:
+                    continue
+                next_hops = algo.find_multipath(dpid_to_switch[src],
+                                                dpid_to_switch[dst])
+                for dpid in next_hops:
+                    cookies.cookie(src, dst, dpid)
+
+    def link_event(p1, p2, up):
+        _set_link(dpid_to_switch, graph, p1, p2, up)
+        changed = algo.link_changed(p1.dpid, p2.dpid) | \
+            algo.link_changed(p2.dpid, p1.dpid)
+        return changed, cookies.invalidate_routes(changed)
+
+    rand = random.Random(1)
+    deletes = 0
+    elapsed = 0
+    for i in xrange(events):
+        deploy()
+        leaf = rand.choice(leaf_ids)
+        p1 = rand.choice([p for p in dpid_to_switch[leaf].ports.itervalues()
+                          if p.peer_switch_dpid is not None])
+        p2 = dpid_to_switch[p1.peer_switch_dpid].ports[p1.peer_port_no]
+        expected = set((src, dst) for src in leaf_ids for dst in leaf_ids
+                       if src != dst and leaf in (src, dst))
+        for up in (False, True):
+            start = time.time()
+            changed, sent = link_event(p1, p2, up)
+            elapsed += time.time() - start
+            # a parallel link of the pair is left, but the ports change
+            assert set(p for p in changed if p[0] in leaf_ids and
+                       p[1] in leaf_ids) == expected, (leaf, up)
+            assert set((c & flow_cookie.ROUTE_MASK) for d, c, m in sent) == \
+                set(cookies.routes[p].route_id << 32 for p in expected)
+            deletes += len(sent)
+            deploy()
+
+    print '%d leaves, %d spines, %d links per pair, %d link failures ' \
+        'and recoveries' % (leaves, spines, links, events)
+    print '%20s %14.1f' % ('link event (us)', elapsed / events / 2 * 1e6)
+    print '%20s %14.1f' % ('deletes per event', deletes / events / 2.0)
+
+
+def bench_lfa(n=500, flows=5000, failures=20):
+    '''
+        simulated link failures under deployed flows: with loop-free
+        alternates the affected flow entries are moved right away, without
+        them every affected flow is routed again after the topology is
+        updated (or, as before, waits for its entries to time out); each
+        failure starts from the converged topology
+    '''
+    dpid_to_switch, graph = random_topology(n)
+    rand = random.Random(1)
+    algo = algorithm.AllPairs(dpid_to_switch, graph)
+    routes = {}
+    while len(routes) < flows:
+        src = dpid_to_switch[rand.randint(1, n)]
+        dst = dpid_to_switch[rand.randint(1, n)]
+        path = algo.find_route(src, dst)
+        if src is dst or not path:
+            continue
+        ip_dst = '10.%d.%d.%d' % (dst.dp.id / 256, dst.dp.id % 256,
+                                  len(routes) % 250 + 2)
+        routes[ip_dst] = path
+
+    affected = moved = 0
+    t_add = t_lfa = t_update = 0.0
+    for i in xrange(failures):
+        if algo.table_outdated():
+            algo.install(algorithm.AllPairs.compute(algo.snapshot()))
+        start = time.time()
+        reroute = frr.FastReroute(algo, 600)
+        for ip_dst, path in routes.iteritems():
+            for this_switch, next_switch in zip(path, path[1:]):
+                reroute.add(frr.FlowRecord(
+                    this_switch.dp.id,
+                    this_switch.peer_to_local_port[next_switch],
+                    path[-1].dp.id, ip_dst, 4, None, 0, 0))
+        t_add += time.time() - start
+        next_hops = dict((key, r.outport_no)
+                         for key, r in reroute.records.iteritems())
+
+        # fail a link of a random flow
+        path = rand.choice(routes.values())
+        k = rand.randint(0, len(path) - 2)
+        s1, s2 = path[k], path[k + 1]
+        p1 = s1.ports[s1.peer_to_local_port[s2]]
+        p2 = s2.ports[p1.peer_port_no]
+        start = time.time()
+        records = reroute.link_down(p1.dpid, p1.port_no) + \
+            reroute.link_down(p2.dpid, p2.port_no)
+        t_lfa += time.time() - start
+        moved += len(records)
+        for record in records:
+            assert _loop_free(dpid_to_switch, next_hops, record)
+
+        start = time.time()
+        _set_link(dpid_to_switch, graph, p1, p2, False)
+        algo.link_changed(s1.dp.id, s2.dp.id)
+        algo.link_changed(s2.dp.id, s1.dp.id)
+        for ip_dst, path in routes.iteritems():
+            for this_switch, next_switch in zip(path, path[1:]):
+                if (this_switch, next_switch) in ((s1, s2), (s2, s1)):
+                    algo.find_route(this_switch, path[-1])
+                    affected += 1
+        t_update += time.time() - start
+        _set_link(dpid_to_switch, graph, p1, p2, True)
+        algo.link_changed(s1.dp.id, s2.dp.id)
+        algo.link_changed(s2.dp.id, s1.dp.id)
+
+    print '%d switches, %d flows, %d link failures' % (n, flows, failures)
+    print '%d flow entries affected, %d moved to backups (%.0f%%)' % (
+        affected, moved, 100.0 * moved / max(affected, 1))
+    print '%28s %12s' % ('', 'ms/failure')
+    print '%28s %12.1f' % ('backups found on deployment', t_add / failures * 1e3)
+    print '%28s %12.3f' % ('fast reroute', t_lfa / failures * 1e3)
+    print '%28s %12.3f' % ('topology update and reroute',
+                           t_update / failures * 1e3)
+    print '%28s %12.0f' % ('idle timeout', 60e3)
+
+
+def bench_cookie_deletes(deletes=20000):
+    '''
+        cookie masked deletes as _delete_flows sends them, encoded by
+        flow_templates.cookie_delete and serialized, with the fields
+        read back; needs Ryu
+    '''
+    try:
+        import flow_cookie
+        import flow_templates
+        from ryu.ofproto import ofproto_v1_0, ofproto_v1_0_parser
+    except ImportError:
+        print 'no Ryu'
+        return
+
+    class Datapath(FakeDatapath):
+        ofproto = ofproto_v1_0
+        ofproto_parser = ofproto_v1_0_parser
+
+    dp = Datapath(1)
+    cookies = flow_cookie.Cookies()
+    for i in xrange(deletes):
+        cookies.cookie(i, i + 1, 1)
+    masks = cookies.invalidate_routes([(i, i + 1) for i in xrange(deletes)])
+
+    def encode():
+        bufs = []
+        for i, (dpid, cookie, mask) in enumerate(masks):
+            msg = flow_templates.cookie_delete(dp, cookie, mask)
+            msg.xid = i
+            msg.serialize()
+            bufs.append(msg.buf)
+        return bufs
+
+    for i, buf in enumerate(encode()):
+        version, msg_type, length, xid, vendor, subtype = \
+            struct.unpack_from('!BBHIII', buf)
+        (cookie, command, idle, hard, priority, buffer_id, out_port, flags,
+         match_len) = struct.unpack_from(ofproto_v1_0.NX_FLOW_MOD_PACK_STR,
+                                         buf, ofproto_v1_0.NICIRA_HEADER_SIZE)
+        header, value, mask = struct.unpack_from(
+            '!IQQ', buf, ofproto_v1_0.NX_FLOW_MOD_SIZE)
+        assert (version, msg_type, length, xid, vendor, subtype) == \
+            (ofproto_v1_0.OFP_VERSION, ofproto_v1_0.OFPT_VENDOR, len(buf), i,
+             0x00002320, ofproto_v1_0.NXT_FLOW_MOD)   # Nicira
+        assert (command, out_port, match_len) == \
+            (ofproto_v1_0.OFPFC_DELETE, ofproto_v1_0.OFPP_NONE, 20)
+        assert len(buf) == ofproto_v1_0.NX_FLOW_MOD_SIZE + 24
+        assert (header, value, mask) == \
+            (flow_templates.NXM_NX_COOKIE_W, masks[i][1], masks[i][2])
+
+    print '%d cookie masked deletes' % deletes
+    print '%20s %14s' % ('', 'deletes/s')
+    print '%20s %14.0f' % ('cookie_delete', deletes / _timeit(encode))
+
+
+def bench_setup(setups=2000, burst=20, gap=0.2e-3, ctrl=0.5e-3,
+                per_msg=0.05e-3, install=2e-3, link=0.05e-3):
+    '''
+        simulated flow setups on random paths, counting the packets sent
+        to the controller again by a switch down the path whose entry is
+        not installed yet: ingress first with the packet out right after
+        the flow mods, as before, against egress first with the ingress
+        entry and the packets held until the other switches replied to
+        their barriers; a flow mod takes 'install' seconds on average,
+        exponentially distributed, and a burst follows the first packet
+    '''
+    rand = random.Random(1)
+    names = ('ingress first', 'egress first, barriers')
+    repunts = dict((name, 0) for name in names)
+    held = dict((name, 0.0) for name in names)
+    for i in xrange(setups):
+        hops = rand.randint(2, 8)
+        latency = [rand.expovariate(1 / install) for k in xrange(hops)]
+        for name in names:
+            installed = [0.0] * hops
+            if name == 'ingress first':
+                for hop in xrange(hops):
+                    installed[hop] = ctrl + (hop + 1) * per_msg + latency[hop]
+                released = hops * per_msg
+            else:
+                for k, hop in enumerate(xrange(hops - 1, 0, -1)):
+                    installed[hop] = ctrl + (k + 1) * per_msg + latency[hop]
+                # replies to the barriers, then the ingress entry
+                released = max(installed[1:]) + ctrl + per_msg
+                installed[0] = released + ctrl + latency[0]
+            held[name] += released
+
+            for k in xrange(burst):
+                t = k * gap
+                if t < installed[0]:
+                    # sent to the controller, out of the ingress switch
+                    t = max(t + ctrl, released) + ctrl
+                for hop in xrange(1, hops):
+                    t += link
+                    if t < installed[hop]:
+                        repunts[name] += 1
+                        break
+
+    print '%d setups on 2 to 8 hops, bursts of %d packets' % (setups, burst)
+    print '%24s %12s %12s %18s' % ('', 're-punts', 'per setup',
+                                   'packets held (ms)')
+    for name in names:
+        print '%24s %12d %12.2f %18.2f' % (
+            name, repunts[name], float(repunts[name]) / setups,
+            held[name] / setups * 1e3)
+
+
+def bench_packet_in(packets=20000):
+    '''
+        classification of packet ins as _handle_ip does it: the layers
+        it looks for, by Ryu's parser and a scan of the protocols as
+        before, against headers.Headers; needs Ryu for the former
+    '''
+    rand = random.Random(1)
+    datas = []
+    for i in xrange(packets):
+        ports = struct.pack('!HH', rand.randint(1024, 65535),
+                            rand.choice((22, 80, 443)))
+        tcp = ports + '\0' * 8 + '\x50\x02' + '\0' * 6
+        if i % 4:
+            ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), i,
+                             0, 64, 6, 0, struct.pack('!I', 0x0a000000 + i),
+                             struct.pack('!I', 0x0a800000 + i % 250))
+            eth_type, ip_name = 0x0800, 'ipv4'
+        else:
+            ip = struct.pack('!IHBB16s16s', 6 << 28, len(tcp), 6, 64,
+                             '\x20\x01' + '\0' * 10 + struct.pack('!I', i),
+                             '\x20\x02' + '\0' * 14)
+            eth_type, ip_name = 0x86dd, 'ipv6'
+        datas.append((struct.pack('!6s6sH', '\x02' * 6, '\x04' * 6,
+                                  eth_type) + ip + tcp, ip_name))
+
+    # looked for by _handle_ip and the flow setup, 'ip' is ipv4 or ipv6
+    targets = ('ethernet', 'ip', 'icmp', 'tcp', 'ip', 'ip')
+
+    def find_packet(pkt, target):
+        for p in pkt.protocols:
+            if getattr(p, 'protocol_name', None) == target:
+                return p
+        return None
+
+    def fast(datas):
+        for data, ip_name in datas:
+            pkt = headers.Headers(data)
+            pkt.five_tuple()
+            for target in targets:
+                pkt.find(ip_name if target == 'ip' else target)
+
+    def ryu(datas):
+        for data, ip_name in datas:
+            pkt = packet.Packet(data)
+            for target in targets:
+                find_packet(pkt, ip_name if target == 'ip' else target)
+
+    print '%d packet ins, TCP over IPv4 and IPv6' % packets
+    print '%20s %14s' % ('', 'packets/s')
+    try:
+        from ryu.lib.packet import packet
+    except ImportError:
+        print '%20s %14s' % ('Ryu parser', 'no Ryu')
+    else:
+        print '%20s %14.0f' % ('Ryu parser', packets / _timeit(ryu, datas))
+    print '%20s %14.0f' % ('headers.Headers', packets / _timeit(fast, datas))
+
+
+def bench_batch(n=200, packets=20000, flows=10000, active=256, batch=64,
+                prefixes=4, hosts=40):
+    '''
+        a flood of packet ins through Routing._packet_in, one by one as
+        before and in batches by Routing._handle_batch, with the held
+        messages of a batch released together; the fake switches answer
+        the barriers after every packet or batch. Half of the flows go
+        to hosts behind the gateways, half to hosts in 'prefixes'
+        external networks behind a border switch, and the requests to
+        BGPer are counted; packets come from 'active' flows at a time,
+        as new flows punt their first packets until their entries are
+        installed; needs Ryu
+    '''
+    import gc
+    try:
+        import netaddr
+        import routing
+        import tap
+        import util
+        import dest_event
+        import egress
+        from ryu.controller import ofp_event
+        from ryu.ofproto import ofproto_v1_0, ofproto_v1_0_parser
+    except ImportError:
+        print 'no Ryu'
+        return
+
+    class Tap(object):
+        mac_addr = netaddr.EUI('02:00:00:00:00:fe')
+
+        def set_nonblocking(self):
+            pass
+
+        def write(self, data):
+            pass
+
+    class Datapath(FakeDatapath):
+        ofproto = ofproto_v1_0
+        ofproto_parser = ofproto_v1_0_parser
+
+        def __init__(self, dpid, sent):
+            super(Datapath, self).__init__(dpid)
+            self.sent = sent
+            self.xid = 0
+
+        def set_xid(self, msg):
+            self.xid += 1
+            msg.set_xid(self.xid)
+            return self.xid
+
+        def send_msg(self, msg):
+            if msg.xid is None:
+                self.set_xid(msg)
+            msg.serialize()
+            self.sent['messages'] += 1
+            if msg.msg_type == ofproto_v1_0.OFPT_BARRIER_REQUEST:
+                self.sent['barriers'].append(msg)
+
+    rand = random.Random(1)
+    border = n
+    flows = [(rand.randint(1, n), rand.randint(1, n),
+              rand.randint(2, hosts + 1), rand.randint(0, 1))
+             for i in xrange(flows)]
+    datas = []
+    for i in xrange(packets):
+        first = i * len(flows) / packets
+        src, dst, host, external = flows[
+            rand.randint(first, first + active - 1) % len(flows)]
+        if external:
+            ip_dst = 0x64000000 + (dst % prefixes << 16) + host * 256 + src % 256
+        else:
+            ip_dst = 0x0a000000 + dst * 256 + host
+        tcp = struct.pack('!HH', 1024 + src, 80) + '\0' * 8 + \
+            '\x50\x02' + '\0' * 6
+        ip = struct.pack('!BBHHHBBHII', 0x45, 0, 20 + len(tcp), i, 0, 64, 6,
+                         0, 0x0a000002 + src * 256, ip_dst)
+        datas.append((src, struct.pack('!6s6sH', '\x02' * 6, '\x04' * 6,
+                                       0x0800) + ip + tcp))
+
+    def make_app():
+        if tap.device is None:
+            tap.device = Tap()
+        util.bgper_config = {'local_ipv4': '192.0.2.1',
+                             'local_ipv6': '2001:db8::1', 'neighbor': []}
+        app = routing.Routing()
+        sent = app.sent = {'messages': 0, 'barriers': [], 'requests': 0}
+        dpid_to_switch, graph = random_topology(n)
+        add_gateways(dpid_to_switch)
+        for dpid, switch in dpid_to_switch.iteritems():
+            switch.dp = Datapath(dpid, sent)
+            for port_no, port in switch.ports.iteritems():
+                port.hw_addr = netaddr.EUI(0x020000000000 + dpid * 256 +
+                                           port_no)
+                port.templates = None
+        app.dpid_to_switch = dpid_to_switch
+        app.graph = graph
+        app.routing_algo = algorithm.IncrementalSPF(dpid_to_switch, graph)
+        app.frr = frr.FastReroute(app.routing_algo,
+                                  routing.Routing.FLOW_HARD_TIMEOUT)
+        for switch in dpid_to_switch.itervalues():
+            app.switches.update_switch(switch)
+
+        # hosts behind the gateways and the border neighbor are known
+        now = time.time()
+        for dpid, switch in dpid_to_switch.iteritems():
+            port_no = len(switch.ports)
+            for host in xrange(2, hosts + 2):
+                app.neighbors.learn(
+                    netaddr.IPAddress('10.%d.%d.%d' % (
+                        dpid / 256, dpid % 256, host)),
+                    netaddr.EUI(0x040000000000 + dpid * 256 + host),
+                    dpid, port_no, now)
+        switch = dpid_to_switch[border]
+        outport_no = len(switch.ports)
+        neighbor_ip = netaddr.IPAddress('10.%d.%d.254' % (border / 256,
+                                                          border % 256))
+        exit = egress.Exit(switch.name, outport_no, neighbor_ip)
+
+        def send_request(req):
+            sent['requests'] += 1
+            return dest_event.EventDestinationReply(
+                dpid=border, outport_no=outport_no, neighbor_ip=neighbor_ip,
+                exits=[exit], network_len=16)
+        app.send_request = send_request
+
+        msgs = []
+        for src, data in datas:
+            dp = dpid_to_switch[src].dp
+            msg = ofproto_v1_0_parser.OFPPacketIn(
+                dp, buffer_id=ofproto_v1_0.OFP_NO_BUFFER, total_len=len(data),
+                in_port=1, reason=ofproto_v1_0.OFPR_NO_MATCH, data=data)
+            # as packet_in_handler
+            pkt = headers.Headers(msg.data)
+            five_tuple = pkt.five_tuple()
+            msgs.append((msg, pkt, five_tuple, False))
+        return app, msgs
+
+    def reply_barriers(app):
+        # the replies might send the barriers of the next switches
+        barriers = app.sent['barriers']
+        while barriers:
+            req = barriers.pop(0)
+            reply = ofproto_v1_0_parser.OFPBarrierReply(req.datapath)
+            reply.xid = req.xid
+            app.barrier_reply_handler(ofp_event.EventOFPBarrierReply(reply))
+
+    def one_by_one(app, msgs):
+        for msg, pkt, five_tuple, bgp in msgs:
+            app._packet_in(msg, pkt, five_tuple, bgp)
+            # as _flush_messages does for the rate limited flow mods
+            app.scheduler.flush(time.time())
+            reply_barriers(app)
+
+    def batched(app, msgs):
+        for i in xrange(0, len(msgs), batch):
+            app._handle_batch(msgs[i:i + batch])
+            reply_barriers(app)
+
+    print '%d switches, %d packet ins of %d flows, batches of %d, ' \
+        '%d external prefixes' % (n, packets, len(flows), batch, prefixes)
+    print '%20s %14s %14s %14s' % ('', 'packets/s', 'messages',
+                                   'BGP requests')
+    for name, run in (('one by one', one_by_one), ('batched', batched)):
+        app, msgs = make_app()
+        # the green threads of the apps keep them alive, collections
+        # over both would land in either run
+        gc.collect()
+        gc.disable()
+        try:
+            t = _timeit(run, app, msgs)
+        finally:
+            gc.enable()
+        print '%20s %14.0f %14d %14d' % (name, packets / t,
+                                         app.sent['messages'],
+                                         app.sent['requests'])
+    # one request per external prefix of a batch at most
+    assert app.sent['requests'] <= \
+        (packets + batch - 1) / batch * min(prefixes, batch)
+
+
+def bench_gateways(sizes=(10, 100, 1000), lookups=5000):
+    '''
+        find_switch_of_network as a scan of the gateways of all the
+        ports against switch_index.SwitchIndex
+    '''
+    import netaddr
+    import switch_index
+
+    print '%8s %14s %14s %8s' % ('switches', 'scan(/s)', 'index(/s)',
+                                 'speedup')
+    for n in sizes:
+        dpid_to_switch, graph = random_topology(n)
+        add_gateways(dpid_to_switch)
+        index = switch_index.SwitchIndex()
+        for switch in dpid_to_switch.itervalues():
+            index.update_switch(switch)
+        rand = random.Random(n)
+        addrs = []
+        for i in xrange(lookups):
+            dpid = rand.randint(1, n)
+            if i % 2:
+                addrs.append(netaddr.IPAddress('10.%d.%d.%d' % (
+                    dpid / 256, dpid % 256, rand.randint(1, 254))))
+            else:
+                addrs.append(netaddr.IPAddress('2001:%x::%x' % (
+                    dpid, rand.randint(1, 0xffff))))
+
+        def scan(addr):
+            # as find_switch_of_network did
+            for dpid, switch in dpid_to_switch.iteritems():
+                for port_no, port in switch.ports.iteritems():
+                    if not port.gateway:
+                        continue
+                    if addr.version == 4:
+                        network = port.gateway.gw_ip_network
+                        gw_ip = port.gateway.gw_ip
+                    else:
+                        network = port.gateway.gw_ipv6_network
+                        gw_ip = port.gateway.gw_ipv6
+                    if addr in network:
+                        return switch, port_no, addr == gw_ip
+            return None
+
+        t1 = _timeit(lambda: [scan(a) for a in addrs])
+        t2 = _timeit(lambda: [index.lookup(a) for a in addrs])
+        for addr in addrs:
+            assert scan(addr) == index.lookup(addr)
+        print '%8d %14.0f %14.0f %7.1fx' % (n, lookups / t1, lookups / t2,
+                                             t1 / t2)
+
+
+def bench_templates(packets=20000):
+    '''
+        ARP requests, NS, NA and echo replies built by Ryu's packet
+        library as before, against packet_templates; needs Ryu for the
+        former
+    '''
+    import netaddr
+    import packet_templates
+    from gateway import Gateway
+
+    gateway = Gateway(ip='10.0.0.1', ipv6='2001:db8::1', prefixlen=24,
+                      ipv6prefixlen=64)
+    hw_addr = '02:00:00:00:00:01'
+    host_mac = '02:00:00:00:00:09'
+    hosts4 = [str(netaddr.IPAddress(0x0a000000 + i % 65536 + 2))
+              for i in xrange(packets)]
+    hosts6 = [str(netaddr.IPAddress((0x20010db8 << 96) + i + 2, 6))
+              for i in xrange(packets)]
+    packed4 = [netaddr.IPAddress(h).packed for h in hosts4]
+    packed6 = [netaddr.IPAddress(h).packed for h in hosts6]
+    templates = packet_templates.PortTemplates(
+        netaddr.EUI(hw_addr).packed, gateway)
+    # echo requests to the gateway, replied by both
+    request = struct.pack('!6s6sH', netaddr.EUI(hw_addr).packed,
+                          netaddr.EUI(host_mac).packed, 0x86dd) + \
+        struct.pack('!IHBB16s16s', 6 << 28, 64, 58, 64, packed6[0],
+                    gateway.gw_ipv6.packed) + \
+        struct.pack('!BBHHH', 128, 0, 0, 7, 1) + 'x' * 56
+    csum = packet_templates.checksum(packet_templates.ones_sum(
+        request[54:] + packed6[0] + gateway.gw_ipv6.packed, 64 + 58))
+    request = request[:56] + struct.pack('!H', csum) + request[58:]
+
+    def fast():
+        mac = netaddr.EUI(hw_addr).packed
+        dst_mac = netaddr.EUI(host_mac).packed
+        for i in xrange(packets / 4):
+            templates.arp(packed4[i])
+            templates.neighbor_solicit(packed6[i])
+            packet_templates.neighbor_advert(mac, dst_mac,
+                                             gateway.gw_ipv6.packed,
+                                             packed6[i], 7)
+            packet_templates.echo_reply(request, mac)
+
+    def ryu():
+        def serialize(*protocols):
+            p = packet.Packet()
+            for protocol in protocols:
+                p.add_protocol(protocol)
+            p.serialize()
+            return p.data
+
+        for i in xrange(packets / 4):
+            serialize(ethernet.ethernet(dst='ff:ff:ff:ff:ff:ff', src=hw_addr,
+                                        ethertype=0x0806),
+                      arp.arp_ip(opcode=arp.ARP_REQUEST, src_mac=hw_addr,
+                                 src_ip='10.0.0.1',
+                                 dst_mac='00:00:00:00:00:00',
+                                 dst_ip=hosts4[i]))
+            # as _generate_dst_for_NS did
+            mc_mac, mc_ip = packet_templates.solicited_node(packed6[i])
+            serialize(ethernet.ethernet(
+                          dst=':'.join('%02x' % ord(c) for c in mc_mac),
+                          src=hw_addr, ethertype=0x86dd),
+                      ipv6.ipv6(payload_length=32, nxt=58, hop_limit=255,
+                                src='2001:db8::1', dst=str(
+                                    netaddr.IPAddress(
+                                        int(mc_ip.encode('hex'), 16), 6))),
+                      icmpv6.icmpv6(type_=icmpv6.ND_NEIGHBOR_SOLICIT,
+                                    data=icmpv6.nd_neighbor(
+                                        dst=hosts6[i],
+                                        option=icmpv6.nd_option_sla(
+                                            hw_src=hw_addr))))
+            serialize(ethernet.ethernet(host_mac, hw_addr, 0x86dd),
+                      ipv6.ipv6(payload_length=32, nxt=58, hop_limit=255,
+                                src='2001:db8::1', dst=hosts6[i]),
+                      icmpv6.icmpv6(type_=icmpv6.ND_NEIGHBOR_ADVERT,
+                                    data=icmpv6.nd_neighbor(
+                                        res=7, dst='2001:db8::1',
+                                        option=icmpv6.nd_option_tla(
+                                            hw_src=hw_addr))))
+            pkt = packet.Packet(request)
+            echo = pkt.protocols[2]
+            serialize(ethernet.ethernet(host_mac, hw_addr, 0x86dd),
+                      ipv6.ipv6(payload_length=64, nxt=58, hop_limit=64,
+                                src='2001:db8::1', dst=hosts6[0]),
+                      icmpv6.icmpv6(type_=icmpv6.ICMPV6_ECHO_REPLY,
+                                    data=echo.data))
+
+    print '%d packets, ARP requests, NS, NA and echo replies' % packets
+    print '%20s %14s' % ('', 'packets/s')
+    try:
+        from ryu.lib.packet import packet, ethernet, arp, ipv6, icmpv6
+    except ImportError:
+        print '%20s %14s' % ('Ryu packet', 'no Ryu')
+    else:
+        print '%20s %14.0f' % ('Ryu packet', packets / _timeit(ryu))
+    print '%20s %14.0f' % ('packet_templates', packets / _timeit(fast))
+
+
+def bench_flow_mods(flows=20000):
+    '''
+        flow mods towards a destination, IPv4 and IPv6 ones as
+        _send_flow_mod sends them: encoded by Ryu for each one as before,
+        against flow_templates; both need Ryu
+    '''
+    try:
+        import netaddr
+        import flow_templates
+        from ryu.ofproto import ofproto_v1_0, ofproto_v1_0_parser, nx_match
+    except ImportError:
+        print 'no Ryu'
+        return
+
+    class Datapath(FakeDatapath):
+        ofproto = ofproto_v1_0
+        ofproto_parser = ofproto_v1_0_parser
+
+    dp = Datapath(1)
+    parser = ofproto_v1_0_parser
+    mac_src = netaddr.EUI('02:00:00:00:00:01')
+    mac_dst = netaddr.EUI('02:00:00:00:00:09')
+    ips = [netaddr.IPAddress(0x0a000000 + i + 2) if i % 2 else
+           netaddr.IPAddress((0x20010db8 << 96) + i + 2, 6)
+           for i in xrange(flows)]
+    wildcards = ofproto_v1_0.OFPFW_ALL & ~ofproto_v1_0.OFPFW_DL_TYPE & \
+        ~(0x3f << ofproto_v1_0.OFPFW_NW_DST_SHIFT)
+
+    def encode(cookie, mac_src, mac_dst, ip_dst, buffer_id):
+        # as _flow_match and _encode_flow_mod do
+        actions = [parser.OFPActionSetDlSrc(mac_src.packed),
+                   parser.OFPActionSetDlDst(mac_dst.packed),
+                   parser.OFPActionOutput(3)]
+        if ip_dst.version == 4:
+            match = parser.OFPMatch(
+                wildcards, 0, 0, 0, 0, 0, 0x0800, 0, 0, 0, ip_dst.value,
+                0, 0)
+            return parser.OFPFlowMod(
+                dp, match, cookie, ofproto_v1_0.OFPFC_ADD, 60, 600,
+                ofproto_v1_0.OFP_DEFAULT_PRIORITY, buffer_id, 3,
+                ofproto_v1_0.OFPFF_SEND_FLOW_REM, actions)
+        rule = nx_match.ClsRule()
+        rule.set_dl_type(0x86dd)
+        rule.set_ipv6_dst(struct.unpack('!8H', ip_dst.packed))
+        return parser.NXTFlowMod(
+            dp, cookie, ofproto_v1_0.OFPFC_ADD, 60, 600,
+            ofproto_v1_0.OFP_DEFAULT_PRIORITY, buffer_id, 3,
+            ofproto_v1_0.OFPFF_SEND_FLOW_REM, rule, actions)
+
+    def ryu():
+        bufs = []
+        for i, ip in enumerate(ips):
+            msg = encode(i, mac_src, mac_dst, ip, ofproto_v1_0.OFP_NO_BUFFER)
+            msg.xid = i
+            msg.serialize()
+            bufs.append(msg.buf)
+        return bufs
+
+    def fast():
+        templates = flow_templates.FlowModTemplates()
+        src, dst = mac_src.packed, mac_dst.packed
+        bufs = []
+        for i, ip in enumerate(ips):
+            msg = templates.build(dp, 3, ip.version,
+                                  ofproto_v1_0.OFP_DEFAULT_PRIORITY, encode,
+                                  i, src, dst, ip.value,
+                                  ofproto_v1_0.OFP_NO_BUFFER)
+            msg.xid = i
+            msg.serialize()
+            bufs.append(msg.buf)
+        return bufs
+
+    assert ryu() == fast()
+    print '%d flow mods, IPv4 and IPv6' % flows
+    print '%20s %14s' % ('', 'flow mods/s')
+    print '%20s %14.0f' % ('Ryu', flows / _timeit(ryu))
+    print '%20s %14.0f' % ('flow_templates', flows / _timeit(fast))
+
+
+def bench_tap(frames=50000, size=100):
+    '''
+        frames from the kernel to the switches as the tap reader takes
+        them: one blocking read per frame in a native thread, woken
+        through a pipe as before, against non-blocking reads of every
+        queued frame on hub readiness; a datagram socket pair stands in
+        for the tap device, a native thread writes to it; needs eventlet
+    '''
+    import os
+    import socket
+    import threading
+    import Queue
+    try:
+        import eventlet
+        from eventlet import greenio, hubs
+    except ImportError:
+        print 'no eventlet'
+        return
+    import tap
+
+    frame = 'x' * size
+
+    def run(read):
+        reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        feed = threading.Thread(
+            target=lambda: [writer.send(frame) for i in xrange(frames)])
+        feed.setDaemon(True)
+        start = time.time()
+        feed.start()
+        read(reader.fileno())
+        elapsed = time.time() - start
+        feed.join()
+        reader.close()
+        writer.close()
+        return elapsed
+
+    def native(fd):
+        queue = Queue.Queue()
+        r_pipe, w_pipe = os.pipe()
+        notify_send = greenio.GreenPipe(w_pipe, 'wb', 0)
+        notify_recv = greenio.GreenPipe(r_pipe, 'rb', 0)
+
+        def read_from_tap():
+            for i in xrange(frames):
+                queue.put(os.read(fd, 2048))
+                notify_send.write(' ')
+                notify_send.flush()
+
+        def dispatch():
+            count = 0
+            while count < frames:
+                notify_recv.read(1)
+                while not queue.empty():
+                    queue.get(block=False)
+                    count += 1
+
+        thread = threading.Thread(target=read_from_tap)
+        thread.setDaemon(True)
+        thread.start()
+        eventlet.spawn(dispatch).wait()
+        notify_send.close()
+        notify_recv.close()
+
+    def green(fd):
+        tap.set_nonblocking(fd)
+
+        def dispatch():
+            count = 0
+            while count < frames:
+                hubs.trampoline(fd, read=True)
+                count += len(tap.read_available(fd, 64))
+
+        eventlet.spawn(dispatch).wait()
+
+    print '%d frames of %d bytes from the kernel' % (frames, size)
+    print '%20s %14s' % ('', 'frames/s')
+    print '%20s %14.0f' % ('native thread, pipe', frames / run(native))
+    print '%20s %14.0f' % ('green, non-blocking', frames / run(green))
+
+
+def _set_link(dpid_to_switch, graph, p1, p2, up):
+    s1 = dpid_to_switch[p1.dpid]
+    s2 = dpid_to_switch[p2.dpid]
+    if up:
+        p1.peer_switch_dpid, p1.peer_port_no = p2.dpid, p2.port_no
+        p2.peer_switch_dpid, p2.peer_port_no = p1.dpid, p1.port_no
+        s1.peer_to_local_port[s2] = p1.port_no
+        s2.peer_to_local_port[s1] = p2.port_no
+    else:
+        p1.peer_switch_dpid = p1.peer_port_no = None
+        p2.peer_switch_dpid = p2.peer_port_no = None
+        s1.peer_to_local_port.pop(s2, None)
+        s2.peer_to_local_port.pop(s1, None)
+    graph.update_port(p1)
+    graph.update_port(p2)
+
+
+def _loop_free(dpid_to_switch, next_hops, record):
+    '''
+        follow the flow entries from the backup of a moved record, the
+        packets must not come back to the switch of the record
+    '''
+    switch = dpid_to_switch[record.dpid]
+    seen = set([record.dpid])
+    dpid = switch.ports[record.outport_no].peer_switch_dpid
+    while dpid != record.dst_dpid:
+        if dpid in seen:
+            return False
+        seen.add(dpid)
+        outport_no = next_hops.get((dpid, 4, record.ip_dst, None), None)
+        if outport_no is None:
+            # no entry there, it would be sent to the controller
+            return True
+        dpid = dpid_to_switch[dpid].ports[outport_no].peer_switch_dpid
+    return True
+
+
+BENCHMARKS = {
+    'spt': bench_spt,
+    'allpairs': bench_allpairs,
+    'ecmp': bench_ecmp,
+    'invalidation': bench_invalidation,
+    'lfa': bench_lfa,
+    'cookie_deletes': bench_cookie_deletes,
+    'setup': bench_setup,
+    'packet_in': bench_packet_in,
+    'batch': bench_batch,
+    'gateways': bench_gateways,
+    'templates': bench_templates,
+    'flow_mods': bench_flow_mods,
+    'tap': bench_tap,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        print '==', name
+        BENCHMARKS[name]()
@@ -25,6 +25,11 @@ BGP4_HEADER_SIZE = BGP4.bgp4.BGP4_HEADER_SIZE
 
 
 class Server(object):
+    # called with the address of a peer which withdrew routes
+    withdraw_listener = None
+    # called with the networks of announced routes
+    announce_listener = None
+
     def __init__(self, handler, conn_num=128, *args, **kwargs):
         super(Server, self).__init__()
         self.conn_num = conn_num
@@ -256,6 +261,11 @@ class Connection(object):
                         withdraw_entries.append(entry)
         self.__add_route(advert_entries, attributes)
         self.__remove_route(withdraw_entries)
+        if withdraw_entries and Server.withdraw_listener is not None:
+            Server.withdraw_listener(netaddr.IPAddress(self.address[0]))
+        if advert_entries and Server.announce_listener is not None:
+            Server.announce_listener([netaddr.IPNetwork(e.ip)
+                                      for e in advert_entries])
 
     def __add_route(self, advert_entries, attributes):
         # XXX acquire route table lock?
@@ -11,6 +11,7 @@ from bgp_server import Server, Connection
 import BGP4
 import util
 import tap
+import egress
 
 
 LOG = logging.getLogger(__name__)
@@ -21,6 +22,29 @@ def address_match_entry(dest_addr, route_entry):
     return dest_addr in network
 
 
+def same_route_len(dest_addr, _4or6, match_len=0):
+    """
+        prefix length of the widest network around dest_addr whose
+        addresses all match the same routes as dest_addr, match_len is
+        the prefix length of its longest match, 0 if it has no route
+    """
+    dest_addr = netaddr.IPAddress(dest_addr)
+    width = 32 if _4or6 == 4 else 128
+    length = match_len
+    for entry in Server.route_table:
+        if entry._4or6 != _4or6:
+            continue
+        network = netaddr.IPNetwork(entry.ip)
+        if dest_addr in network:
+            # no longer than the longest match, it covers the whole network
+            continue
+        # bits dest_addr has in common with the network, fewer than its
+        # prefix length
+        common = width - (dest_addr.value ^ network.first).bit_length()
+        length = max(length, common + 1)
+    return length
+
+
 class BGPer(app_manager.RyuApp):
     """
         the BGP part of this project(aka. "B")
@@ -63,6 +87,8 @@ class BGPer(app_manager.RyuApp):
                                                         Server.local_as))
 
         Server.route_table = []
+        Server.withdraw_listener = self._routes_withdrawn
+        Server.announce_listener = self._routes_announced
 
         server = Server(handler)
         g = hub.spawn(server)
@@ -80,33 +106,60 @@ class BGPer(app_manager.RyuApp):
 
             hub.sleep(3)
 
+    def _routes_withdrawn(self, neighbor_ip):
+        # flows through the neighbor might go to withdrawn prefixes
+        self.send_event('Routing', dest_event.EventRouteWithdraw(neighbor_ip))
+
+    def _routes_announced(self, networks):
+        self.send_event('Routing', dest_event.EventRouteAnnounce(networks))
+
     @set_ev_cls(dest_event.EventDestinationRequest)
     def destination_request_handler(self, event):
         LOG.debug('Get EventDestinationRequest for dest addr %s',
                   event.dest_addr)
 
         longest_match = None
+        matches = []
         for entry in Server.route_table:
             if event._4or6 == entry._4or6:
                 if address_match_entry(event.dest_addr, entry):
                     if longest_match is None or \
                             entry.prefix_len > longest_match.prefix_len:
                         longest_match = entry
-
-        if longest_match:
-            address = longest_match.announcer
-            neighbors = util.bgper_config.get('neighbor')
+                        matches = [entry]
+                    elif entry.prefix_len == longest_match.prefix_len:
+                        # the same prefix announced by another neighbor
+                        matches.append(entry)
+
+        exits = []
+        neighbors = util.bgper_config.get('neighbor')
+        for entry in matches:
+            address = entry.announcer
             for neighbor in neighbors:
                 if netaddr.IPAddress(neighbor['neighbor_ipv4']) == address or \
                    netaddr.IPAddress(neighbor['neighbor_ipv6']) == address:
                     name = neighbor['border_switch']
                     outport = int(neighbor['outport_no'])
-                    reply = dest_event.EventDestinationReply(switch_name=name,
-                                                             outport_no=outport,
-                                                             neighbor_ip=address)
+                    exit = egress.Exit(name, outport, address)
+                    if exit not in exits:
+                        exits.append(exit)
                     break
-        else:
+
+        if exits:
+            reply = dest_event.EventDestinationReply(
+                    switch_name=exits[0].switch_name,
+                    outport_no=exits[0].outport_no,
+                    neighbor_ip=exits[0].neighbor_ip, exits=exits)
+        elif matches:
+            # announced by an unknown neighbor
             reply = dest_event.EventDestinationReply()
+        else:
+            length = same_route_len(event.dest_addr, event._4or6)
+            reply = dest_event.EventDestinationReply(no_route_len=length,
+                                                     network_len=length)
+        if matches:
+            reply.network_len = same_route_len(event.dest_addr, event._4or6,
+                                               longest_match.prefix_len)
 
         self.reply_to_request(event, reply)
 
@@ -15,7 +15,8 @@ class EventDestinationRequest(event.EventRequestBase):
 
 class EventDestinationReply(event.EventReplyBase):
     def __init__(self, dpid = None, switch_name = None, outport_no = None,
-                 neighbor_ip = None, dest = None):
+                 neighbor_ip = None, dest = None, exits = None,
+                 no_route_len = None, network_len = None):
         # 'dest' here is the event consumer, required by Ryu,
         # no need to set this parameter when init
         super(EventDestinationReply, self).__init__(dest)
@@ -23,3 +24,31 @@ class EventDestinationReply(event.EventReplyBase):
         self.switch_name = switch_name
         self.outport_no = outport_no
         self.neighbor_ip = neighbor_ip
+        # all the egress.Exit announcing the longest matched prefix,
+        # the fields above are filled with the first one
+        self.exits = exits or []
+        # if there is no route, the prefix length of the widest network
+        # around the address without routes
+        self.no_route_len = no_route_len
+        # the prefix length of the widest network around the address
+        # whose addresses all get this reply
+        self.network_len = network_len
+
+
+class EventRouteAnnounce(event.EventBase):
+    """
+        routes to 'networks' were announced, destinations in them could
+        have had no route before
+    """
+    def __init__(self, networks):
+        super(EventRouteAnnounce, self).__init__()
+        self.networks = networks
+
+
+class EventRouteWithdraw(event.EventBase):
+    """
+        a BGP neighbor withdrew routes, flows through it are stale
+    """
+    def __init__(self, neighbor_ip):
+        super(EventRouteWithdraw, self).__init__()
+        self.neighbor_ip = neighbor_ip
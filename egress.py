@@ -0,0 +1,87 @@
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Exit(object):
+    '''
+        a way out of the AS: a border switch port towards a BGP neighbor
+    '''
+    def __init__(self, switch_name, outport_no, neighbor_ip):
+        self.switch_name = switch_name
+        self.outport_no = outport_no
+        self.neighbor_ip = neighbor_ip
+
+    def __eq__(self, other):
+        if not isinstance(other, Exit):
+            return False
+        return self.switch_name == other.switch_name and \
+               self.outport_no == other.outport_no and \
+               self.neighbor_ip == other.neighbor_ip
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.switch_name, self.outport_no, self.neighbor_ip))
+
+    def __str__(self):
+        return 'Exit<switch=%s, outport_no=%s, neighbor=%s>' % (
+            self.switch_name, self.outport_no, self.neighbor_ip)
+
+
+class EgressSelector(object):
+    '''
+        chooses among the exits announcing the same prefix; the least
+        loaded acceptable exit wins, the internal path cost breaks ties
+        between exits of similar load, and a destination keeps its exit
+        while it is in use, so existing flows don't move
+    '''
+    MAX_UTILIZATION = 0.9   # exits above this are used only if all are
+    UTILIZATION_STEP = 0.1  # loads within a step are considered equal
+    STICKY_TIMEOUT = 60     # in seconds, the same as idle timeout of flows
+
+    def __init__(self):
+        self.sticky = {}    # sticky[dest_addr] = [Exit, last used time]
+
+    def select(self, dest_addr, exits, cost, utilization, now):
+        '''
+            'cost(exit)' is the internal path cost to the border switch of
+            the exit, inf if not reachable; 'utilization(exit)' is the
+            load of its port, 1.0 means full; return None if no exit is
+            reachable
+        '''
+        try:
+            entry = self.sticky[dest_addr]
+        except KeyError:
+            entry = None
+        if entry is not None and now - entry[1] < \
+                EgressSelector.STICKY_TIMEOUT and entry[0] in exits and \
+                cost(entry[0]) != float('inf'):
+            entry[1] = now
+            return entry[0]
+
+        candidates = []
+        for exit in exits:
+            c = cost(exit)
+            if c != float('inf'):
+                candidates.append((utilization(exit), c, exit))
+        if not candidates:
+            self.sticky.pop(dest_addr, None)
+            return None
+
+        acceptable = [x for x in candidates
+                      if x[0] <= EgressSelector.MAX_UTILIZATION]
+        if not acceptable:
+            acceptable = candidates
+        load, c, exit = min(acceptable, key=lambda x: (
+            int(x[0] / EgressSelector.UTILIZATION_STEP), x[1]))
+        LOG.debug('Exit %s selected for %s, utilization %.2f, cost %s',
+                  exit, dest_addr, load, c)
+        self.sticky[dest_addr] = [exit, now]
+        return exit
+
+    def expire(self, now):
+        for dest_addr in [k for k, v in self.sticky.iteritems()
+                          if now - v[1] >= EgressSelector.STICKY_TIMEOUT]:
+            del self.sticky[dest_addr]
@@ -0,0 +1,125 @@
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# a cookie of a flow entry deployed by routing is made of
+#   bits 63-56  TAG, to tell the entries from the ones of other apps
+#   bits 55-32  route id, one per (ingress switch, egress switch)
+#   bits 31-16  egress id, one per exit of the AS, 0 inside the AS
+#   bits 15-0   generation of the route, increased when it's invalidated
+TAG = 0x52 << 56
+TAG_MASK = 0xff << 56
+ROUTE_MASK = 0xffffff << 32
+EGRESS_MASK = 0xffff << 16
+GENERATION_MASK = 0xffff
+
+
+class Route(object):
+    def __init__(self, route_id):
+        self.route_id = route_id
+        self.generation = 0
+        self.dpids = set()      # switches where entries of it are deployed
+
+
+class Egress(object):
+    def __init__(self, egress_id):
+        self.egress_id = egress_id
+        self.dpids = set()
+
+
+class Cookies(object):
+    '''
+        allocates the cookies of flow entries and remembers which switches
+        got entries of each route and egress, so stale entries are deleted
+        by a few cookie masked deletes per invalidated route or exit,
+        without knowing the entries themselves
+    '''
+    def __init__(self):
+        self.routes = {}        # routes[(src_dpid, dst_dpid)] = Route
+        self.egresses = {}      # egresses[egress.Exit] = Egress
+        self._next_route_id = 1
+        self._next_egress_id = 1
+
+    def cookie(self, src_dpid, dst_dpid, dpid, exit=None):
+        '''
+            cookie of an entry deployed to switch dpid on the route from
+            src_dpid to dst_dpid, towards 'exit' if it leaves the AS
+        '''
+        try:
+            route = self.routes[src_dpid, dst_dpid]
+        except KeyError:
+            route = Route(self._next_route_id)
+            self._next_route_id = self._next_route_id % (ROUTE_MASK >> 32) + 1
+            self.routes[src_dpid, dst_dpid] = route
+        route.dpids.add(dpid)
+
+        egress_id = 0
+        if exit is not None:
+            egress = self._get_egress(exit)
+            egress.dpids.add(dpid)
+            egress_id = egress.egress_id
+        return TAG | route.route_id << 32 | egress_id << 16 | route.generation
+
+    def invalidate_routes(self, pairs):
+        '''
+            pairs is a collection of (src_dpid, dst_dpid) whose routes
+            changed; return [(dpid, cookie, mask)] of the deletes to send
+        '''
+        deletes = []
+        for pair in pairs:
+            route = self.routes.get(pair, None)
+            if route is None or not route.dpids:
+                continue
+            cookie = TAG | route.route_id << 32 | route.generation
+            for dpid in route.dpids:
+                deletes.append((dpid, cookie,
+                                TAG_MASK | ROUTE_MASK | GENERATION_MASK))
+            # entries deployed from now on don't match the deletes
+            route.generation = (route.generation + 1) & GENERATION_MASK
+            route.dpids = set()
+        return deletes
+
+    def invalidate_exits(self, neighbor_ips):
+        '''
+            invalidate the exits through the neighbors, whose announced
+            routes changed; return [(dpid, cookie, mask)] like
+            invalidate_routes
+        '''
+        deletes = []
+        for exit in [e for e in self.egresses if e.neighbor_ip in neighbor_ips]:
+            egress = self.egresses.pop(exit)
+            cookie = TAG | egress.egress_id << 16
+            for dpid in egress.dpids:
+                deletes.append((dpid, cookie, TAG_MASK | EGRESS_MASK))
+        return deletes
+
+    def invalidate_all(self, dpids):
+        '''
+            every route could have changed; return the deletes of all the
+            entries with cookies on the switches
+        '''
+        for route in self.routes.itervalues():
+            route.generation = (route.generation + 1) & GENERATION_MASK
+            route.dpids = set()
+        self.egresses = {}
+        return [(dpid, TAG, TAG_MASK) for dpid in dpids]
+
+    def remove_switch(self, dpid):
+        for pair in [p for p in self.routes if dpid in p]:
+            del self.routes[pair]
+        for route in self.routes.itervalues():
+            route.dpids.discard(dpid)
+        for egress in self.egresses.itervalues():
+            egress.dpids.discard(dpid)
+
+    def _get_egress(self, exit):
+        try:
+            return self.egresses[exit]
+        except KeyError:
+            pass
+        # a new id every time, so the entries of an invalidated exit
+        # don't share it with new ones
+        egress = Egress(self._next_egress_id)
+        self._next_egress_id = self._next_egress_id % (EGRESS_MASK >> 16) + 1
+        self.egresses[exit] = egress
+        return egress
@@ -0,0 +1,178 @@
+import collections
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# classes of the messages to a switch, the lower the sooner sent
+PACKET_OUT = 0
+REACTIVE = 1        # flow mods of flow setups and fast reroute
+BULK = 2            # deletes of invalidated routes, pre-installed entries
+CLASSES = (PACKET_OUT, REACTIVE, BULK)
+CLASS_NAMES = ('packet out', 'reactive', 'bulk')
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, now):
+        self.rate = rate        # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        '''
+            return False if there is no token now
+        '''
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Queued(object):
+    def __init__(self, msg, cls, key, limited):
+        self.msg = msg          # None once superseded
+        self.cls = cls
+        self.key = key
+        self.limited = limited  # takes a token
+        self.done = False       # sent or superseded
+
+
+class SwitchQueue(object):
+    def __init__(self, dp, rate, burst, now):
+        self.dp = dp
+        self.bucket = TokenBucket(rate, burst, now)
+        self.queues = [collections.deque() for cls in CLASSES]
+        self.by_key = {}        # by_key[key] = Queued, not sent yet
+
+    def depth(self):
+        return [sum(1 for q in queue if q.msg is not None)
+                for queue in self.queues]
+
+
+class Scheduler(object):
+    '''
+        sends the messages to every switch in order of their classes,
+        flow mods at most 'rate' per second with bursts of 'burst'; a
+        queued flow mod is replaced by a later one of the same key, i.e.
+        the same match, instead of being sent as well; messages of a
+        class reach a switch in the order they were given
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.switches = {}      # switches[dpid] = SwitchQueue
+        self.backlog = set()    # dpids with messages waiting for tokens
+        self.sent = [0] * len(CLASSES)
+        self.coalesced = 0
+        self.delayed = 0        # messages which had to wait for a token
+        self.max_depth = 0
+        self.held = False
+
+    def send(self, dp, msg, cls, now, key=None, limited=True):
+        '''
+            queue msg to dp and send what the rate allows; 'key'
+            identifies the match of a flow mod; 'limited' is False for
+            messages not taking a token, e.g. barriers, which are still
+            sent after the messages queued before in their class
+        '''
+        switch = self.switches.get(dp.id, None)
+        if switch is None or switch.dp is not dp:
+            switch = SwitchQueue(dp, self.rate, self.burst, now)
+            self.switches[dp.id] = switch
+        if cls == PACKET_OUT:
+            limited = False
+
+        old = switch.by_key.get(key, None) if key is not None else None
+        if old is not None and old.cls <= cls:
+            # sent as soon as the superseded one would have been
+            old.msg = msg
+            self.coalesced += 1
+            return
+        if old is not None:
+            old.msg = None
+            old.done = True
+            self.coalesced += 1
+        queued = Queued(msg, cls, key, limited)
+        switch.queues[cls].append(queued)
+        if key is not None:
+            switch.by_key[key] = queued
+        if self.held:
+            self.backlog.add(dp.id)
+            return
+        self._flush(dp.id, switch, now)
+        if not queued.done:
+            self.delayed += 1
+
+    def fence(self, dpid, covered):
+        '''
+            flow mods queued to dpid so far whose key is covered, i.e.
+            covered(key) is True, are no longer replaced by later ones,
+            which are queued after them instead; e.g. for a delete of
+            their matches queued in between
+        '''
+        switch = self.switches.get(dpid, None)
+        if switch is None:
+            return
+        for key in [k for k in switch.by_key if covered(k)]:
+            del switch.by_key[key]
+
+    def hold(self):
+        '''
+            queue messages without sending them until release, to send
+            the ones to each switch together; the hold applies to every
+            green thread, so it must be released before blocking
+        '''
+        self.held = True
+
+    def release(self, now):
+        self.held = False
+        self.flush(now)
+
+    def flush(self, now):
+        '''
+            send what the rate allows to the switches with a backlog
+        '''
+        if self.held:
+            return
+        for dpid in list(self.backlog):
+            self._flush(dpid, self.switches[dpid], now)
+
+    def _flush(self, dpid, switch, now):
+        for queue in switch.queues:
+            while queue:
+                queued = queue[0]
+                if queued.msg is not None and queued.limited and \
+                        not switch.bucket.take(now):
+                    break
+                queue.popleft()
+                if queued.msg is None:
+                    continue
+                queued.done = True
+                if switch.by_key.get(queued.key, None) is queued:
+                    del switch.by_key[queued.key]
+                switch.dp.send_msg(queued.msg)
+                self.sent[queued.cls] += 1
+            if queue:
+                # later classes don't take the tokens of this one
+                break
+        depth = sum(len(queue) for queue in switch.queues)
+        if depth:
+            self.backlog.add(dpid)
+            self.max_depth = max(self.max_depth, depth)
+        else:
+            self.backlog.discard(dpid)
+
+    def remove_switch(self, dpid):
+        self.switches.pop(dpid, None)
+        self.backlog.discard(dpid)
+
+    def depths(self):
+        '''
+            depths[dpid] = [queued messages of each class], of the
+            switches with a backlog
+        '''
+        return dict((dpid, self.switches[dpid].depth())
+                    for dpid in self.backlog)
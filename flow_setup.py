@@ -0,0 +1,187 @@
+import logging
+
+import headers
+
+LOG = logging.getLogger(__name__)
+
+
+def peek_five_tuple(data):
+    '''
+        (4 or 6, src ip, dst ip, ip proto, src port, dst port) read from
+        the raw data of an untagged IP packet, addresses are left packed
+        and ports are 0 if it's neither TCP nor UDP; None if not IP
+    '''
+    return headers.Headers(data).five_tuple()
+
+
+class Setup(object):
+    '''
+        flow setup started by the packet in 'msg' at the ingress switch
+    '''
+    def __init__(self, key, msg, five_tuple, now, generation):
+        self.key = key
+        self.msg = msg
+        # if the entries match the 5-tuple, only packets of it follow
+        self.five_tuple = five_tuple
+        self.started = now
+        self.completed = None
+        self.generation = generation    # of PendingSetups when started
+        self.dp = None          # ingress datapath, set once entries are sent
+        self.actions = None     # of the packet out at the ingress switch
+        # sends the entry of the ingress switch held back until the
+        # barriers are replied, and returns the actions
+        self.install = None
+        self.waiting = []       # packet ins to release on completion
+        # (dpid, xid) of the barrier requests not replied yet
+        self.barriers = set()
+
+    def matches(self, five_tuple):
+        return self.five_tuple is None or self.five_tuple == five_tuple
+
+    def release_actions(self):
+        '''
+            actions of the packet out at the ingress switch, its entry is
+            sent first if it's held back
+        '''
+        if self.install is not None:
+            self.actions = self.install()
+            self.install = None
+        return self.actions
+
+
+class PendingSetups(object):
+    '''
+        flow setups keyed by (ingress dpid, destination address); packet
+        ins for the same destination wait for the running setup and are
+        sent along its path, instead of being routed again, until the
+        entries are surely installed
+    '''
+    TIMEOUT = 1.0       # in seconds, after the setup started or completed
+    MAX_WAITING = 64    # packet ins per setup, further ones are dropped
+
+    def __init__(self):
+        self.setups = {}
+        self.barriers = {}      # barriers[(dpid, xid)] = Setup
+        self.expired = []       # see expire
+        self.coalesced = 0
+        self.generation = 0     # increased by routes_changed
+
+    def routes_changed(self):
+        '''
+            the actions of the setups completed so far may be stale, so
+            packet ins are routed again instead of following them
+        '''
+        self.generation += 1
+
+    def lookup(self, key, now):
+        setup = self.setups.get(key, None)
+        if setup is None:
+            return None
+        if now - (setup.completed or setup.started) >= PendingSetups.TIMEOUT:
+            self.expired.append((setup, self.abort(setup)))
+            return None
+        if setup.completed is not None and \
+                setup.generation != self.generation:
+            # nothing waits for a completed setup
+            self.abort(setup)
+            return None
+        return setup
+
+    def start(self, key, msg, five_tuple, now):
+        setup = Setup(key, msg, five_tuple, now, self.generation)
+        self.setups[key] = setup
+        return setup
+
+    def wait(self, setup, msg):
+        '''
+            return False if the packet in can't wait for the setup
+        '''
+        if len(setup.waiting) >= PendingSetups.MAX_WAITING:
+            return False
+        setup.waiting.append(msg)
+        self.coalesced += 1
+        return True
+
+    def complete(self, key, msg, dp, actions, exact, now, barriers=(),
+                 install=None):
+        '''
+            the entries of the setup started by msg are sent, packets
+            follow 'actions' at the ingress 'dp'; 'exact' is True if the
+            entries match the 5-tuple; if 'barriers' are given, i.e.
+            (dpid, xid) of barrier requests sent after the entries, the
+            setup completes when they are all replied (see barrier_reply)
+            and msg waits as well, 'install' is then Setup.install;
+            return the packet ins to release now, msg included, or None
+            if msg didn't start a setup
+        '''
+        setup = self.setups.get(key, None)
+        if setup is None or setup.msg is not msg or setup.dp is not None:
+            return None
+        setup.dp, setup.actions = dp, actions
+        setup.install = install
+        if not exact:
+            setup.five_tuple = None
+        setup.waiting.insert(0, msg)
+        if barriers:
+            self._wait_barriers(setup, barriers)
+            return []
+        return self._done(setup, now)
+
+    def complete_alone(self, msg, dp, barriers, install, now):
+        '''
+            as complete with barriers, for a packet in which didn't start
+            a setup that others may wait for, e.g. a BGP packet; it's
+            released by barrier_reply all the same
+        '''
+        setup = self.start(('barriers',) + barriers[0], msg, None, now)
+        setup.dp, setup.install = dp, install
+        setup.waiting.append(msg)
+        self._wait_barriers(setup, barriers)
+
+    def _wait_barriers(self, setup, barriers):
+        setup.barriers = set(barriers)
+        for barrier in barriers:
+            self.barriers[barrier] = setup
+
+    def barrier_reply(self, dpid, xid, now):
+        '''
+            return (dp, actions, packet ins) to release if the reply
+            completes a setup, (None, None, []) otherwise
+        '''
+        setup = self.barriers.pop((dpid, xid), None)
+        if setup is None:
+            return None, None, []
+        setup.barriers.discard((dpid, xid))
+        if setup.barriers:
+            return None, None, []
+        return setup.dp, setup.release_actions(), self._done(setup, now)
+
+    def _done(self, setup, now):
+        setup.completed = now
+        waiting, setup.waiting = setup.waiting, []
+        return waiting
+
+    def abort(self, setup):
+        '''
+            forget the setup; return the waiting packet ins
+        '''
+        if self.setups.get(setup.key, None) is setup:
+            del self.setups[setup.key]
+        for barrier in setup.barriers:
+            self.barriers.pop(barrier, None)
+        setup.barriers = set()
+        waiting, setup.waiting = setup.waiting, []
+        return waiting
+
+    def expire(self, now):
+        '''
+            drop timed out setups; return [(setup, waiting packet ins)],
+            the packets may follow the setup if its entries were sent,
+            i.e. setup.dp is set, though barriers weren't all replied
+        '''
+        expired, self.expired = self.expired, []
+        for setup in [s for s in self.setups.itervalues()
+                      if now - (s.completed or s.started) >=
+                      PendingSetups.TIMEOUT]:
+            expired.append((setup, self.abort(setup)))
+        return expired
@@ -0,0 +1,91 @@
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class FlowEntry(object):
+    def __init__(self, cookie, actions, installed, expires, reported):
+        self.cookie = cookie
+        self.actions = actions      # hashable summary of the actions
+        self.installed = installed
+        self.expires = expires      # by hard timeout
+        # True if the switch reports the removal by OFPT_FLOW_REMOVED
+        self.reported = reported
+
+
+class ShadowTables(object):
+    '''
+        what the controller has installed to the flow table of every
+        switch, entries[dpid][(key, priority)] = FlowEntry, where key
+        identifies the match; kept in sync by OFPT_FLOW_REMOVED, so flow
+        mods that change nothing are not sent again
+    '''
+    # an entry whose removal isn't reported, or which is on the switch
+    # that sent the packet in, is trusted only while its flow mod may be
+    # still on the way
+    IN_FLIGHT = 1.0     # in seconds
+
+    def __init__(self):
+        self.entries = {}
+        self.suppressed = 0     # flow mods not sent
+
+    def install(self, dpid, key, priority, actions, cookie, now,
+                hard_timeout, reported, punted=False):
+        '''
+            return True if the flow mod has to be sent, and remember the
+            entry; 'punted' is True if the switch sent the packet in that
+            caused the flow mod, i.e. its entry might be gone
+        '''
+        table = self.entries.setdefault(dpid, {})
+        entry = table.get((key, priority), None)
+        if entry is not None and entry.actions == actions and \
+                entry.cookie == cookie and now < entry.expires:
+            if (entry.reported and not punted) or \
+                    now - entry.installed < ShadowTables.IN_FLIGHT:
+                self.suppressed += 1
+                return False
+        # flow mods are OFPFC_ADD, which replace the cookie and the
+        # timeouts of an existing entry
+        table[key, priority] = FlowEntry(cookie, actions, now,
+                                         now + hard_timeout, reported)
+        return True
+
+    def removed(self, dpid, key, priority):
+        table = self.entries.get(dpid, {})
+        table.pop((key, priority), None)
+
+    def remove_cookies(self, deletes):
+        '''
+            forget the entries removed by cookie masked deletes, a list of
+            (dpid, cookie, mask)
+        '''
+        for dpid, cookie, mask in deletes:
+            table = self.entries.get(dpid, {})
+            for k in [k for k, e in table.iteritems()
+                      if e.cookie & mask == cookie]:
+                del table[k]
+
+    def remove_destination(self, dpid, _4or6, ip_value):
+        '''
+            forget the entries of dpid towards the address, deleted by a
+            non-strict delete
+        '''
+        table = self.entries.get(dpid, {})
+        for k in [k for k in table if k[0][:2] == (_4or6, ip_value)]:
+            del table[k]
+
+    def remove_switch(self, dpid):
+        self.entries.pop(dpid, None)
+
+    def expire(self, now):
+        for table in self.entries.itervalues():
+            for k in [k for k, e in table.iteritems() if now >= e.expires]:
+                del table[k]
+
+    def occupancy(self):
+        '''
+            number of entries in the flow table of each switch,
+            occupancy[dpid] = count
+        '''
+        return dict((dpid, len(table))
+                    for dpid, table in self.entries.iteritems())
@@ -0,0 +1,120 @@
+import struct
+import logging
+
+import netaddr
+from ryu.ofproto.ofproto_parser import MsgBase
+from ryu.ofproto import nx_match
+
+LOG = logging.getLogger(__name__)
+
+# put into a template where the fields are patched, found by searching
+# the encoded flow mod, so they must not appear anywhere else in it
+COOKIE = 0x0123456789abcdef
+BUFFER_ID = 0xfedcba98
+MAC_SRC = netaddr.EUI('5e:a1:b2:c3:d4:e5')
+MAC_DST = netaddr.EUI('5e:f6:07:18:29:3a')
+IP_DST = {4: netaddr.IPAddress('165.60.150.15'),
+          6: netaddr.IPAddress('a53c:960f:4b5a:6978:8796:a5b4:c3d2:e1f0')}
+
+# the masked flow cookie of Open vSwitch, unknown to Ryu's ClsRule
+NXM_NX_COOKIE_W = 1 << 16 | 30 << 9 | 1 << 8 | 16
+NX_FLOW_MOD_MATCH_LEN = 40      # offset of match_len in nx_flow_mod
+
+
+class RawMessage(MsgBase):
+    '''
+        a message encoded beforehand, sent as it is but for the xid
+    '''
+    def __init__(self, datapath, data):
+        super(RawMessage, self).__init__(datapath)
+        self.data = data        # bytearray
+
+    def serialize(self):
+        struct.pack_into('!I', self.data, 4, self.xid)
+        self.buf = str(self.data)
+
+
+def cookie_delete(datapath, cookie, mask):
+    '''
+        NXT_FLOW_MOD deleting the entries of any match whose cookie & mask
+        is cookie
+    '''
+    msg = datapath.ofproto_parser.NXTFlowMod(
+        datapath=datapath, cookie=0, command=datapath.ofproto.OFPFC_DELETE,
+        rule=nx_match.ClsRule())
+    msg.xid = 0
+    msg.serialize()
+    match = struct.pack('!IQQ', NXM_NX_COOKIE_W, cookie & mask, mask)
+    data = bytearray(msg.buf) + match + '\0' * (-len(match) % 8)
+    struct.pack_into('!H', data, 2, len(data))
+    struct.pack_into('!H', data, NX_FLOW_MOD_MATCH_LEN, len(match))
+    return RawMessage(datapath, data)
+
+
+class FlowModTemplate(object):
+    def __init__(self, msg, version):
+        msg.xid = 0
+        msg.serialize()
+        self.data = bytearray(msg.buf)
+        self.version = version
+        self.cookie = self._find(struct.pack('!Q', COOKIE))
+        self.buffer_id = self._find(struct.pack('!I', BUFFER_ID))
+        self.mac_src = self._find(MAC_SRC.packed)
+        self.mac_dst = self._find(MAC_DST.packed)
+        self.ip_dst = self._find(IP_DST[version].packed)
+
+    def _find(self, sentinel):
+        offset = self.data.find(sentinel)
+        if offset < 0 or self.data.find(sentinel, offset + 1) >= 0:
+            raise ValueError('%r is not once in the flow mod'
+                             % (sentinel,))
+        return offset
+
+    def build(self, datapath, cookie, mac_src, mac_dst, ip_value,
+              buffer_id):
+        data = bytearray(self.data)
+        struct.pack_into('!Q', data, self.cookie, cookie)
+        struct.pack_into('!I', data, self.buffer_id, buffer_id)
+        data[self.mac_src:self.mac_src + 6] = mac_src
+        data[self.mac_dst:self.mac_dst + 6] = mac_dst
+        if self.version == 4:
+            struct.pack_into('!I', data, self.ip_dst, ip_value)
+        else:
+            struct.pack_into('!QQ', data, self.ip_dst, ip_value >> 64,
+                             ip_value & 0xffffffffffffffff)
+        return RawMessage(datapath, data)
+
+
+class FlowModTemplates(object):
+    '''
+        flow mods towards a destination address, encoded once per
+        (dpid, out port, address family, priority) by
+        encode(cookie, mac_src, mac_dst, ip_dst, buffer_id), which
+        returns the Ryu message; then only the cookie, the MAC addresses
+        rewritten, the destination and the buffer id are patched into a
+        copy of its bytes
+    '''
+    def __init__(self):
+        self.templates = {}
+        self.encoded = 0
+
+    def build(self, dp, outport_no, version, priority, encode, cookie,
+              mac_src, mac_dst, ip_value, buffer_id):
+        '''
+            return a RawMessage of the flow mod; mac_src and mac_dst are
+            packed
+        '''
+        key = dp.id, outport_no, version, priority
+        template = self.templates.get(key, None)
+        if template is None:
+            template = FlowModTemplate(encode(COOKIE, MAC_SRC, MAC_DST,
+                                              IP_DST[version], BUFFER_ID),
+                                       version)
+            self.templates[key] = template
+            self.encoded += 1
+        return template.build(dp, cookie, mac_src, mac_dst, ip_value,
+                              buffer_id)
+
+    def remove_switch(self, dpid):
+        for key in [k for k in self.templates if k[0] == dpid]:
+            del self.templates[key]
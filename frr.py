@@ -0,0 +1,142 @@
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class FlowRecord(object):
+    '''
+        a flow entry deployed to a switch on the way to dst_dpid, and the
+        backup next hop to use if the link of outport_no fails
+    '''
+    def __init__(self, dpid, outport_no, dst_dpid, ip_dst, _4or6,
+                 five_tuple, cookie, timestamp):
+        self.dpid = dpid
+        self.outport_no = outport_no
+        self.dst_dpid = dst_dpid
+        self.ip_dst = ip_dst
+        self._4or6 = _4or6
+        self.five_tuple = five_tuple    # None if only ip_dst is matched
+        self.cookie = cookie
+        self.timestamp = timestamp
+        self.backup = None              # (outport_no, next switch)
+        self.generation = None          # topology the backup was found in
+
+    def key(self):
+        return self.dpid, self._4or6, self.ip_dst, self.five_tuple
+
+
+class FastReroute(object):
+    '''
+        keeps the flow entries deployed between switches with a loop-free
+        alternate next hop each; when a link goes down the entries using
+        it are moved to their alternates at once, instead of pointing at
+        the dead port until they time out
+    '''
+    def __init__(self, routing_algo, timeout):
+        self.routing_algo = routing_algo
+        self.timeout = timeout      # hard timeout of the flow entries
+        self.records = {}           # records[FlowRecord.key()] = FlowRecord
+        self.by_port = {}           # by_port[(dpid, port_no)] = set of keys
+        self.generation = 0         # bumped on topology changes
+        # backups[(dpid, dst_dpid, outport_no)] = (outport_no, next switch)
+        # of the current generation, shared by the records
+        self.backups = {}
+
+    def add(self, record):
+        old = self.records.get(record.key(), None)
+        if old is not None:
+            self._unlink(old)
+        self.records[record.key()] = record
+        self.by_port.setdefault((record.dpid, record.outport_no),
+                                set()).add(record.key())
+        self._find_backup(record)
+
+    def topology_changed(self):
+        self.generation += 1
+        self.backups = {}
+
+    def refresh(self):
+        '''
+            find the backups again after topology changes, call it when
+            the topology is stable
+        '''
+        count = 0
+        for record in self.records.values():
+            if record.generation != self.generation:
+                self._find_backup(record)
+                count += 1
+        if count:
+            LOG.debug('Backups of %s flow entries refreshed', count)
+
+    def link_down(self, dpid, port_no):
+        '''
+            call it before the failed link is removed from the topology;
+            return records of the flow entries to move, their outport_no
+            is changed to the backup one
+        '''
+        keys = self.by_port.pop((dpid, port_no), set())
+        moved = []
+        for key in keys:
+            record = self.records[key]
+            if record.generation != self.generation:
+                # the backup is only stale if the topology changed since,
+                # the failed link is still there
+                self._find_backup(record)
+            if record.backup is None:
+                del self.records[key]
+                continue
+            record.outport_no = record.backup[0]
+            record.backup = None
+            record.generation = None
+            self.by_port.setdefault((dpid, record.outport_no),
+                                    set()).add(key)
+            moved.append(record)
+        if keys:
+            LOG.info('Link down at port %s of %s: %s of %s flow entries '
+                     'have a backup', port_no, dpid, len(moved), len(keys))
+        return moved
+
+    def remove_switch(self, dpid):
+        for key in [k for k in self.records if k[0] == dpid]:
+            self._unlink(self.records.pop(key))
+
+    def remove_cookies(self, deletes):
+        '''
+            forget the entries removed by cookie masked deletes, a list of
+            (dpid, cookie, mask)
+        '''
+        deletes = set(deletes)
+        masks = set(mask for dpid, cookie, mask in deletes)
+        for record in [r for r in self.records.itervalues()
+                       if any((r.dpid, r.cookie & mask, mask) in deletes
+                              for mask in masks)]:
+            self._unlink(record)
+            del self.records[record.key()]
+
+    def expire(self, now):
+        for record in [r for r in self.records.itervalues()
+                       if now - r.timestamp >= self.timeout]:
+            self._unlink(record)
+            del self.records[record.key()]
+
+    def _unlink(self, record):
+        keys = self.by_port.get((record.dpid, record.outport_no), None)
+        if keys is not None:
+            keys.discard(record.key())
+            if not keys:
+                del self.by_port[record.dpid, record.outport_no]
+
+    def _find_backup(self, record):
+        dpid_to_switch = self.routing_algo.dpid_to_switch
+        switch = dpid_to_switch.get(record.dpid, None)
+        dst = dpid_to_switch.get(record.dst_dpid, None)
+        key = record.dpid, record.dst_dpid, record.outport_no
+        if switch is None or dst is None:
+            record.backup = None
+        elif key in self.backups:
+            record.backup = self.backups[key]
+        else:
+            record.backup = self.routing_algo.loop_free_alternate(
+                switch, dst, record.outport_no)
+            self.backups[key] = record.backup
+        record.generation = self.generation
@@ -0,0 +1,151 @@
+import logging
+from array import array
+
+LOG = logging.getLogger(__name__)
+
+
+class Graph(object):
+    '''
+        topology of the switches for the routing algorithms;
+        every switch gets a dense integer index, and the links are kept in
+        compressed sparse row form, i.e. the links of switch i are at
+        positions offset[i] .. offset[i+1]-1 of the arrays
+            neighbor    index of the peer switch, -1 if the link is gone
+            local_port  port number on switch i
+            peer_port   port number on the peer switch
+            cost        cost of the link
+            reverse     position of the link in the opposite direction, -1
+                        if the peer has no such link
+        the arrays are rebuilt lazily after links are added, while cost
+        changes and deleted links are patched in place
+    '''
+    def __init__(self):
+        # a switch keeps its index after it is removed, and gets it back
+        # when it comes back
+        self.dpids = []         # dpids[index] = dpid, None if removed
+        self.index = {}         # index[dpid] = index
+
+        # links[dpid][port_no] = (peer_dpid, peer_port_no, cost)
+        self._links = {}
+        self._position = {}     # position[(index, port_no)] = position
+        self._dirty = True
+
+        self.offset = array('l', [0])
+        self.neighbor = array('l')
+        self.local_port = array('l')
+        self.peer_port = array('l')
+        self.cost = array('d')
+        self.reverse = array('l')
+
+    def __len__(self):
+        # number of indexes, including the removed switches
+        return len(self.dpids)
+
+    def add_switch(self, dpid):
+        try:
+            i = self.index[dpid]
+        except KeyError:
+            i = len(self.dpids)
+            self.dpids.append(None)
+            self.index[dpid] = i
+        if self.dpids[i] is None:
+            self.dpids[i] = dpid
+            self._links.setdefault(dpid, {})
+            self._dirty = True
+        return i
+
+    def remove_switch(self, dpid):
+        i = self.index.get(dpid, None)
+        if i is None or self.dpids[i] is None:
+            return
+        self.dpids[i] = None
+        # links of peers towards this switch are kept, so they work again
+        # if the switch comes back
+        self._links.pop(dpid, None)
+        self._dirty = True
+
+    def alive(self, dpid):
+        i = self.index.get(dpid, None)
+        return i is not None and self.dpids[i] is not None
+
+    def update_port(self, port):
+        '''
+            sync the link of a switch.Port, call it after the peer or the
+            cost of the port changed
+        '''
+        if port.peer_switch_dpid is None:
+            self.remove_port(port.dpid, port.port_no)
+            return
+        links = self._links.setdefault(port.dpid, {})
+        link = (port.peer_switch_dpid, port.peer_port_no, port.cost)
+        old = links.get(port.port_no, None)
+        if old == link:
+            return
+        links[port.port_no] = link
+        if old is not None and old[:2] == link[:2] and not self._dirty:
+            i = self.index.get(port.dpid, None)
+            position = self._position.get((i, port.port_no), None)
+            if position is not None:
+                self.cost[position] = port.cost
+                return
+        self._dirty = True
+
+    def remove_port(self, dpid, port_no):
+        links = self._links.get(dpid, {})
+        if links.pop(port_no, None) is None:
+            return
+        if self._dirty:
+            return
+        i = self.index.get(dpid, None)
+        position = self._position.pop((i, port_no), None)
+        if position is not None:
+            self.neighbor[position] = -1
+            reverse = self.reverse[position]
+            if reverse >= 0:
+                self.reverse[reverse] = -1
+            self.reverse[position] = -1
+
+    def csr(self):
+        '''
+            return (offset, neighbor, cost, reverse) of an up to date graph
+        '''
+        if self._dirty:
+            self._rebuild()
+        return self.offset, self.neighbor, self.cost, self.reverse
+
+    def _rebuild(self):
+        offset = array('l', [0])
+        neighbor = array('l')
+        local_port = array('l')
+        peer_port = array('l')
+        cost = array('d')
+        owner = array('l')
+        position = {}
+        for i, dpid in enumerate(self.dpids):
+            if dpid is not None:
+                for port_no, link in sorted(self._links[dpid].iteritems()):
+                    peer_dpid, peer_port_no, link_cost = link
+                    if not self.alive(peer_dpid):
+                        continue
+                    j = self.index[peer_dpid]
+                    position[i, port_no] = len(neighbor)
+                    owner.append(i)
+                    neighbor.append(j)
+                    local_port.append(port_no)
+                    peer_port.append(peer_port_no)
+                    cost.append(link_cost)
+            offset.append(len(neighbor))
+
+        reverse = array('l', [-1]) * len(neighbor)
+        for e in xrange(len(neighbor)):
+            r = position.get((neighbor[e], peer_port[e]), None)
+            if r is not None and neighbor[r] == owner[e]:
+                reverse[e] = r
+
+        self.offset, self.neighbor, self.cost = offset, neighbor, cost
+        self.local_port, self.peer_port = local_port, peer_port
+        self.reverse = reverse
+        self._position = position
+        self._dirty = False
+        LOG.debug('Graph rebuilt: %s switches, %s links',
+                  len(self.dpids), len(neighbor))
@@ -0,0 +1,160 @@
+import socket
+import struct
+import logging
+
+LOG = logging.getLogger(__name__)
+
+ETHERNET = struct.Struct('!6s6sH')
+IPV4 = struct.Struct('!BBHHHBBH4s4s')
+IPV6 = struct.Struct('!IHBB16s16s')
+PORTS = struct.Struct('!HH')
+MAC = struct.Struct('!6B')
+
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_IPV6 = 0x86dd
+IPPROTO_ICMP = 1
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+IPPROTO_ICMPV6 = 58
+
+# find returns it for the layers it doesn't know, see Headers.protocols
+UNKNOWN = object()
+
+
+class Ethernet(object):
+    protocol_name = 'ethernet'
+
+    def __init__(self, dst, src, ethertype):
+        self.packed_dst = dst
+        self.packed_src = src
+        self.ethertype = ethertype
+
+    @property
+    def dst(self):
+        return '%02x:%02x:%02x:%02x:%02x:%02x' % MAC.unpack(self.packed_dst)
+
+    @property
+    def src(self):
+        return '%02x:%02x:%02x:%02x:%02x:%02x' % MAC.unpack(self.packed_src)
+
+
+class IP(object):
+    '''
+        either 'ipv4' or 'ipv6', addresses are formatted like Ryu does
+    '''
+    def __init__(self, version, src, dst, proto):
+        self.protocol_name = 'ipv4' if version == 4 else 'ipv6'
+        self.version = version
+        self.packed_src = src
+        self.packed_dst = dst
+        self.proto = proto
+        self.nxt = proto        # as named in ipv6
+
+    @property
+    def src(self):
+        return self._ntop(self.packed_src)
+
+    @property
+    def dst(self):
+        return self._ntop(self.packed_dst)
+
+    def __str__(self):
+        return '%s(src=%s, dst=%s, proto=%s)' % (
+            self.protocol_name, self.src, self.dst, self.proto)
+
+    def _ntop(self, packed):
+        if self.version == 4:
+            return socket.inet_ntoa(packed)
+        return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+class L4(object):
+    def __init__(self, protocol_name, src_port, dst_port):
+        self.protocol_name = protocol_name
+        self.src_port = src_port
+        self.dst_port = dst_port
+
+
+class Headers(object):
+    '''
+        the headers of the data of a packet in which routing decides on,
+        read by precompiled structs at fixed offsets; anything else, e.g.
+        ARP or ICMP, is parsed by Ryu on demand, as 'protocols'
+    '''
+    def __init__(self, data):
+        self.data = data
+        self._protocols = None
+        self.ethernet = None
+        self.ip = None          # IP if it's untagged IPv4 or IPv6
+        self.l4 = None          # L4 if it's TCP or UDP, not a fragment
+        view = memoryview(data)
+        if len(data) < ETHERNET.size:
+            return
+        self.ethernet = Ethernet(*ETHERNET.unpack_from(view, 0))
+        eth_type = self.ethernet.ethertype
+        offset = ETHERNET.size
+        if eth_type == ETH_TYPE_IP and len(data) >= offset + IPV4.size:
+            (ver_ihl, tos, total_len, ident, frag, ttl, proto, csum,
+             src, dst) = IPV4.unpack_from(view, offset)
+            self.ip = IP(4, src, dst, proto)
+            first = frag & 0x1fff == 0
+            offset += (ver_ihl & 0xf) * 4
+        elif eth_type == ETH_TYPE_IPV6 and len(data) >= offset + IPV6.size:
+            (flow, payload_len, nxt, hlim,
+             src, dst) = IPV6.unpack_from(view, offset)
+            self.ip = IP(6, src, dst, nxt)
+            first = True
+            offset += IPV6.size
+        else:
+            return
+        if first and len(data) >= offset + PORTS.size:
+            if self.ip.proto == IPPROTO_TCP:
+                self.l4 = L4('tcp', *PORTS.unpack_from(view, offset))
+            elif self.ip.proto == IPPROTO_UDP:
+                self.l4 = L4('udp', *PORTS.unpack_from(view, offset))
+
+    @property
+    def protocols(self):
+        # parsed by Ryu the first time they are needed
+        if self._protocols is None:
+            # not imported before, the fast path runs without Ryu
+            from ryu.lib.packet import packet
+            self._protocols = packet.Packet(self.data).protocols
+        return self._protocols
+
+    def find(self, target):
+        '''
+            the layer named 'target', None if the packet hasn't it, or
+            UNKNOWN if it's to be found in 'protocols'
+        '''
+        if target == 'ethernet' and self.ethernet is not None:
+            return self.ethernet
+        if self.ip is None:
+            return UNKNOWN
+        if target == self.ip.protocol_name:
+            return self.ip
+        if target in ('ipv4', 'ipv6', 'arp'):
+            return None
+        if target in ('tcp', 'udp'):
+            if self.l4 is not None and self.l4.protocol_name == target:
+                return self.l4
+            return None
+        if target == 'icmp' and self.ip.proto != IPPROTO_ICMP:
+            return None
+        if target == 'icmpv6' and self.ip.proto != IPPROTO_ICMPV6:
+            return None
+        return UNKNOWN
+
+    def five_tuple(self):
+        '''
+            (4 or 6, src ip, dst ip, ip proto, src port, dst port) with
+            packed addresses, ports are 0 if it's neither TCP nor UDP;
+            None if it's not IP
+        '''
+        if self.ip is None:
+            return None
+        if self.l4 is None:
+            return self.ip.version, self.ip.packed_src, self.ip.packed_dst, \
+                self.ip.proto, 0, 0
+        return self.ip.version, self.ip.packed_src, self.ip.packed_dst, \
+            self.ip.proto, self.l4.src_port, self.l4.dst_port
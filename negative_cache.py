@@ -0,0 +1,80 @@
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Unroutable(object):
+    def __init__(self, network, expires):
+        self.network = network      # netaddr.IPNetwork
+        self.expires = expires
+        self.dpids = set()          # switches with a drop entry of it
+
+
+class NegativeCache(object):
+    '''
+        networks found without a route, packets to them are dropped
+        without looking them up again until the timeout or a route
+        covering a part of them shows up
+    '''
+    def __init__(self, timeout):
+        self.timeout = timeout
+        # tables[(version, prefixlen)][network value] = Unroutable
+        self.tables = {}
+        self.hits = 0
+
+    def lookup(self, addr, now):
+        '''
+            return the Unroutable containing netaddr.IPAddress addr, or
+            None
+        '''
+        for (version, prefixlen), table in self.tables.iteritems():
+            if version != addr.version:
+                continue
+            width = 32 if version == 4 else 128
+            value = addr.value >> (width - prefixlen) << (width - prefixlen)
+            unroutable = table.get(value, None)
+            if unroutable is not None and now < unroutable.expires:
+                self.hits += 1
+                return unroutable
+        return None
+
+    def add(self, network, now):
+        network = network.cidr
+        table = self.tables.setdefault((network.version, network.prefixlen),
+                                       {})
+        unroutable = table.get(network.value, None)
+        if unroutable is None or now >= unroutable.expires:
+            unroutable = Unroutable(network, now + self.timeout)
+            table[network.value] = unroutable
+        return unroutable
+
+    def cover(self, networks):
+        '''
+            routes to 'networks' appeared; forget the Unroutables
+            overlapping them and return those
+        '''
+        covered = []
+        for table in self.tables.itervalues():
+            for value, unroutable in table.items():
+                if any(n.version == unroutable.network.version and
+                       (n in unroutable.network or unroutable.network in n)
+                       for n in networks):
+                    del table[value]
+                    covered.append(unroutable)
+        if covered:
+            LOG.info('%s unroutable networks covered by new routes',
+                     len(covered))
+        return covered
+
+    def remove_switch(self, dpid):
+        for table in self.tables.itervalues():
+            for unroutable in table.itervalues():
+                unroutable.dpids.discard(dpid)
+
+    def expire(self, now):
+        for key, table in self.tables.items():
+            for value in [v for v, u in table.iteritems()
+                          if now >= u.expires]:
+                del table[value]
+            if not table:
+                del self.tables[key]
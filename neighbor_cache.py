@@ -0,0 +1,105 @@
+import collections
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Neighbor(object):
+    def __init__(self, mac, dpid, port_no, now, expires):
+        self.mac = mac              # netaddr.EUI
+        self.dpid = dpid            # where the host is
+        self.port_no = port_no
+        self.seen = now
+        self.expires = expires
+        self.used = None            # time of the last lookup
+        self.refreshed = None       # time a refresh was requested
+
+    def moved(self, other):
+        return (self.mac, self.dpid, self.port_no) != \
+            (other.mac, other.dpid, other.port_no)
+
+
+class NeighborCache(object):
+    '''
+        the location of the hosts of all the switches, i.e. MAC address,
+        switch and port by netaddr.IPAddress, learned from ARP, ND and IP
+        packets; an entry lives for 'ttl' after the host was last seen,
+        and at most 'size' of them are kept, the least recently used are
+        evicted first
+    '''
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        # entries[ip] = Neighbor, the least recently used first
+        self.entries = collections.OrderedDict()
+        self.evicted = 0
+        self.expired = 0
+        self.refreshes = 0
+
+    def lookup(self, ip, now):
+        '''
+            return the Neighbor of ip, or None if it's unknown or expired
+        '''
+        neighbor = self.entries.get(ip, None)
+        if neighbor is None or now >= neighbor.expires:
+            # an expired one is left to expire, which invalidates it
+            return None
+        del self.entries[ip]
+        self.entries[ip] = neighbor
+        neighbor.used = now
+        return neighbor
+
+    def learn(self, ip, mac, dpid, port_no, now):
+        '''
+            remember or confirm where ip is; return the Neighbor it
+            replaces if that one is still in use and the host has
+            another MAC address or location, i.e. entries to it are stale
+        '''
+        old = self.entries.pop(ip, None)
+        neighbor = Neighbor(mac, dpid, port_no, now, now + self.ttl)
+        if old is not None:
+            neighbor.used = old.used
+        self.entries[ip] = neighbor
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+        if old is not None and now < old.expires and old.moved(neighbor):
+            return old
+        return None
+
+    def to_refresh(self, now, before, retry):
+        '''
+            return [(ip, Neighbor)] of the entries looked up since they
+            were last seen and expiring within 'before'; each one is
+            returned again after 'retry' if it isn't confirmed
+        '''
+        refresh = []
+        for ip, neighbor in self.entries.iteritems():
+            if neighbor.used is None or neighbor.used < neighbor.seen:
+                continue
+            if now >= neighbor.expires or \
+                    neighbor.expires - now > before:
+                continue
+            if neighbor.refreshed is not None and \
+                    now - neighbor.refreshed < retry:
+                continue
+            neighbor.refreshed = now
+            refresh.append((ip, neighbor))
+        self.refreshes += len(refresh)
+        return refresh
+
+    def expire(self, now):
+        '''
+            forget the expired entries and return [(ip, Neighbor)] of them
+        '''
+        expired = [(ip, n) for ip, n in self.entries.iteritems()
+                   if now >= n.expires]
+        for ip, neighbor in expired:
+            del self.entries[ip]
+        self.expired += len(expired)
+        return expired
+
+    def remove_switch(self, dpid):
+        for ip in [ip for ip, n in self.entries.iteritems()
+                   if n.dpid == dpid]:
+            del self.entries[ip]
@@ -0,0 +1,195 @@
+import struct
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# addresses are packed strings: 6 bytes MAC, 4 bytes IPv4, 16 bytes IPv6
+ETHERNET = struct.Struct('!6s6sH')
+ARP = struct.Struct('!HHBBH6s4s6s4s')
+IPV4 = struct.Struct('!BBHHHBBH4s4s')
+IPV6 = struct.Struct('!IHBB16s16s')
+ICMP = struct.Struct('!BBH')
+ND = struct.Struct('!BBHI16sBB6s')     # NS or NA with a link-layer option
+WORDS16 = struct.Struct('!8H')
+
+ETH_TYPE_ARP = 0x0806
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_IPV6 = 0x86dd
+MIN_FRAME = 60          # Ryu pads the ethernet payload to 46 bytes
+BROADCAST = '\xff' * 6
+ND_NEIGHBOR_SOLICIT = 135
+ND_NEIGHBOR_ADVERT = 136
+ND_OPTION_SLA = 1
+ND_OPTION_TLA = 2
+ND_LEN = 32             # ICMPv6 payload of NS and NA
+IPPROTO_ICMPV6 = 58
+ICMP_ECHO_REQUEST = 8
+ICMPV6_ECHO_REQUEST = 128
+
+
+def ones_sum(data, initial=0):
+    # one's complement sum of the 16 bit words, not folded
+    if len(data) % 2:
+        data = data + '\0'
+    return sum(struct.unpack('!%dH' % (len(data) / 2), data), initial)
+
+
+def fold(s):
+    while s >> 16:
+        s = (s & 0xffff) + (s >> 16)
+    return s
+
+
+def checksum(s):
+    return ~fold(s) & 0xffff
+
+
+def adjust(csum, old, new):
+    '''
+        the checksum once the word 'old' is replaced by 'new', RFC 1624
+    '''
+    return ~fold((~csum & 0xffff) + (~old & 0xffff) + new) & 0xffff
+
+
+def solicited_node(packed):
+    '''
+        (MAC, IPv6) multicast addresses of the solicited-node group of an
+        IPv6 address, 33:33:ff:XX:XX:XX and ff02::1:ffXX:XXXX where XX
+        are the last 24 bits of the address; RFC 2464, RFC 4291
+    '''
+    return '\x33\x33\xff' + packed[13:], \
+        '\xff\x02' + '\0' * 9 + '\x01\xff' + packed[13:]
+
+
+def arp_reply(src_mac, src_ip, dst_mac, dst_ip):
+    buf = bytearray(MIN_FRAME)
+    ETHERNET.pack_into(buf, 0, dst_mac, src_mac, ETH_TYPE_ARP)
+    ARP.pack_into(buf, ETHERNET.size, 1, ETH_TYPE_IP, 6, 4, 2,
+                  src_mac, src_ip, dst_mac, dst_ip)
+    return str(buf)
+
+
+def neighbor_advert(src_mac, dst_mac, target, dst_ip, res):
+    '''
+        NA of target, whose MAC address is src_mac; res is the R, S, O
+        flags as in Ryu's nd_neighbor
+    '''
+    buf = bytearray(ETHERNET.size + IPV6.size + ND_LEN)
+    ETHERNET.pack_into(buf, 0, dst_mac, src_mac, ETH_TYPE_IPV6)
+    IPV6.pack_into(buf, ETHERNET.size, 6 << 28, ND_LEN, IPPROTO_ICMPV6, 255,
+                   target, dst_ip)
+    offset = ETHERNET.size + IPV6.size
+    ND.pack_into(buf, offset, ND_NEIGHBOR_ADVERT, 0, 0, res << 29, target,
+                 ND_OPTION_TLA, 1, src_mac)
+    s = ones_sum(target + dst_ip, ND_LEN + IPPROTO_ICMPV6)
+    struct.pack_into('!H', buf, offset + 2,
+                     checksum(ones_sum(str(buf[offset:]), s)))
+    return str(buf)
+
+
+def echo_reply(data, src_mac):
+    '''
+        the reply to the ICMP or ICMPv6 echo request in the frame 'data',
+        sent with src_mac; the payload is copied, and the checksum of the
+        request adjusted to the new type; None if it's not a request.
+        A request cut by the switch (miss_send_len) is answered with what
+        was sent in, and the checksum calculated again
+    '''
+    _, mac_src, eth_type = ETHERNET.unpack_from(data, 0)
+    offset = ETHERNET.size
+    if eth_type == ETH_TYPE_IP:
+        ver_ihl, _, total_len = struct.unpack_from('!BBH', data, offset)
+        ip_src, ip_dst = struct.unpack_from('!4s4s', data, offset + 12)
+        icmp_offset = offset + (ver_ihl & 0xf) * 4
+        end = offset + total_len
+        request, reply = ICMP_ECHO_REQUEST, 0
+    elif eth_type == ETH_TYPE_IPV6:
+        payload_len, = struct.unpack_from('!H', data, offset + 4)
+        ip_src, ip_dst = struct.unpack_from('!16s16s', data, offset + 8)
+        icmp_offset = offset + IPV6.size
+        end = icmp_offset + payload_len
+        request, reply = ICMPV6_ECHO_REQUEST, ICMPV6_ECHO_REQUEST + 1
+    else:
+        return None
+    type_, code, csum = ICMP.unpack_from(data, icmp_offset)
+    if type_ != request:
+        return None
+    truncated = end > len(data)
+    end = min(end, len(data))
+    icmp_len = end - icmp_offset
+
+    if eth_type == ETH_TYPE_IP:
+        buf = bytearray(max(MIN_FRAME, offset + IPV4.size + icmp_len))
+        IPV4.pack_into(buf, offset, 0x45, 0, IPV4.size + icmp_len, 0, 0,
+                       64, 1, 0, ip_dst, ip_src)
+        struct.pack_into('!H', buf, offset + 10, checksum(
+            ones_sum(str(buf[offset:offset + IPV4.size]))))
+        start = offset + IPV4.size
+    else:
+        buf = bytearray(max(MIN_FRAME, icmp_offset + icmp_len))
+        # the pseudo header sums the same with the addresses swapped
+        IPV6.pack_into(buf, offset, 6 << 28, icmp_len, IPPROTO_ICMPV6, 64,
+                       ip_dst, ip_src)
+        start = icmp_offset
+    ETHERNET.pack_into(buf, 0, mac_src, src_mac, eth_type)
+    buf[start:start + icmp_len] = data[icmp_offset:end]
+    if not truncated:
+        ICMP.pack_into(buf, start, reply, code,
+                       adjust(csum, request << 8 | code, reply << 8 | code))
+        return str(buf)
+    ICMP.pack_into(buf, start, reply, code, 0)
+    s = 0
+    if eth_type == ETH_TYPE_IPV6:
+        s = ones_sum(ip_src + ip_dst, icmp_len + IPPROTO_ICMPV6)
+    struct.pack_into('!H', buf, start + 2, checksum(
+        ones_sum(str(buf[start:start + icmp_len]), s)))
+    return str(buf)
+
+
+class PortTemplates(object):
+    '''
+        ARP requests and NS sent from a gateway port, encoded once; only
+        the target address and the checksum are filled in each time
+    '''
+    def __init__(self, hw_addr, gateway):
+        self.hw_addr = hw_addr      # packed MAC of the port
+        self.gateway = gateway      # the Gateway they are built for
+
+        self.arp_request = bytearray(MIN_FRAME)
+        ETHERNET.pack_into(self.arp_request, 0, BROADCAST, hw_addr,
+                           ETH_TYPE_ARP)
+        ARP.pack_into(self.arp_request, ETHERNET.size, 1, ETH_TYPE_IP, 6, 4,
+                      1, hw_addr, gateway.gw_ip.packed, '\0' * 6, '\0' * 4)
+
+        src = gateway.gw_ipv6.packed
+        self.ns = bytearray(ETHERNET.size + IPV6.size + ND_LEN)
+        ETHERNET.pack_into(self.ns, 0, '\0' * 6, hw_addr, ETH_TYPE_IPV6)
+        IPV6.pack_into(self.ns, ETHERNET.size, 6 << 28, ND_LEN,
+                       IPPROTO_ICMPV6, 255, src, '\0' * 16)
+        self.nd_offset = ETHERNET.size + IPV6.size
+        ND.pack_into(self.ns, self.nd_offset, ND_NEIGHBOR_SOLICIT, 0, 0, 0,
+                     '\0' * 16, ND_OPTION_SLA, 1, hw_addr)
+        # of the pseudo header and the fixed fields, target and
+        # destination are added to it
+        self.ns_sum = ones_sum(src + str(self.ns[self.nd_offset:]),
+                               ND_LEN + IPPROTO_ICMPV6)
+
+    def arp(self, dst_ip):
+        '''
+            ARP request of the packed IPv4 address dst_ip
+        '''
+        self.arp_request[38:42] = dst_ip
+        return str(self.arp_request)
+
+    def neighbor_solicit(self, target):
+        '''
+            NS of the packed IPv6 address target
+        '''
+        mac, ip = solicited_node(target)
+        ns = self.ns
+        ns[0:6] = mac
+        ns[38:54] = ip
+        ns[self.nd_offset + 8:self.nd_offset + 24] = target
+        s = self.ns_sum + sum(WORDS16.unpack(ip)) + sum(WORDS16.unpack(target))
+        struct.pack_into('!H', ns, self.nd_offset + 2, checksum(s))
+        return str(ns)
@@ -0,0 +1,114 @@
+import collections
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Pending(object):
+    '''
+        what is kept of a packet in waiting for the MAC address of its
+        next hop: the buffer_id if the switch buffered it, else the data
+    '''
+    def __init__(self, msg, no_buffer, now):
+        self.datapath = msg.datapath
+        self.buffer_id = msg.buffer_id
+        self.in_port = msg.in_port
+        self.data = msg.data if msg.buffer_id == no_buffer else None
+        self.queued = now
+        self.done = False       # released or dropped
+
+
+class Resolution(object):
+    def __init__(self, outport_no, now):
+        self.outport_no = outport_no
+        self.started = now
+        self.requested = None   # time the last ARP request or NS was sent
+        self.packets = collections.deque()
+
+
+class PendingQueue(object):
+    '''
+        packet ins waiting for the MAC address of their next hop, keyed
+        by (dpid, next hop ip); at most 'per_destination' of them for a
+        next hop and 'total' overall, the oldest are dropped first; the
+        packets of a next hop not resolved in 'timeout' are dropped
+    '''
+    def __init__(self, per_destination, total, timeout, retry):
+        self.per_destination = per_destination
+        self.total = total
+        self.timeout = timeout
+        self.retry = retry      # ARP requests or NS are not sent sooner
+        self.resolutions = {}   # resolutions[(dpid, ip)] = Resolution
+        self.order = collections.deque()    # (key, Pending), oldest first
+        self.count = 0
+        self.dropped = 0
+        self.suppressed = 0     # ARP requests and NS not sent
+
+    def add(self, dpid, ip, outport_no, msg, no_buffer, now):
+        '''
+            queue the packet in; return (True if the address is to be
+            requested, [Pending] dropped to make room)
+        '''
+        key = dpid, ip
+        resolution = self.resolutions.get(key, None)
+        if resolution is None:
+            resolution = Resolution(outport_no, now)
+            self.resolutions[key] = resolution
+        pending = Pending(msg, no_buffer, now)
+        resolution.packets.append(pending)
+        self.order.append((key, pending))
+        self.count += 1
+
+        dropped = []
+        if len(resolution.packets) > self.per_destination:
+            dropped.append(self._remove(resolution.packets.popleft()))
+        while self.count > self.total:
+            key, oldest = self.order.popleft()
+            if not oldest.done:
+                self.resolutions[key].packets.remove(oldest)
+                dropped.append(self._remove(oldest))
+        self.dropped += len(dropped)
+
+        if resolution.requested is not None and \
+                now - resolution.requested < self.retry:
+            self.suppressed += 1
+            return False, dropped
+        resolution.requested = now
+        return True, dropped
+
+    def _remove(self, pending):
+        pending.done = True
+        self.count -= 1
+        return pending
+
+    def resolved(self, dpid, ip):
+        '''
+            the MAC address of ip is known, return its Resolution with
+            the packets to release, or None if none are waiting
+        '''
+        resolution = self.resolutions.pop((dpid, ip), None)
+        if resolution is None:
+            return None
+        for pending in resolution.packets:
+            self._remove(pending)
+        return resolution
+
+    def expire(self, now):
+        '''
+            forget the next hops not resolved in time; return [Pending]
+            of them to drop
+        '''
+        dropped = []
+        for key in [k for k, r in self.resolutions.iteritems()
+                    if now - r.started >= self.timeout]:
+            for pending in self.resolutions.pop(key).packets:
+                dropped.append(self._remove(pending))
+        self.dropped += len(dropped)
+        while self.order and self.order[0][1].done:
+            self.order.popleft()
+        return dropped
+
+    def remove_switch(self, dpid):
+        for key in [k for k in self.resolutions if k[0] == dpid]:
+            for pending in self.resolutions.pop(key).packets:
+                self._remove(pending)
@@ -0,0 +1,101 @@
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# bits of ofp_phy_port.curr in OpenFlow 1.0 -> bits per second
+SPEEDS = (
+    (1 << 6, 10e9),     # OFPPF_10GB_FD
+    (1 << 5, 1e9),      # OFPPF_1GB_FD
+    (1 << 4, 1e9),      # OFPPF_1GB_HD
+    (1 << 3, 100e6),    # OFPPF_100MB_FD
+    (1 << 2, 100e6),    # OFPPF_100MB_HD
+    (1 << 1, 10e6),     # OFPPF_10MB_FD
+    (1 << 0, 10e6),     # OFPPF_10MB_HD
+)
+
+
+def port_speed(curr):
+    '''
+        the fastest speed advertised in 'curr', None if there is none
+    '''
+    for bit, speed in SPEEDS:
+        if curr & bit:
+            return speed
+    return None
+
+
+class PortLoad(object):
+    def __init__(self):
+        self.tx_bytes = None
+        self.timestamp = None
+        self.utilization = 0.0  # smoothed, 1.0 means full speed
+        self.level = 0          # index of the highest threshold crossed
+
+
+class PortStats(object):
+    '''
+        turns polled port counters into link costs; the utilization is
+        smoothed by EWMA, then mapped to a level by thresholds with
+        hysteresis, and only a change of level changes the link cost, so
+        route changes are bounded
+    '''
+    EWMA_WEIGHT = 0.3           # weight of the newest sample
+    THRESHOLDS = (0.5, 0.7, 0.9)
+    HYSTERESIS = 0.1            # go down a level this much below threshold
+    LEVEL_COST = 1              # extra cost per level, times the base cost
+
+    def __init__(self):
+        self.loads = {}         # loads[(dpid, port_no)] = PortLoad
+
+    def update(self, dpid, port_no, tx_bytes, timestamp, speed):
+        '''
+            feed the tx byte counter of a port read at 'timestamp';
+            return True if the level of the port changed
+        '''
+        try:
+            load = self.loads[dpid, port_no]
+        except KeyError:
+            load = PortLoad()
+            self.loads[dpid, port_no] = load
+
+        last_bytes, last_timestamp = load.tx_bytes, load.timestamp
+        load.tx_bytes, load.timestamp = tx_bytes, timestamp
+        if last_bytes is None or tx_bytes < last_bytes or \
+                timestamp <= last_timestamp:
+            # first sample, or the counter was reset
+            return False
+
+        sample = (tx_bytes - last_bytes) * 8 / \
+                 ((timestamp - last_timestamp) * speed)
+        load.utilization += PortStats.EWMA_WEIGHT * \
+                            (sample - load.utilization)
+
+        level = load.level
+        while level < len(PortStats.THRESHOLDS) and \
+                load.utilization > PortStats.THRESHOLDS[level]:
+            level += 1
+        while level > 0 and load.utilization < \
+                PortStats.THRESHOLDS[level - 1] - PortStats.HYSTERESIS:
+            level -= 1
+        if level == load.level:
+            return False
+        LOG.info('Port %s of %s utilization %.2f, level %s -> %s',
+                 port_no, dpid, load.utilization, load.level, level)
+        load.level = level
+        return True
+
+    def utilization(self, dpid, port_no):
+        load = self.loads.get((dpid, port_no), None)
+        if load is None:
+            return 0.0
+        return load.utilization
+
+    def cost(self, dpid, port_no, base_cost):
+        load = self.loads.get((dpid, port_no), None)
+        if load is None:
+            return base_cost
+        return base_cost * (1 + PortStats.LEVEL_COST * load.level)
+
+    def remove_switch(self, dpid):
+        for key in [k for k in self.loads if k[0] == dpid]:
+            del self.loads[key]
@@ -1,10 +1,10 @@
 import time
-import os
+import functools
+import random
 import logging
-from eventlet import patcher
-from eventlet import greenio
-native_threading = patcher.original("threading")
-native_queue = patcher.original("Queue")
+from eventlet import hubs
+from eventlet import tpool
+from eventlet import queue as green_queue
 
 import struct
 import netaddr
@@ -17,16 +17,31 @@ from ryu.controller import ofp_event
 from ryu import topology
 from ryu.ofproto import ofproto_v1_0, nx_match
 from ryu.ofproto import ether, inet
-from ryu.lib.packet import (packet, ethernet, arp, icmp, icmpv6, ipv4, ipv6)
-from ryu.lib import mac
+from ryu.lib.packet import (packet, arp, icmp, icmpv6, ipv4, ipv6)
 import ryu.utils
 
 from switch import Port, Switch
+from graph import Graph
 import util
 import algorithm
 import dest_event
 import BGP4
 import tap
+import port_stats
+import egress
+import frr
+import flow_cookie
+import flow_table
+import flow_setup
+import flow_scheduler
+import negative_cache
+import admission
+import headers
+import switch_index
+import neighbor_cache
+import pending_queue
+import packet_templates
+import flow_templates
 
 
 
@@ -37,16 +52,145 @@ LOG = logging.getLogger(__name__)
 class Routing(app_manager.RyuApp):
     ARP_TIMEOUT = 600    # in seconds
 
+    # where the hosts are, learned from the packet ins of all switches;
+    # the least recently used are evicted beyond NEIGHBOR_CACHE_SIZE; the
+    # ones looked up since last seen are requested again
+    # NEIGHBOR_REFRESH_BEFORE their expiry, so flows to them don't wait
+    # for a new one; the entries towards an expired one are deleted
+    NEIGHBOR_CACHE_SIZE = 10000
+    NEIGHBOR_REFRESH_INTERVAL = 5   # in seconds
+    NEIGHBOR_REFRESH_BEFORE = 30    # in seconds
+    # answer ARP requests and NS for known hosts in their place
+    PROXY_ARP = True
+
+    # packet ins waiting for the MAC address of their next hop, the
+    # oldest are dropped beyond the limits; an ARP request or NS is sent
+    # at most once per RESOLVE_RETRY for a next hop, and its packets are
+    # dropped if it's not resolved in RESOLVE_TIMEOUT
+    PENDING_PER_DESTINATION = 16
+    PENDING_TOTAL = 4096
+    RESOLVE_RETRY = 1       # in seconds
+    RESOLVE_TIMEOUT = 3     # in seconds
+
     FLOW_IDLE_TIMEOUT = 60
     FLOW_HARD_TIMEOUT = 600
+    # flow mods towards a destination are encoded once per switch, port
+    # and address family, and patched for each destination
+    FLOW_MOD_TEMPLATES = True
+
+    # spread flows over equal cost paths, flow entries of switches where
+    # the paths diverge match the 5-tuple with a higher priority
+    ECMP = True
+    ECMP_FLOW_PRIORITY = ofproto_v1_0.OFP_DEFAULT_PRIORITY + 1
+
+    # calculate routes of all switch pairs in background after topology
+    # changes, needs numpy
+    PRECOMPUTE_ROUTES = True
+    PRECOMPUTE_INTERVAL = 1     # in seconds
+
+    # poll port statistics of every switch once in the interval, to make
+    # link costs follow utilization
+    PORT_STATS_INTERVAL = 10    # in seconds
+
+    # find loop-free alternates of flow entries again once the topology
+    # changed, they are used to move flow entries off failed links
+    BACKUP_REFRESH_INTERVAL = 1 # in seconds
+
+    # flow entries of changed routes are deleted by cookie once in the
+    # interval, fast reroute carries the traffic meanwhile
+    FLOW_INVALIDATE_INTERVAL = 1    # in seconds
+
+    # log the flow table occupancy of every switch once in the interval
+    FLOW_TABLE_REPORT_INTERVAL = 60 # in seconds
+
+    # packet ins to a destination whose flow setup from the same switch
+    # is running or just done follow that setup instead of a new one
+    COALESCE_SETUPS = True
+
+    # send the ingress entry and the packet of a flow setup after barrier
+    # replies from the other switches on the path, so packets don't
+    # overtake the flow entries
+    BARRIER_SETUP = True
+
+    # deploy the way back to the source host along with a flow setup, so
+    # the replies aren't sent to the controller again
+    BIDIRECTIONAL_SETUP = True
+
+    # flow mods to a switch are rate limited, packet outs go first and
+    # flow setups before bulk reprogramming
+    FLOW_MOD_RATE = 500         # per second and switch
+    FLOW_MOD_BURST = 100
+    FLOW_MOD_TICK = 0.01        # in seconds, to send the queued ones
+
+    # destinations without a route are remembered for the timeout, with
+    # drop entries on the ingress switches if DROP_FLOWS, as networks
+    # not shorter than the prefix lengths
+    NEGATIVE_CACHE_TIMEOUT = 10 # in seconds
+    DROP_FLOWS = True
+    DROP_FLOW_PRIORITY = 1
+    UNROUTABLE_PREFIX_LEN = {4: 16, 6: 48}
+
+    # packet ins beyond the (rate per second, burst) of their level are
+    # shed, but one in PACKET_IN_SAMPLE; with SUPPRESS_PUNTS, sources
+    # and ports beyond their limits get entries dropping their packets
+    # which match no other entry, for PUNT_SUPPRESS_TIMEOUT
+    PACKET_IN_LIMITS = {
+        admission.DATAPATH: (2000, 400),
+        admission.PORT: (500, 100),
+        admission.MAC: (200, 50),
+        admission.IP: (200, 50),
+    }
+    PACKET_IN_SAMPLE = 100
+    SUPPRESS_PUNTS = True
+    PUNT_SUPPRESS_TIMEOUT = 5   # in seconds
+    PUNT_SUPPRESS_PRIORITY = 0  # below any other entry
+    # BGP from port 179, ARP and ND are sent to the controller by entries
+    # above the suppressing ones and the drops of unroutable networks, so
+    # a flood through a port doesn't cut the neighbor routers off
+    CONTROL_PUNT_PRIORITY = 2
+    ADMISSION_EXPIRE_INTERVAL = 1   # in seconds
+
+    # admitted packet ins are handled in batches of up to BATCH_SIZE,
+    # gathered for at most BATCH_TIME; the batch is grouped by ingress
+    # switch and destination, destinations are looked up once per batch
+    # and network, routes once per batch
+    BATCH_PACKET_INS = True
+    BATCH_SIZE = 64
+    BATCH_TIME = 0.001          # in seconds
+
+    # frames from the kernel read from the tap device per wakeup, before
+    # the other green threads get a turn
+    TAP_READ_LIMIT = 64
 
     def __init__(self, *args, **kwargs):
         super(Routing, self).__init__(*args, **kwargs)
 
+        # flow entries installed to the switches, to suppress flow mods
+        # which change nothing
+        self.flow_tables = flow_table.ShadowTables()
+        hub.spawn(self._report_flow_tables)
+
+        self.setups = flow_setup.PendingSetups()
+        hub.spawn(self._expire_setups)
+
+        # all the messages changing switches go through it
+        self.scheduler = flow_scheduler.Scheduler(Routing.FLOW_MOD_RATE,
+                                                  Routing.FLOW_MOD_BURST)
+        hub.spawn(self._flush_messages)
+
         self.dpid_to_switch = {}    # dpid_to_switch[dpid] = Switch
                                     # maintains all the switches
-
-        self.routing_algo = algorithm.Dijkstra(self.dpid_to_switch)
+        self.graph = Graph()        # links of dpid_to_switch, for routing
+        self.switches = switch_index.SwitchIndex()  # by names and gateways
+        self.flow_mods = flow_templates.FlowModTemplates()
+
+        if Routing.PRECOMPUTE_ROUTES and algorithm.numpy is not None:
+            self.routing_algo = algorithm.AllPairs(self.dpid_to_switch,
+                                                   self.graph)
+            hub.spawn(self._precompute_routes)
+        else:
+            self.routing_algo = algorithm.IncrementalSPF(self.dpid_to_switch,
+                                                         self.graph)
 
         if tap.device is None:
             tap.device = tap.TapDevice()
@@ -66,6 +210,39 @@ class Routing(app_manager.RyuApp):
             except:
                 LOG.error('File %s parse error', util.bgper_config)
 
+        self.port_stats = port_stats.PortStats()
+        self.egress = egress.EgressSelector()
+        hub.spawn(self._poll_port_stats)
+
+        # backup next hops of deployed flow entries
+        self.frr = frr.FastReroute(self.routing_algo,
+                                   Routing.FLOW_HARD_TIMEOUT)
+        hub.spawn(self._refresh_backups)
+
+        self.unroutable = negative_cache.NegativeCache(
+            Routing.NEGATIVE_CACHE_TIMEOUT)
+
+        self.admission = admission.Admission(Routing.PACKET_IN_LIMITS,
+                                             Routing.PACKET_IN_SAMPLE)
+        hub.spawn(self._expire_admission)
+
+        self.neighbors = neighbor_cache.NeighborCache(
+            Routing.ARP_TIMEOUT, Routing.NEIGHBOR_CACHE_SIZE)
+        hub.spawn(self._refresh_neighbors)
+        self.pending = pending_queue.PendingQueue(
+            Routing.PENDING_PER_DESTINATION, Routing.PENDING_TOTAL,
+            Routing.RESOLVE_TIMEOUT, Routing.RESOLVE_RETRY)
+        hub.spawn(self._expire_pending)
+
+        self.packet_ins = green_queue.LightQueue()
+        self._batch = None          # lookups of the batch being handled
+        if Routing.BATCH_PACKET_INS:
+            hub.spawn(self._handle_batches)
+
+        self.cookies = flow_cookie.Cookies()
+        self.flow_deletes = set()   # (dpid, cookie, mask) to send
+        hub.spawn(self._invalidate_flows)
+
         #hub.spawn(self._test)
         self._init_events()
 
@@ -84,33 +261,231 @@ class Routing(app_manager.RyuApp):
                           port, port.peer_switch_dpid)
         LOG.debug('-------------------')
 
-    def _init_pipe(self):
+    def _precompute_routes(self):
+        """
+        Recalculate the route table when the topology has changed. The
+        calculation runs in a native thread, so packet-ins are still
+        handled meanwhile.
+        """
+        while True:
+            hub.sleep(Routing.PRECOMPUTE_INTERVAL)
+            if not self.routing_algo.table_outdated():
+                continue
+            snapshot = self.routing_algo.snapshot()
+            table = tpool.execute(algorithm.AllPairs.compute, snapshot)
+            self.routing_algo.install(table)
+
+    def _refresh_backups(self):
         """
-        The pipe is for synchronization, the queue is used for store
-        the packets
+        Keep the backup next hops of flow entries up to date, so that no
+        route has to be calculated when a link fails.
         """
-        self._event_queue = native_queue.Queue()
-        r_pipe, w_pipe = os.pipe()
-        self._event_notify_send = greenio.GreenPipe(w_pipe, 'wb', 0)
-        self._event_notify_recv = greenio.GreenPipe(r_pipe, 'rb', 0)
+        while True:
+            hub.sleep(Routing.BACKUP_REFRESH_INTERVAL)
+            self.frr.expire(time.time())
+            if isinstance(self.routing_algo, algorithm.AllPairs) and \
+                    self.routing_algo.table_outdated():
+                # distances are cheap once the table is there
+                continue
+            self.frr.refresh()
+
+    def _invalidate_flows(self):
+        """
+        Send the cookie masked deletes of invalidated routes and exits.
+        Cookies of the routes are changed at once, so entries deployed
+        meanwhile are not deleted.
+        """
+        while True:
+            hub.sleep(Routing.FLOW_INVALIDATE_INTERVAL)
+            if not self.flow_deletes:
+                continue
+            deletes, self.flow_deletes = self.flow_deletes, set()
+            self._delete_flows(deletes)
+
+    def _delete_flows(self, deletes):
+        now = time.time()
+        for dpid, cookie, mask in deletes:
+            try:
+                dp = self.dpid_to_switch[dpid].dp
+            except KeyError:
+                continue
+            mod = flow_templates.cookie_delete(dp, cookie, mask)
+            self.scheduler.send(dp, mod, flow_scheduler.BULK, now)
+        self.frr.remove_cookies(deletes)
+        self.flow_tables.remove_cookies(deletes)
+        LOG.info('%s cookie masked deletes sent', len(deletes))
+
+    def _report_flow_tables(self):
+        while True:
+            hub.sleep(Routing.FLOW_TABLE_REPORT_INTERVAL)
+            self.flow_tables.expire(time.time())
+            self.unroutable.expire(time.time())
+            for dpid, count in sorted(
+                    self.flow_tables.occupancy().iteritems()):
+                LOG.info('Flow table of %s: %s entries', dpid, count)
+            LOG.info('%s flow mods suppressed', self.flow_tables.suppressed)
+            LOG.info('%s packets to unroutable destinations dropped without '
+                     'lookup', self.unroutable.hits)
+            LOG.info('Neighbors: %s known, %s expired, %s evicted, %s '
+                     'refreshes requested', len(self.neighbors.entries),
+                     self.neighbors.expired, self.neighbors.evicted,
+                     self.neighbors.refreshes)
+            LOG.info('Packet ins waiting for MAC addresses: %s, %s dropped; '
+                     '%s ARP requests and NS suppressed', self.pending.count,
+                     self.pending.dropped, self.pending.suppressed)
+            LOG.info('Packet ins: %s admitted, %s of them sampled over the '
+                     'limits; shed by %s', self.admission.admitted,
+                     self.admission.sampled,
+                     ', '.join('%s %s' % (self.admission.shed[level], level)
+                               for level in admission.LEVELS))
+            scheduler = self.scheduler
+            for dpid, depth in sorted(scheduler.depths().iteritems()):
+                LOG.info('Messages queued to %s: %s', dpid,
+                         ', '.join('%s %s' % (n, name) for n, name in
+                                   zip(depth, flow_scheduler.CLASS_NAMES)))
+            LOG.info('Messages sent: %s; %s waited for the rate limit, '
+                     '%s superseded, at most %s queued to a switch',
+                     ', '.join('%s %s' % (n, name) for n, name in
+                               zip(scheduler.sent,
+                                   flow_scheduler.CLASS_NAMES)),
+                     scheduler.delayed, scheduler.coalesced,
+                     scheduler.max_depth)
+
+    def _expire_admission(self):
+        while True:
+            hub.sleep(Routing.ADMISSION_EXPIRE_INTERVAL)
+            self.admission.expire(time.time())
 
-    def _init_events(self):
+    def _refresh_neighbors(self):
+        """
+        Request the MAC addresses in use again before they expire, and
+        delete the entries towards the expired ones.
+        """
+        while True:
+            hub.sleep(Routing.NEIGHBOR_REFRESH_INTERVAL)
+            now = time.time()
+            for ip, neighbor in self.neighbors.to_refresh(
+                    now, Routing.NEIGHBOR_REFRESH_BEFORE,
+                    Routing.NEIGHBOR_REFRESH_INTERVAL):
+                switch = self.dpid_to_switch.get(neighbor.dpid, None)
+                if switch is not None and neighbor.port_no in switch.ports:
+                    self._resolve(switch.dp, neighbor.port_no, ip)
+            for ip, neighbor in self.neighbors.expire(now):
+                LOG.debug('Neighbor %s of %s expired', ip, neighbor.dpid)
+                self._delete_last_hops(neighbor.dpid, ip)
+
+    def _expire_pending(self):
+        while True:
+            hub.sleep(Routing.RESOLVE_RETRY)
+            for pending in self.pending.expire(time.time()):
+                self.drop_pkt(pending)
+
+    def _delete_last_hops(self, dpid, ip):
         """
-        Init the event subsystem. Codes learned from OpenStack
-        nova/virt/libvirt/driver.py
-        since we meet the same problem that an eventlet green thread
-        must cooperate with a native C-based library.
+        Delete the entries of the switch towards the host ip, whose MAC
+        address is no longer known.
+        """
+        switch = self.dpid_to_switch.get(dpid, None)
+        if switch is None:
+            return
+        dp = switch.dp
+        mod = dp.ofproto_parser.NXTFlowMod(
+            datapath = dp, cookie = 0,
+            command = dp.ofproto.OFPFC_DELETE,
+            rule = self._network_rule(netaddr.IPNetwork(ip), ip.version))
+        # in the class of the flow mods towards ip, after the queued ones,
+        # so that a later one is not sent before the delete
+        self.scheduler.fence(
+            dpid, lambda key: key[0][:2] == (ip.version, ip.value))
+        self.scheduler.send(dp, mod, flow_scheduler.REACTIVE, time.time())
+        self.flow_tables.remove_destination(dpid, ip.version, ip.value)
+        self.setups.routes_changed()
+
+    def _flush_messages(self):
+        while True:
+            hub.sleep(Routing.FLOW_MOD_TICK)
+            self.scheduler.flush(time.time())
 
-        - Apache License v2.0?
-        - OK.
+    def _expire_setups(self):
+        while True:
+            hub.sleep(flow_setup.PendingSetups.TIMEOUT)
+            for setup, waiting in self.setups.expire(time.time()):
+                if setup.dp is not None:
+                    # entries were sent, but not all confirmed
+                    self._release(setup.dp, setup.release_actions(),
+                                  waiting)
+                else:
+                    for msg in waiting:
+                        self.drop_pkt(msg)
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def flow_removed_handler(self, event):
+        msg = event.msg
+        match = msg.match
+        if match.dl_type != ether.ETH_TYPE_IP:
+            # the match of NXM entries can't be told from OpenFlow 1.0
+            return
+        five_tuple = None
+        if msg.priority == Routing.ECMP_FLOW_PRIORITY:
+            five_tuple = (match.nw_src, match.nw_dst, match.nw_proto,
+                          match.tp_src, match.tp_dst)
+        self.flow_tables.removed(msg.datapath.id,
+                                 (4, match.nw_dst, five_tuple), msg.priority)
+
+    def _poll_port_stats(self):
+        """
+        Request statistics of all ports from every switch once per
+        interval. Requests are not waited for, and are spread randomly
+        over the interval so that replies don't arrive in a burst.
         """
-        self._init_pipe()
-        LOG.info('Starting native event thread')
-        event_thread = native_threading.Thread(target = self.read_from_tap)
-        event_thread.setDaemon(True)
-        event_thread.start()
-        LOG.info('Starting green dispatch thread')
-        dispatch_thread = hub.spawn(self.dispatch_thread)
+        while True:
+            switches = self.dpid_to_switch.values()
+            delays = sorted(random.uniform(0, Routing.PORT_STATS_INTERVAL)
+                            for s in switches)
+            elapsed = 0
+            for switch, delay in zip(switches, delays):
+                hub.sleep(delay - elapsed)
+                elapsed = delay
+                dp = switch.dp
+                if dp.id not in self.dpid_to_switch:
+                    continue
+                req = dp.ofproto_parser.OFPPortStatsRequest(
+                        dp, 0, ofproto_v1_0.OFPP_NONE)
+                self.scheduler.send(dp, req, flow_scheduler.BULK,
+                                    time.time(), limited = False)
+            hub.sleep(Routing.PORT_STATS_INTERVAL - elapsed)
+            self.egress.expire(time.time())
+
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def port_stats_reply_handler(self, event):
+        dpid = event.msg.datapath.id
+        switch = self.dpid_to_switch.get(dpid, None)
+        if switch is None:
+            return
+        now = time.time()
+        for stat in event.msg.body:
+            port = switch.ports.get(stat.port_no, None)
+            if port is None or port.speed is None:
+                continue
+            if not self.port_stats.update(dpid, stat.port_no, stat.tx_bytes,
+                                          now, port.speed):
+                continue
+            # the level of utilization changed
+            port.cost = self.port_stats.cost(dpid, stat.port_no,
+                                             port.base_cost)
+            self.graph.update_port(port)
+            if port.peer_switch_dpid is not None:
+                self._link_changed(dpid, port.peer_switch_dpid)
+
+    def _init_events(self):
+        """
+        Read the packets the kernel sends out of the tap device in a
+        green thread. The device is non-blocking, the thread waits on the
+        hub until it's readable and then takes every frame queued.
+        """
+        tap.device.set_nonblocking()
+        LOG.info('Starting green tap reader')
+        hub.spawn(self.read_from_tap)
 
     def find_switch_and_port_for_dispatch(self, data):
         """
@@ -148,56 +523,38 @@ class Routing(app_manager.RyuApp):
         dst_switch = self.name_to_switch(dst_switch)
         return dst_switch, dst_port
 
-    def dispatch_thread(self):
-
-        out_switch = None
-        out_port_no = None
-
-        while True:
-            # Wait to be notified that there're some events pending in queue
-            try:
-                _c = self._event_notify_recv.read(1)
-                assert _c
-            except ValueError:
-                return  # will be raised when pipe is closed
-
-            # try processing as many events as possible
-            while not self._event_queue.empty():
-                try:
-                    data = self._event_queue.get(block = False)
-                    LOG.debug('New packet in event_queue: %s',
-                              ryu.utils.hex_array(data))
-                    if out_switch is None or out_port_no is None:
-                        out_switch, out_port_no = \
-                            self.find_switch_and_port_for_dispatch(data)
-                        LOG.debug('out_switch %s, out_port %s for tunneled msg',
-                                  out_switch, out_port_no)
-                    if out_switch and out_port_no:
-                        actions = []
-                        actions.append(
-                                out_switch.dp.ofproto_parser.OFPActionOutput(
-                                                                out_port_no))
-                        out = out_switch.dp.ofproto_parser.OFPPacketOut(
-                                datapath = out_switch.dp,
-                                buffer_id = 0xffffffff,  # -1 in 32bit
-                                in_port = ofproto_v1_0.OFPP_NONE,
-                                actions = actions, data = data)
-                        out_switch.dp.send_msg(out)
-
-                except native_queue.Empty:
-                    pass
-
     def read_from_tap(self):
         """
-        Note that this method runs in a native thread
+        Send the frames from the kernel out of the port to the BGP peer.
+        At most TAP_READ_LIMIT of them are taken per wakeup.
         """
+        out_switch = None
+        out_port_no = None
+        fd = tap.device.fileno()
+
         while True:
-            data = tap.device.read()
-            self._event_queue.put(data)
-            # notify the green dispatch_thread
-            c = ' '.encode()
-            self._event_notify_send.write(c)
-            self._event_notify_send.flush()
+            hubs.trampoline(fd, read = True)
+            for data in tap.device.read_available(Routing.TAP_READ_LIMIT):
+                LOG.debug('New packet from tap: %s',
+                          ryu.utils.hex_array(data))
+                if out_switch is None or out_port_no is None:
+                    out_switch, out_port_no = \
+                        self.find_switch_and_port_for_dispatch(data)
+                    LOG.debug('out_switch %s, out_port %s for tunneled msg',
+                              out_switch, out_port_no)
+                if out_switch and out_port_no:
+                    actions = []
+                    actions.append(
+                            out_switch.dp.ofproto_parser.OFPActionOutput(
+                                                            out_port_no))
+                    out = out_switch.dp.ofproto_parser.OFPPacketOut(
+                            datapath = out_switch.dp,
+                            buffer_id = 0xffffffff,  # -1 in 32bit
+                            in_port = ofproto_v1_0.OFPP_NONE,
+                            actions = actions, data = data)
+                    self.scheduler.send(out_switch.dp, out,
+                                        flow_scheduler.PACKET_OUT,
+                                        time.time())
 
     def _pre_install_flow_entry(self, switch):
         # 'switch' is a Switch object
@@ -235,11 +592,46 @@ class Routing(app_manager.RyuApp):
                 out_port = ofproto_v1_0.OFPP_CONTROLLER,
                 rule = rule6, actions = actions)
 
-        switch.dp.send_msg(msg4)
-        switch.dp.send_msg(msg6)
+        now = time.time()
+        self.scheduler.send(switch.dp, msg4, flow_scheduler.BULK, now)
+        self.scheduler.send(switch.dp, msg6, flow_scheduler.BULK, now)
+
+        # the rest of BGP, ARP and ND would reach the controller by table
+        # miss, but not past the entries suppressing punts of a port
+        for rule in self._control_rules():
+            msg = switch.dp.ofproto_parser.NXTFlowMod(
+                    datapath = switch.dp, cookie = 0,
+                    command = switch.dp.ofproto.OFPFC_MODIFY,
+                    idle_timeout = 0, hard_timeout = 0,
+                    priority = Routing.CONTROL_PUNT_PRIORITY,
+                    out_port = ofproto_v1_0.OFPP_CONTROLLER,
+                    rule = rule, actions = actions)
+            self.scheduler.send(switch.dp, msg, flow_scheduler.BULK, now)
 
         LOG.debug('Pre-installed flow entry')
 
+    def _control_rules(self):
+        rules = []
+        for eth_type in (ether.ETH_TYPE_IP, ether.ETH_TYPE_IPV6):
+            rule = nx_match.ClsRule()
+            rule.set_dl_type(eth_type)
+            rule.set_nw_proto(inet.IPPROTO_TCP)
+            rule.set_tp_src(BGP4.BGP_TCP_PORT)
+            rules.append(rule)
+
+        rule = nx_match.ClsRule()
+        rule.set_dl_type(ether.ETH_TYPE_ARP)
+        rules.append(rule)
+
+        for icmp_type in (icmpv6.ND_NEIGHBOR_SOLICIT,
+                          icmpv6.ND_NEIGHBOR_ADVERT):
+            rule = nx_match.ClsRule()
+            rule.set_dl_type(ether.ETH_TYPE_IPV6)
+            rule.set_nw_proto(inet.IPPROTO_ICMPV6)
+            rule.set_icmpv6_type(icmp_type)
+            rules.append(rule)
+        return rules
+
     @set_ev_cls(topology.event.EventSwitchEnter)
     def switch_enter_handler(self, event):
         # very strangely, EventSwitchEnter happens after 
@@ -248,19 +640,37 @@ class Routing(app_manager.RyuApp):
         try:
             s = self.dpid_to_switch[dpid]
         except KeyError:
+            # a new switch has no links yet, so no route changes
             s = Switch(event.switch.dp)
             self.dpid_to_switch[dpid] = s
-            self.routing_algo.topology_last_update = time.time()
+            self.graph.add_switch(dpid)
 
+        self.switches.update_switch(s)
+        # entries installed before the switch connected are unknown
+        self.flow_tables.remove_switch(dpid)
         self._pre_install_flow_entry(s)
+        self._cover_unroutable(self._gateway_networks(s))
 
     @set_ev_cls(topology.event.EventSwitchLeave)
     def switch_leave_handler(self, event):
+        dpid = event.switch.dp.id
         try:
-            del self.dpid_to_switch[event.switch.dp.id]
-            self.routing_algo.topology_last_update = time.time()
+            del self.dpid_to_switch[dpid]
         except KeyError:
-            pass
+            return
+        self.graph.remove_switch(dpid)
+        self.switches.remove_switch(dpid)
+        self.port_stats.remove_switch(dpid)
+        self.frr.remove_switch(dpid)
+        self.cookies.remove_switch(dpid)
+        self.flow_tables.remove_switch(dpid)
+        self.scheduler.remove_switch(dpid)
+        self.unroutable.remove_switch(dpid)
+        self.neighbors.remove_switch(dpid)
+        self.flow_mods.remove_switch(dpid)
+        self.pending.remove_switch(dpid)
+        self.admission.remove_switch(dpid)
+        self._routes_changed(self.routing_algo.switch_removed(dpid))
 
     def _update_port_link(self, dpid, port):
         switch = self.dpid_to_switch[dpid]
@@ -270,18 +680,45 @@ class Routing(app_manager.RyuApp):
             p.peer_port_no = port.peer_port_no
         else:
             switch.ports[port.port_no] = port
+        self.graph.update_port(switch.ports[port.port_no])
 
         peer_switch = self.dpid_to_switch[port.peer_switch_dpid]
         switch.peer_to_local_port[peer_switch] = port.port_no
 
 
+    def _routes_changed(self, changed):
+        """
+            'changed' is a set of (src_dpid, dst_dpid) whose routes have
+            been changed by a topology event, or None if every route
+            could have been changed
+        """
+        self.frr.topology_changed()
+        self._forget_batch_lookups()
+        self.setups.routes_changed()
+        if changed is None:
+            LOG.debug('All routes changed')
+            self.flow_deletes.update(self.cookies.invalidate_all(
+                self.dpid_to_switch.keys()))
+        elif changed:
+            LOG.debug('Routes changed: %s', changed)
+            self.flow_deletes.update(self.cookies.invalidate_routes(changed))
+
+    def _link_changed(self, dpid1, dpid2):
+        # links between switches are bidirectional
+        changed_1 = self.routing_algo.link_changed(dpid1, dpid2)
+        changed_2 = self.routing_algo.link_changed(dpid2, dpid1)
+        if changed_1 is None or changed_2 is None:
+            self._routes_changed(None)
+        else:
+            self._routes_changed(changed_1 | changed_2)
+
     @set_ev_cls(topology.event.EventLinkAdd)
     def link_add_handler(self, event):
         src_port = Port(port = event.link.src, peer = event.link.dst)
         dst_port = Port(port = event.link.dst, peer = event.link.src)
         self._update_port_link(src_port.dpid, src_port)
         self._update_port_link(dst_port.dpid, dst_port)
-        self.routing_algo.topology_last_update = time.time()
+        self._link_changed(src_port.dpid, dst_port.dpid)
 
     def _delete_link(self, port):
         try:
@@ -292,6 +729,26 @@ class Routing(app_manager.RyuApp):
 
         p.peer_switch_dpid = None
         p.peer_port_no = None
+        self.graph.update_port(p)
+
+    def _fast_reroute(self, port):
+        """
+            move the flow entries forwarding through a failed port to
+            their backup next hops
+        """
+        self.setups.routes_changed()
+        for record in self.frr.link_down(port.dpid, port.port_no):
+            this_switch = self.dpid_to_switch[record.dpid]
+            next_switch = self.dpid_to_switch[
+                this_switch.ports[record.outport_no].peer_switch_dpid]
+            key, match, rule, priority = self._flow_match(
+                this_switch.dp, record._4or6, record.ip_dst,
+                record.five_tuple)
+            self._send_flow_entry(this_switch, next_switch,
+                                  record.outport_no, record._4or6,
+                                  key, match, rule, priority, record.cookie)
+            LOG.info('Flow entry of %s to %s moved to port %s',
+                     this_switch, record.ip_dst, record.outport_no)
 
     @set_ev_cls(topology.event.EventLinkDelete)
     def link_delete_handler(self, event):
@@ -303,28 +760,40 @@ class Routing(app_manager.RyuApp):
         except KeyError:
             return
 
+        # before the link is removed, backups are found on the topology
+        # in which the flow entries were deployed
+        self._fast_reroute(event.link.src)
+        self._fast_reroute(event.link.dst)
         self._delete_link(event.link.src)
         self._delete_link(event.link.dst)
-        self.routing_algo.topology_last_update = time.time()
+        self._link_changed(event.link.src.dpid, event.link.dst.dpid)
 
 
     @set_ev_cls(topology.event.EventPortAdd)
     def port_add_handler(self, event):
         port = Port(event.port)
         switch = self.dpid_to_switch[port.dpid]
+        old_port = switch.ports.get(port.port_no, None)
         switch.ports[port.port_no] = port
-        switch.update_from_config(self.switch_cfg)
-        self.routing_algo.topology_last_update = time.time()
+        switch.update_from_config(self.switch_cfg, self.switches)
+        self.graph.update_port(port)
+        self._cover_unroutable(self._gateway_networks(switch))
+        # a new port has no link, only the one it replaces matters
+        if old_port and old_port.peer_switch_dpid is not None:
+            self._link_changed(port.dpid, old_port.peer_switch_dpid)
 
     @set_ev_cls(topology.event.EventPortDelete)
     def port_delete_handler(self, event):
         port = Port(event.port)
         try:
             switch = self.dpid_to_switch[port.dpid]
-            del switch.ports[port.port_no]
-            self.routing_algo.topology_last_update = time.time()
+            old_port = switch.ports.pop(port.port_no)
         except KeyError:
-            pass
+            return
+        self.graph.remove_port(port.dpid, port.port_no)
+        self.switches.update_switch(switch)
+        if old_port.peer_switch_dpid is not None:
+            self._link_changed(port.dpid, old_port.peer_switch_dpid)
 
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, [MAIN_DISPATCHER,
@@ -338,6 +807,7 @@ class Routing(app_manager.RyuApp):
         except KeyError:
             self.dpid_to_switch[dpid] = Switch(event.msg.datapath)
             switch = self.dpid_to_switch[dpid]
+            self.graph.add_switch(dpid)
 
         for port_no, port in event.msg.ports.iteritems():
             if port_no not in switch.ports:
@@ -353,13 +823,22 @@ class Routing(app_manager.RyuApp):
                 # represents current features of the port.
                 # LOCAL port doesn't have a cost value
                 curr = port.curr & 0x7f	 # get last 7 bits
-                p.cost = 64/curr
+                old_cost = p.cost
+                p.base_cost = 64/curr
+                p.speed = port_stats.port_speed(curr)
+                p.cost = self.port_stats.cost(dpid, port_no, p.base_cost)
                 print 'cost:', p.cost
+                self.graph.update_port(p)
+                if p.cost != old_cost and p.peer_switch_dpid is not None:
+                    self._link_changed(dpid, p.peer_switch_dpid)
 
-        switch.update_from_config(self.switch_cfg)
-        self.routing_algo.topology_last_update = time.time()
+        switch.update_from_config(self.switch_cfg, self.switches)
 
     def find_packet(self, pkt, target):
+        if isinstance(pkt, headers.Headers):
+            layer = pkt.find(target)
+            if layer is not headers.UNKNOWN:
+                return layer
         for packet in pkt.protocols:
             try:
                 if packet.protocol_name == target:
@@ -373,17 +852,10 @@ class Routing(app_manager.RyuApp):
         switch = self.dpid_to_switch[msg.datapath.id]
         in_port_no = msg.in_port
         gateway = switch.ports[in_port_no].gateway
-        pop_list = []
         if gateway and gateway.gw_ip == netaddr.IPAddress(arp_pkt.dst_ip):
-            self._remember_mac_addr(switch, pkt, 4)
-            for i in xrange(len(switch.msg_buffer)):
-                msg, pkt, outport_no, _4or6 = switch.msg_buffer[i]
-                if self.last_switch_out(msg, pkt, outport_no, _4or6):
-                    pop_list.append(i)
-
-            pop_list.sort(reverse = True)  # descending order
-            for i in pop_list:             # pop from tail to head
-                switch.msg_buffer.pop(i)
+            self._remember_mac_addr(switch, in_port_no, pkt, 4)
+            self._release_pending(switch, netaddr.IPAddress(arp_pkt.src_ip),
+                                  4)
 
     def _handle_arp(self, msg, pkt, arp_pkt):
         """
@@ -391,16 +863,31 @@ class Routing(app_manager.RyuApp):
             handles ARP request from hosts, about their gateways;
             only works in IPv4 since IPv6 uses NDP(ICMPv6);
             e.g. when a host need to send a packet to the gateway, it will
-                firstly send an ARP to get the MAC address of the gateway
+                firstly send an ARP to get the MAC address of the gateway;
+            requests about other known hosts are answered in their place
             2)
             handles ARP reply from hosts, and try to send packets currently
-            stored in switch.msg_buffer
+            waiting for the address in self.pending
             3)
             brutally forward all ARP packets to the tap port, so the system
             protocol stack could also handle those MAC addresses
         """
         LOG.debug('Handling ARP packet %s', arp_pkt)
 
+        switch = self.dpid_to_switch[msg.datapath.id]
+        in_port_no = msg.in_port
+        req_dst_ip = arp_pkt.dst_ip
+        req_src_ip = arp_pkt.src_ip
+        port = switch.ports[in_port_no]
+
+        # not from probes of duplicate address detection, 0.0.0.0
+        if arp_pkt.opcode == arp.ARP_REQUEST and \
+                netaddr.IPAddress(req_src_ip).value:
+            self._remember_mac_addr(switch, in_port_no, pkt, 4)
+            if self._proxy_arp(msg, arp_pkt, port):
+                # answered for the host, no need to bother the tap
+                return
+
         # forward ARP packets to the tap port
         self.write_to_tap(pkt.data)
 
@@ -411,37 +898,62 @@ class Routing(app_manager.RyuApp):
         if arp_pkt.opcode != arp.ARP_REQUEST:
             return
 
-        switch = self.dpid_to_switch[msg.datapath.id]
-        in_port_no = msg.in_port
-        req_dst_ip = arp_pkt.dst_ip
-        req_src_ip = arp_pkt.src_ip
-
-        port = switch.ports[in_port_no]
         if port.gateway and netaddr.IPAddress(req_dst_ip) != port.gateway.gw_ip:
             return
 
-        datapath = msg.datapath
         reply_src_mac = str(port.hw_addr)
-        ether_layer = self.find_packet(pkt, 'ethernet')
-
-        e = ethernet.ethernet(dst = ether_layer.src, src = reply_src_mac,
-                                ethertype = ether.ETH_TYPE_ARP)
-        a = arp.arp(hwtype = arp.ARP_HW_TYPE_ETHERNET,
-                    proto = ether.ETH_TYPE_IP,
-                    hlen = 6, plen = 4, opcode = arp.ARP_REPLY,
-                    src_mac = reply_src_mac, src_ip = req_dst_ip,
-                    dst_mac = arp_pkt.src_mac, dst_ip = req_src_ip)
-        p = packet.Packet()
-        p.add_protocol(e)
-        p.add_protocol(a)
-        p.serialize()
-
-        datapath.send_packet_out(in_port = ofproto_v1_0.OFPP_NONE,
-                actions = [datapath.ofproto_parser.OFPActionOutput(in_port_no)],
-                data = p.data)
-
+        self._send_arp_reply(msg.datapath, in_port_no, reply_src_mac,
+                             req_dst_ip, arp_pkt.src_mac, req_src_ip)
         LOG.debug('ARP replied: %s - %s', reply_src_mac, req_dst_ip)
 
+    def _proxy_arp(self, msg, arp_pkt, port):
+        """
+            answer the ARP request with the MAC address of the host asked
+            for, if it's known and not behind the port of the request;
+            return True if answered
+        """
+        if not Routing.PROXY_ARP:
+            return False
+        target = netaddr.IPAddress(arp_pkt.dst_ip)
+        if port.gateway and target == port.gateway.gw_ip:
+            return False
+        host = self.neighbors.lookup(target, time.time())
+        if host is None or (host.dpid == msg.datapath.id and
+                            host.port_no == msg.in_port):
+            # the host answers itself
+            return False
+        self._send_arp_reply(msg.datapath, msg.in_port, str(host.mac),
+                             arp_pkt.dst_ip, arp_pkt.src_mac,
+                             arp_pkt.src_ip)
+        LOG.debug('ARP proxied: %s - %s', host.mac, target)
+        return True
+
+    def _send_arp_reply(self, datapath, port_no, src_mac, src_ip, dst_mac,
+                        dst_ip):
+        self._send_packet(datapath, port_no, packet_templates.arp_reply(
+            netaddr.EUI(src_mac).packed, netaddr.IPAddress(src_ip).packed,
+            netaddr.EUI(dst_mac).packed, netaddr.IPAddress(dst_ip).packed))
+
+    def _send_packet(self, datapath, port_no, data):
+        out = datapath.ofproto_parser.OFPPacketOut(
+            datapath = datapath, buffer_id = datapath.ofproto.OFP_NO_BUFFER,
+            in_port = ofproto_v1_0.OFPP_NONE,
+            actions = [datapath.ofproto_parser.OFPActionOutput(port_no)],
+            data = data)
+        self.scheduler.send(datapath, out, flow_scheduler.PACKET_OUT,
+                            time.time())
+
+    def _templates(self, port):
+        """
+            PortTemplates of a gateway port, built again if its gateway
+            was configured anew
+        """
+        if port.templates is None or port.templates.gateway is not \
+                port.gateway:
+            port.templates = packet_templates.PortTemplates(
+                port.hw_addr.packed, port.gateway)
+        return port.templates
+
     def _handle_icmp(self, msg, pkt, icmp_pkt):
         """
             reply to ICMP_ECHO_REQUEST(i.e. ping);
@@ -472,31 +984,10 @@ class Routing(app_manager.RyuApp):
         if not need_reply:
             return False
 
-        echo_id = icmp_pkt.data.id
-        echo_seq = icmp_pkt.data.seq
-        echo_data = bytearray(icmp_pkt.data.data)
-
-        icmp_data = icmp.echo(id_=echo_id, seq=echo_seq, data=echo_data)
-
         #send a echo reply packet
-        ether_layer = self.find_packet(pkt, 'ethernet')
-        ether_dst = ether_layer.src
-        ether_src = str(switch.ports[in_port_no].hw_addr)
-        e = ethernet.ethernet(ether_dst, ether_src, ether.ETH_TYPE_IP)
-        #csum calculation should be paid attention to
-        i = ipv4.ipv4(version=4, header_length=5, tos=0, total_length=0,
-            identification=0, flags=0x000, offset=0, ttl=64, proto=1, csum=0,
-            src=str(ip_dst), dst=str(ip_src), option=None)
-        ic = icmp.icmp(type_=0, code=0, csum=0, data=icmp_data)
-        p = packet.Packet()
-        p.add_protocol(e)
-        p.add_protocol(i)
-        p.add_protocol(ic)
-        p.serialize()
-        datapath = msg.datapath
-        datapath.send_packet_out(in_port=ofproto_v1_0.OFPP_NONE,
-                actions=[datapath.ofproto_parser.OFPActionOutput(in_port_no)],
-                data=p.data)
+        hw_addr = switch.ports[in_port_no].hw_addr.packed
+        self._send_packet(msg.datapath, in_port_no,
+                          packet_templates.echo_reply(pkt.data, hw_addr))
         LOG.debug('Ping replied %s -> %s', ip_dst, ip_src)
         return True
 
@@ -514,19 +1005,11 @@ class Routing(app_manager.RyuApp):
 
         if icmpv6_pkt.type_ == icmpv6.ND_NEIGHBOR_ADVERT:
             gateway = switch.ports[in_port_no].gateway
-            pop_list = []
             ipv6_pkt = self.find_packet(pkt, 'ipv6')
             if gateway and gateway.gw_ipv6 == netaddr.IPAddress(ipv6_pkt.dst):
-                self._remember_mac_addr(switch, pkt, 6)
-                for i in xrange(len(switch.msg_buffer)):
-                    msg, pkt, outport_no, _4or6 = switch.msg_buffer[i]
-                    if self.last_switch_out(msg, pkt, outport_no, _4or6):
-                        pop_list.append(i)
-
-                pop_list.sort(reverse = True)
-                for i in pop_list:
-                    switch.msg_buffer.pop(i)
-
+                self._remember_mac_addr(switch, in_port_no, pkt, 6)
+                self._release_pending(switch,
+                                      netaddr.IPAddress(ipv6_pkt.src), 6)
                 return True
             return False
 
@@ -534,15 +1017,12 @@ class Routing(app_manager.RyuApp):
             port = switch.ports[in_port_no]
             LOG.debug('ND_NEIGHBOR_SOLICIT, dest %s',
                       icmpv6_pkt.data.dst)
-            if port.gateway and \
-               netaddr.IPAddress(icmpv6_pkt.data.dst) != port.gateway.gw_ipv6:
-                return False
-            #send a ND_NEIGHBOR_REPLY packet
             ether_layer = self.find_packet(pkt, 'ethernet')
-            ether_dst = ether_layer.src
-            ether_src = str(port.hw_addr)
-            e = ethernet.ethernet(ether_dst, ether_src, ether.ETH_TYPE_IPV6)
-            ic6_data_data = icmpv6.nd_option_tla(hw_src=ether_src, data=None)
+            ipv6_pkt = self.find_packet(pkt, 'ipv6')
+            target = netaddr.IPAddress(icmpv6_pkt.data.dst)
+            if port.gateway and target != port.gateway.gw_ipv6:
+                return self._proxy_nd(msg, ether_layer, ipv6_pkt, target,
+                                      port)
             # res: R, S, O flags for Neighbor advertisement
             # R: Router flag. Set if the sender of the advertisement is a router
             # S: Solicited flag. Set if the advertisement is in response to a
@@ -550,25 +1030,9 @@ class Routing(app_manager.RyuApp):
             # O: Override flag. When set, the receiving node must update its cache
             # here we must set R, S; O is optional but we decide to set
             # so res = 7
-            ic6_data = icmpv6.nd_neighbor(res=7, dst=icmpv6_pkt.data.dst,
-                                          option=ic6_data_data)
-            ic6 = icmpv6.icmpv6(type_=icmpv6.ND_NEIGHBOR_ADVERT, code=0,
-                                csum=0, data=ic6_data)
-            #payload_length
-            ipv6_pkt = self.find_packet(pkt, 'ipv6')
-            i6 = ipv6.ipv6(version= 6, traffic_class=0, flow_label=0,
-                           payload_length=32, nxt=58, hop_limit=255,
-                           src=icmpv6_pkt.data.dst, dst=ipv6_pkt.src)
-            p = packet.Packet()
-            p.add_protocol(e)
-            p.add_protocol(i6)
-            p.add_protocol(ic6)
-            p.serialize()
-            datapath = msg.datapath
-            datapath.send_packet_out(in_port=ofproto_v1_0.OFPP_NONE,
-                    actions=
-                        [datapath.ofproto_parser.OFPActionOutput(in_port_no)],
-                    data=p.data)
+            self._send_na(msg.datapath, in_port_no, str(port.hw_addr),
+                          ether_layer.src, icmpv6_pkt.data.dst,
+                          ipv6_pkt.src, 7)
             LOG.debug('NA packet sent %s -> %s', icmpv6_pkt.data.dst,
                       ipv6_pkt.src)
             return True
@@ -584,35 +1048,60 @@ class Routing(app_manager.RyuApp):
             if not need_reply:
                 return False
 
-            ether_layer = self.find_packet(pkt, 'ethernet')
-            ether_dst = ether_layer.src
-            ether_src = str(switch.ports[in_port_no].hw_addr)
-            e = ethernet.ethernet(ether_dst,ether_src,ether.ETH_TYPE_IPV6)
-            ic6_data = icmpv6_pkt.data
-            ic6 = icmpv6.icmpv6(type_=icmpv6.ICMPV6_ECHO_REPLY, code=0,
-                                csum=0, data=ic6_data)
-            i6 = ipv6.ipv6(version=6, traffic_class=0, flow_label=0,
-                           payload_length=64, nxt=58, hop_limit=64,
-                           src=ipv6_pkt.dst, dst=ipv6_pkt.src)
-            p = packet.Packet()
-            p.add_protocol(e)
-            p.add_protocol(i6)
-            p.add_protocol(ic6)
-            p.serialize()
-            datapath = msg.datapath
-            datapath.send_packet_out(in_port=ofproto_v1_0.OFPP_NONE,
-                    actions=
-                        [datapath.ofproto_parser.OFPActionOutput(in_port_no)],
-                    data=p.data)
+            hw_addr = switch.ports[in_port_no].hw_addr.packed
+            self._send_packet(msg.datapath, in_port_no,
+                              packet_templates.echo_reply(pkt.data, hw_addr))
             LOG.debug('Ping6 replied %s -> %s', ipv6_pkt.dst, ipv6_pkt.src)
             return True
 
         return False
 
-    def _remember_mac_addr(self, switch, packet, _4or6):
+    def _release_pending(self, switch, ip, _4or6):
+        """
+            the MAC address of ip is learned, deploy the entry towards it
+            and send the packets waiting for it
+        """
+        resolution = self.pending.resolved(switch.dp.id, ip)
+        if resolution is None:
+            return
+        actions = self._install_last_hop(switch, ip, resolution.outport_no,
+                                         _4or6, True)
+        if actions is None:
+            for pending in resolution.packets:
+                self.drop_pkt(pending)
+            return
+        self._release(switch.dp, actions, resolution.packets)
+
+    def _proxy_nd(self, msg, ether_layer, ipv6_pkt, target, port):
+        """
+            the NS counterpart of _proxy_arp, not for duplicate address
+            detection, whose source address is unspecified
+        """
+        if not Routing.PROXY_ARP or \
+                netaddr.IPAddress(ipv6_pkt.src).value == 0:
+            return False
+        host = self.neighbors.lookup(target, time.time())
+        if host is None or (host.dpid == msg.datapath.id and
+                            host.port_no == msg.in_port):
+            return False
+        # solicited, but neither a router nor overriding the host's own
+        self._send_na(msg.datapath, msg.in_port, str(host.mac),
+                      ether_layer.src, str(target), ipv6_pkt.src, 2)
+        LOG.debug('NA proxied: %s - %s', host.mac, target)
+        return True
+
+    def _send_na(self, datapath, port_no, src_mac, dst_mac, target, dst_ip,
+                 res):
+        self._send_packet(datapath, port_no, packet_templates.neighbor_advert(
+            netaddr.EUI(src_mac).packed, netaddr.EUI(dst_mac).packed,
+            netaddr.IPAddress(target).packed,
+            netaddr.IPAddress(dst_ip).packed, res))
+
+    def _remember_mac_addr(self, switch, port_no, packet, _4or6):
         """
-            get ip <-> mac relationship from packets and
-            store them in dict ip_to_mac
+            get ip <-> mac relationship from packets arriving at port_no
+            and store them in the neighbor cache, if the source is a host
+            of the gateway network of the port
         """
         time_now = time.time()
         ether_layer = self.find_packet(packet, 'ethernet')
@@ -627,186 +1116,419 @@ class Routing(app_manager.RyuApp):
                       ip_layer.src)
         else:
             ip_layer = self.find_packet(packet, 'ipv6')
-        switch.ip_to_mac[netaddr.IPAddress(ip_layer.src)] = \
-                            (netaddr.EUI(ether_layer.src), time_now)
-
-    def deploy_flow_entry(self, msg, pkt, switch_list, _4or6):
+        ip = netaddr.IPAddress(ip_layer.src)
+        port = switch.ports.get(port_no, None)
+        if port is None or not port.gateway:
+            return
+        if ip.version == 4:
+            network = port.gateway.gw_ip_network
+        else:
+            network = port.gateway.gw_ipv6_network
+        if ip not in network:
+            # from another network through this port, e.g. a neighbor
+            # router or another switch
+            return
+        old = self.neighbors.learn(ip, netaddr.EUI(ether_layer.src),
+                                   switch.dp.id, port_no, time_now)
+        if old is not None:
+            LOG.info('%s moved to %s at port %s of %s', ip, ether_layer.src,
+                     port_no, switch.dp.id)
+            self._delete_last_hops(old.dpid, ip)
+
+    def _five_tuple(self, pkt, _4or6):
+        """
+            (src ip, dst ip, ip proto, src port, dst port) of a packet,
+            ports are 0 if it's neither TCP nor UDP
+        """
+        if _4or6 == 4:
+            ip_layer = self.find_packet(pkt, 'ipv4')
+            proto = ip_layer.proto
+        else:
+            ip_layer = self.find_packet(pkt, 'ipv6')
+            proto = ip_layer.nxt
+        l4_layer = self.find_packet(pkt, 'tcp') or \
+                   self.find_packet(pkt, 'udp')
+        if l4_layer:
+            return (ip_layer.src, ip_layer.dst, proto,
+                    l4_layer.src_port, l4_layer.dst_port)
+        return ip_layer.src, ip_layer.dst, proto, 0, 0
+
+    def find_route(self, src_switch, dst_switch, pkt, _4or6):
+        """
+            find a path from src_switch to dst_switch for the packet;
+            return (switch_list, outports, exact), where outports[i] is
+            the port of switch_list[i] towards switch_list[i+1] and
+            exact[i] is True if switch_list[i] has several equal cost
+            next hops, so its flow entry must match the 5-tuple;
+            return (None, None, None) if there is no route
+        """
+        key = src_switch.dp.id, dst_switch.dp.id
+        if not Routing.ECMP:
+            switch_list = self._batched('route', key,
+                                        self.routing_algo.find_route,
+                                        src_switch, dst_switch)
+            return switch_list, None, None
+
+        next_hops = self._batched('multipath', key,
+                                  self.routing_algo.find_multipath,
+                                  src_switch, dst_switch)
+        if next_hops is None:
+            return None, None, None
+
+        flow_hash = hash(self._five_tuple(pkt, _4or6))
+        return algorithm.hash_path(next_hops, src_switch, dst_switch,
+                                   flow_hash)
+
+    def deploy_flow_entry(self, msg, pkt, switch_list, _4or6,
+                          outports=None, exact=None, exit=None,
+                          last_outport_no=None):
         """
             deploy flow entry into switch
             e.g. if 'switch_list' is [A, B, C], then this method will
                 deploy flow entries A->B, B->C
+            'outports' and 'exact' are the same as returned by find_route,
+            entries of switches in 'exact' match the 5-tuple of the packet
+            instead of only the destination address; 'exit' is the
+            egress.Exit if the packet leaves the AS; if 'last_outport_no'
+            is given, the last switch gets the entry towards the host too,
+            if its MAC address is known
+            entries are deployed from the last switch back to the first;
+            with barriers, the first switch gets its entry and the packet
+            is sent when all the others confirmed theirs
         """
-        # TODO
-        # this method and last_switch_out should be restructured
         dp = msg.datapath
         length = len(switch_list)
-        for i in xrange(length - 1):
+        if outports is None:
+            outports = [switch_list[i].peer_to_local_port[switch_list[i + 1]]
+                        for i in xrange(length - 1)]
+        if exact is None:
+            exact = [False] * (length - 1)
+        if _4or6 == 4:
+            ip_layer = self.find_packet(pkt, 'ipv4')
+        else:
+            ip_layer = self.find_packet(pkt, 'ipv6')
+        ip_dst = netaddr.IPAddress(ip_layer.dst)
+        five_tuple = None
+        if any(exact):
+            five_tuple = self._five_tuple(pkt, _4or6)
+        src_dpid = switch_list[0].dp.id
+        dst_dpid = switch_list[-1].dp.id
+        now = time.time()
+        actions = install = None
+        if last_outport_no is not None:
+            self._install_last_hop(switch_list[-1], ip_dst, last_outport_no,
+                                   _4or6)
+        for i in reversed(xrange(length - 1)):
             this_switch = switch_list[i]
             next_switch = switch_list[i + 1]
-            outport_no = this_switch.peer_to_local_port[next_switch]
-            if _4or6 == 4:
-                ip_layer = self.find_packet(pkt, 'ipv4')
-            else:
-                ip_layer = self.find_packet(pkt, 'ipv6')
-
-            ip_dst = netaddr.IPAddress(ip_layer.dst)
-            outport = this_switch.ports[outport_no]
-            mac_src = outport.hw_addr
-            mac_dst = next_switch.ports[outport.peer_port_no].hw_addr
-            if _4or6 == 4:
-                # ip src exact match
-                wildcards = ofproto_v1_0.OFPFW_ALL
-                wildcards &= ~ofproto_v1_0.OFPFW_DL_TYPE
-                wildcards &= ~(0x3f << ofproto_v1_0.OFPFW_NW_DST_SHIFT)
-
-                match = dp.ofproto_parser.OFPMatch(
-                        # because of wildcards, parameters other than dl_type
-                        # and nw_dst could be any value
-                        wildcards = wildcards, in_port = 0,
-                        dl_src = 0, dl_dst = 0, dl_vlan = 0, dl_vlan_pcp = 0,
-                        dl_type = ether.ETH_TYPE_IP, nw_tos = 0, nw_proto = 0,
-                        nw_src = 0, nw_dst = ip_dst.value, tp_src = 0,
-                        tp_dst = 0)
+            outport_no = outports[i]
+            if exact[i]:
+                key, match, rule, priority = self._flow_match(
+                    dp, _4or6, ip_dst, five_tuple)
             else:
-                rule = nx_match.ClsRule()
-                rule.set_dl_type(ether.ETH_TYPE_IPV6)
-                rule.set_ipv6_dst(struct.unpack('!8H', ip_dst.packed))
-
-            actions = []
-            actions.append(dp.ofproto_parser.OFPActionSetDlSrc(
-                           mac_src.packed))
-            actions.append(dp.ofproto_parser.OFPActionSetDlDst(
-                           mac_dst.packed))
-            actions.append(dp.ofproto_parser.OFPActionOutput(outport_no))
-
-            if _4or6 == 4:
-                mod = dp.ofproto_parser.OFPFlowMod(
-                    datapath = this_switch.dp, match = match,
-                    cookie = 0,
-                    command = dp.ofproto.OFPFC_MODIFY,
-                    idle_timeout = Routing.FLOW_IDLE_TIMEOUT,
-                    hard_timeout = Routing.FLOW_HARD_TIMEOUT,
-                    out_port = outport_no, actions = actions)
-            else:
-                mod = dp.ofproto_parser.NXTFlowMod(
-                        datapath = this_switch.dp, cookie = 0,
-                        command = dp.ofproto.OFPFC_MODIFY,
-                        idle_timeout = Routing.FLOW_IDLE_TIMEOUT,
-                        hard_timeout = Routing.FLOW_HARD_TIMEOUT,
-                        out_port = outport_no, rule = rule,
-                        actions = actions)
-
-            this_switch.dp.send_msg(mod)
+                key, match, rule, priority = self._flow_match(dp, _4or6,
+                                                              ip_dst)
+            cookie = self.cookies.cookie(src_dpid, dst_dpid,
+                                         this_switch.dp.id, exit)
+            self.frr.add(frr.FlowRecord(
+                this_switch.dp.id, outport_no, dst_dpid, ip_dst, _4or6,
+                five_tuple if exact[i] else None, cookie, now))
+            if i == 0 and Routing.BARRIER_SETUP:
+                # packets hitting it would outrun the other entries
+                install = functools.partial(
+                    self._send_flow_entry, this_switch, next_switch,
+                    outport_no, _4or6, key, match, rule, priority, cookie,
+                    this_switch.dp is dp)
+                break
+            actions = self._send_flow_entry(this_switch, next_switch,
+                                            outport_no, _4or6, key, match,
+                                            rule, priority, cookie,
+                                            this_switch.dp is dp)
             LOG.info('Flow entry deployed to %s', this_switch)
 
-        # send packet out from the first switch
-        switch = switch_list[0]
-        next_switch = switch_list[1]
-        outport_no = switch.peer_to_local_port[next_switch]
+        if Routing.BIDIRECTIONAL_SETUP:
+            # before the barriers, which confirm most of them too
+            self._deploy_reverse(msg, pkt, switch_list, _4or6)
+
+        # the packet follows the entry of the first switch, once every
+        # switch has its entry, so it isn't sent to the controller again
+        if Routing.BARRIER_SETUP:
+            barriers = [self._send_barrier(switch.dp)
+                        for switch in switch_list[1:]]
+            self._complete_setup(msg, None, any(exact), barriers, install)
+        else:
+            self._complete_setup(msg, actions, any(exact))
+
+    def _deploy_reverse(self, msg, pkt, switch_list, _4or6):
+        """
+            deploy flow entries from the last switch of 'switch_list' back
+            to the first one towards the source of the packet, if it's a
+            host behind the port the packet came in from and its MAC
+            address is known
+        """
+        if _4or6 == 4:
+            ip_layer = self.find_packet(pkt, 'ipv4')
+        else:
+            ip_layer = self.find_packet(pkt, 'ipv6')
+        ip_src = netaddr.IPAddress(ip_layer.src)
+        src_switch = switch_list[0]
+        switch, port_no = self.find_switch_of_network(ip_src, _4or6)
+        if switch is not src_switch or port_no != msg.in_port:
+            return
+        if self._install_last_hop(src_switch, ip_src, port_no,
+                                  _4or6) is None:
+            return
+
+        dp = msg.datapath
+        key, match, rule, priority = self._flow_match(dp, _4or6, ip_src)
+        src_dpid = switch_list[-1].dp.id
+        dst_dpid = src_switch.dp.id
+        now = time.time()
+        # from the switch next to the source host on
+        for i in xrange(1, len(switch_list)):
+            this_switch = switch_list[i]
+            next_switch = switch_list[i - 1]
+            outport_no = this_switch.peer_to_local_port[next_switch]
+            cookie = self.cookies.cookie(src_dpid, dst_dpid,
+                                         this_switch.dp.id)
+            self._send_flow_entry(this_switch, next_switch, outport_no,
+                                  _4or6, key, match, rule, priority, cookie)
+            self.frr.add(frr.FlowRecord(
+                this_switch.dp.id, outport_no, dst_dpid, ip_src, _4or6,
+                None, cookie, now))
+        LOG.info('Reverse flow entries deployed towards %s', ip_src)
+
+    def _send_barrier(self, dp):
+        # return (dpid, xid) of the request, it follows the flow mods
+        # queued to dp
+        req = dp.ofproto_parser.OFPBarrierRequest(dp)
+        dp.set_xid(req)
+        self.scheduler.send(dp, req, flow_scheduler.REACTIVE, time.time(),
+                            limited=False)
+        return dp.id, req.xid
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def barrier_reply_handler(self, event):
+        msg = event.msg
+        dp, actions, waiting = self.setups.barrier_reply(
+            msg.datapath.id, msg.xid, time.time())
+        if waiting:
+            self._release(dp, actions, waiting)
+
+    def _complete_setup(self, msg, actions, exact=False, barriers=(),
+                        install=None):
+        """
+            the flow entries for the packet in 'msg' are sent, release it
+            and the packet ins which waited for them with 'actions' at the
+            ingress switch, after the replies of 'barriers' if any;
+            'install' sends the entry of the ingress switch and returns
+            the actions, in place of 'actions', before the release
+        """
+        dp = msg.datapath
+        if install is not None and not barriers:
+            actions, install = install(), None
+        five_tuple = flow_setup.peek_five_tuple(msg.data)
+        waiting = None
+        if five_tuple is not None:
+            waiting = self.setups.complete((dp.id, five_tuple[2]), msg, dp,
+                                           actions, exact, time.time(),
+                                           barriers, install)
+        if waiting is None:
+            # not a setup of its own, the packet waits for the barriers
+            # alone
+            if barriers:
+                self.setups.complete_alone(msg, dp, barriers, install,
+                                           time.time())
+                return
+            waiting = [msg]
+        if waiting:
+            self._release(dp, actions, waiting)
+
+    def _release(self, dp, actions, msgs):
+        now = time.time()
+        for msg in msgs:
+            data = None
+            if msg.buffer_id == dp.ofproto.OFP_NO_BUFFER:
+                data = msg.data
+            out = dp.ofproto_parser.OFPPacketOut(
+                datapath = dp, buffer_id = msg.buffer_id,
+                in_port = msg.in_port, actions = actions, data = data)
+            self.scheduler.send(dp, out, flow_scheduler.PACKET_OUT, now)
+
+    def _flow_match(self, dp, _4or6, ip_dst, five_tuple=None):
+        """
+            return (key, match, rule, priority) of a flow entry towards
+            ip_dst, or of the 5-tuple if given; match is for IPv4 and rule
+            (NXM) is for IPv6, the other one is None; key identifies the
+            match in the shadow flow tables
+        """
+        if five_tuple is not None:
+            match, rule = self._five_tuple_match(dp, five_tuple, _4or6)
+            ip_src, _, proto, tp_src, tp_dst = five_tuple
+            key = (_4or6, ip_dst.value, (netaddr.IPAddress(ip_src).value,
+                   ip_dst.value, proto, tp_src, tp_dst))
+            return key, match, rule, Routing.ECMP_FLOW_PRIORITY
+        key = (_4or6, ip_dst.value, None)
+
+        if _4or6 == 4:
+            # ip dst exact match
+            wildcards = ofproto_v1_0.OFPFW_ALL
+            wildcards &= ~ofproto_v1_0.OFPFW_DL_TYPE
+            wildcards &= ~(0x3f << ofproto_v1_0.OFPFW_NW_DST_SHIFT)
+
+            match = dp.ofproto_parser.OFPMatch(
+                    # because of wildcards, parameters other than dl_type
+                    # and nw_dst could be any value
+                    wildcards = wildcards, in_port = 0,
+                    dl_src = 0, dl_dst = 0, dl_vlan = 0, dl_vlan_pcp = 0,
+                    dl_type = ether.ETH_TYPE_IP, nw_tos = 0, nw_proto = 0,
+                    nw_src = 0, nw_dst = ip_dst.value, tp_src = 0,
+                    tp_dst = 0)
+            return key, match, None, ofproto_v1_0.OFP_DEFAULT_PRIORITY
+
+        rule = nx_match.ClsRule()
+        rule.set_dl_type(ether.ETH_TYPE_IPV6)
+        rule.set_ipv6_dst(struct.unpack('!8H', ip_dst.packed))
+        return key, None, rule, ofproto_v1_0.OFP_DEFAULT_PRIORITY
 
-        outport = switch.ports[outport_no]
+    def _send_flow_entry(self, this_switch, next_switch, outport_no, _4or6,
+                         key, match, rule, priority, cookie, punted=False):
+        """
+            add or modify the flow entry of this_switch which forwards to
+            next_switch through outport_no; return the actions
+        """
+        outport = this_switch.ports[outport_no]
         mac_src = outport.hw_addr
         mac_dst = next_switch.ports[outport.peer_port_no].hw_addr
+        return self._send_flow_mod(this_switch.dp, _4or6, key, match, rule,
+                                   priority, cookie, mac_src, mac_dst,
+                                   outport_no, punted)
+
+    def _send_flow_mod(self, dp, _4or6, key, match, rule, priority, cookie,
+                       mac_src, mac_dst, outport_no, punted=False):
+        """
+            add or modify a flow entry which rewrites the MAC addresses and
+            outputs to outport_no, unless the shadow table shows the same
+            entry on the switch; 'punted' is True if dp sent the packet in
+            being handled; return the actions
+        """
+        actions = self._rewrite_actions(dp, mac_src, mac_dst, outport_no)
+
+        # only removals of OpenFlow 1.0 matches are reported
+        if not self.flow_tables.install(
+                dp.id, key, priority, (mac_src, mac_dst, outport_no), cookie,
+                time.time(), Routing.FLOW_HARD_TIMEOUT, _4or6 == 4, punted):
+            LOG.debug('Flow mod to %s suppressed', dp.id)
+            return actions
+
+        if Routing.FLOW_MOD_TEMPLATES and key[2] is None:
+            # towards the destination only, see _flow_match
+            def encode(cookie, mac_src, mac_dst, ip_dst, buffer_id):
+                _, match, rule, _ = self._flow_match(dp, _4or6, ip_dst)
+                return self._encode_flow_mod(
+                    dp, _4or6, match, rule, priority, cookie,
+                    self._rewrite_actions(dp, mac_src, mac_dst, outport_no),
+                    outport_no, buffer_id)
+            mod = self.flow_mods.build(
+                dp, outport_no, _4or6, priority, encode, cookie,
+                mac_src.packed, mac_dst.packed, key[1],
+                dp.ofproto.OFP_NO_BUFFER)
+        else:
+            mod = self._encode_flow_mod(dp, _4or6, match, rule, priority,
+                                        cookie, actions, outport_no)
+        self.scheduler.send(dp, mod, flow_scheduler.REACTIVE, time.time(),
+                            (key, priority))
+        return actions
+
+    def _rewrite_actions(self, dp, mac_src, mac_dst, outport_no):
         actions = []
         actions.append(dp.ofproto_parser.OFPActionSetDlSrc(
-                        mac_src.packed))
+                       mac_src.packed))
         actions.append(dp.ofproto_parser.OFPActionSetDlDst(
-                        mac_dst.packed))
+                       mac_dst.packed))
         actions.append(dp.ofproto_parser.OFPActionOutput(outport_no))
+        return actions
 
-        out = dp.ofproto_parser.OFPPacketOut(
-            datapath = dp, buffer_id = msg.buffer_id,
-            in_port = msg.in_port, actions = actions)
-
-        switch.dp.send_msg(out)
+    def _encode_flow_mod(self, dp, _4or6, match, rule, priority, cookie,
+                         actions, outport_no, buffer_id=0xffffffff):
+        # an OFPFC_ADD replaces the cookie of an existing entry, which
+        # an OFPFC_MODIFY keeps, so an entry of the new generation of a
+        # route is not hit by the delete of the old one
+        if _4or6 == 4:
+            return dp.ofproto_parser.OFPFlowMod(
+                datapath = dp, match = match,
+                cookie = cookie,
+                command = dp.ofproto.OFPFC_ADD,
+                idle_timeout = Routing.FLOW_IDLE_TIMEOUT,
+                hard_timeout = Routing.FLOW_HARD_TIMEOUT,
+                priority = priority,
+                buffer_id = buffer_id,
+                flags = dp.ofproto.OFPFF_SEND_FLOW_REM,
+                out_port = outport_no, actions = actions)
+        return dp.ofproto_parser.NXTFlowMod(
+                datapath = dp, cookie = cookie,
+                command = dp.ofproto.OFPFC_ADD,
+                idle_timeout = Routing.FLOW_IDLE_TIMEOUT,
+                hard_timeout = Routing.FLOW_HARD_TIMEOUT,
+                priority = priority,
+                buffer_id = buffer_id,
+                flags = dp.ofproto.OFPFF_SEND_FLOW_REM,
+                out_port = outport_no, rule = rule,
+                actions = actions)
+
+    def _five_tuple_match(self, dp, five_tuple, _4or6):
+        """
+            return (match, rule) matching the 5-tuple of a packet, match
+            is for IPv4 and rule (NXM) is for IPv6, the other one is None
+        """
+        ip_src, ip_dst, proto, tp_src, tp_dst = five_tuple
+        ip_src = netaddr.IPAddress(ip_src)
+        ip_dst = netaddr.IPAddress(ip_dst)
+        has_ports = proto in (inet.IPPROTO_TCP, inet.IPPROTO_UDP)
+        if _4or6 == 4:
+            wildcards = ofproto_v1_0.OFPFW_ALL
+            wildcards &= ~ofproto_v1_0.OFPFW_DL_TYPE
+            wildcards &= ~ofproto_v1_0.OFPFW_NW_PROTO
+            wildcards &= ~(0x3f << ofproto_v1_0.OFPFW_NW_SRC_SHIFT)
+            wildcards &= ~(0x3f << ofproto_v1_0.OFPFW_NW_DST_SHIFT)
+            if has_ports:
+                wildcards &= ~ofproto_v1_0.OFPFW_TP_SRC
+                wildcards &= ~ofproto_v1_0.OFPFW_TP_DST
+            match = dp.ofproto_parser.OFPMatch(
+                    wildcards = wildcards, in_port = 0,
+                    dl_src = 0, dl_dst = 0, dl_vlan = 0, dl_vlan_pcp = 0,
+                    dl_type = ether.ETH_TYPE_IP, nw_tos = 0,
+                    nw_proto = proto, nw_src = ip_src.value,
+                    nw_dst = ip_dst.value, tp_src = tp_src, tp_dst = tp_dst)
+            return match, None
+
+        rule = nx_match.ClsRule()
+        rule.set_dl_type(ether.ETH_TYPE_IPV6)
+        rule.set_ipv6_src(struct.unpack('!8H', ip_src.packed))
+        rule.set_ipv6_dst(struct.unpack('!8H', ip_dst.packed))
+        rule.set_nw_proto(proto)
+        if has_ports:
+            rule.set_tp_src(tp_src)
+            rule.set_tp_dst(tp_dst)
+        return None, rule
 
     def _send_arp_request(self, datapath, outport_no, dst_ip):
-        src_mac_addr = \
-            str(self.dpid_to_switch[datapath.id].ports[outport_no].hw_addr)
-        src_ip = \
-            str(self.dpid_to_switch[datapath.id].ports[outport_no].gateway.gw_ip)
-        dst_ip = str(dst_ip)
-        p = packet.Packet()
-        e = ethernet.ethernet(dst = mac.BROADCAST_STR,
-            src = src_mac_addr, ethertype = ether.ETH_TYPE_ARP)
-        p.add_protocol(e)
-        a = arp.arp_ip(opcode = arp.ARP_REQUEST, src_mac = src_mac_addr,
-                src_ip = src_ip, dst_mac = mac.DONTCARE_STR,
-                dst_ip = dst_ip)
-        p.add_protocol(a)
-        p.serialize()
-
-        datapath.send_packet_out(in_port = ofproto_v1_0.OFPP_NONE,
-            actions = [datapath.ofproto_parser.OFPActionOutput(outport_no)],
-            data = p.data)
-
-    def _generate_dst_for_NS(self, ipv6_addr):
-        """
-            ICMPv6 neighbor solicitation destination addresses in ethernet
-            and IP layer are multicast addresses, and could be generated as:
-
-            IPv6:
-                ff02::1:ffXX:XXXX
-            where XX is the last 24 bits of the target IPv6 address
-
-            ethernet:
-                33:33:XX:XX:XX:XX
-            where XX is the last 32 bits of the IPv6 multicast address,
-            i.e. the address generated above, so the effective ethernet
-            multicast address in this scenario is:
-                33:33:ff:XX:XX:XX
-
-            Ref: RFC 2464, RFC 2373
-        """
-        args = struct.unpack('!8H', ipv6_addr.packed)
-
-        arg_6 = args[6] & 0x00ff
-        arg_7head = ('%04x' % args[7])[0:2]
-        arg_7tail = ('%04x' % args[7])[2:]
-        ethernet_str = '33:33:ff:' + str(arg_6) + ':' + arg_7head + ':' + \
-                       arg_7tail
-        ethernet_addr = netaddr.EUI(ethernet_str)
-
-        args[6] |= 0xff00
-        args[0:6] = [0xff02, 0, 0, 0, 0, 1]
-        args = [format(x, 'x') for x in args]
-        args_str = ':'.join(args)
-        ip_addr = netaddr.IPAddress(args_str)
-        return ethernet_addr, ip_addr
+        port = self.dpid_to_switch[datapath.id].ports[outport_no]
+        self._send_packet(datapath, outport_no,
+                          self._templates(port).arp(dst_ip.packed))
+
+    def _resolve(self, datapath, outport_no, dst_ip):
+        # ask for the MAC address of dst_ip behind outport_no
+        if dst_ip.version == 4:
+            self._send_arp_request(datapath, outport_no, dst_ip)
+        else:
+            self._send_icmp_NS(datapath, outport_no, dst_ip)
 
     def _send_icmp_NS(self, datapath, outport_no, dst_ip):
-        src_mac_addr = \
-            str(self.dpid_to_switch[datapath.id].ports[outport_no].hw_addr)
-        src_ip = \
-            str(self.dpid_to_switch[datapath.id].ports[outport_no].gateway.gw_ipv6)
-        p = packet.Packet()
-        dst_mac, dst_ip_multicast = self._generate_dst_for_NS(dst_ip)
-        dst_mac = str(dst_mac)
-        dst_ip_multicast = str(dst_ip_multicast)
-        dst_ip = str(dst_ip)
-        e = ethernet.ethernet(dst = dst_mac, src = src_mac_addr,
-                ethertype = ether.ETH_TYPE_IPV6)
-        ip6 = ipv6.ipv6(version = 6, traffic_class = 0, flow_label = 0,
-                # 4byte ICMP header, 4byte reserved, 16byte target address,
-                # 8byte "source link-layer address" option
-                # next header value for ICMPv6 is 58
-                payload_length = 32, nxt = 58, hop_limit = 255,
-                src = src_ip, dst = dst_ip_multicast)
-        # source link-layer address
-        sla_addr = icmpv6.nd_option_sla(hw_src = src_mac_addr)
-        # ns for neighbor solicit; res for reserved, but actually is a flag,
-        # see comments on "nd_option_tla" above
-        ns = icmpv6.nd_neighbor(res = 4, dst = dst_ip, data = sla_addr)
-        ic6 = icmpv6.icmpv6(type_ = icmpv6.ND_NEIGHBOR_SOLICIT, code = 0,
-                # checksum = 0 then ryu calculate for you
-                csum = 0, data = ns)
-        p.add_protocol(e)
-        p.add_protocol(ip6)
-        p.add_protocol(ic6)
-        p.serialize()
-        datapath.send_packet_out(in_port = ofproto_v1_0.OFPP_NONE,
-            actions = [datapath.ofproto_parser.OFPActionOutput(outport_no)],
-            data = p.data)
+        # to the solicited-node multicast address of dst_ip
+        port = self.dpid_to_switch[datapath.id].ports[outport_no]
+        self._send_packet(datapath, outport_no,
+                          self._templates(port).neighbor_solicit(dst_ip.packed))
 
     def last_switch_out(self, msg, pkt, outport_no, _4or6):
         """
@@ -824,104 +1546,65 @@ class Routing(app_manager.RyuApp):
 
         LOG.debug('last_switch_out: switch %s, port_no %s',
                   switch, outport_no)
-        try:
-            # TODO introduce ARP timeout
-            mac_addr = switch.ip_to_mac[ipDestAddr][0]
-        except KeyError:
+        actions = self._install_last_hop(switch, ipDestAddr, outport_no,
+                                         _4or6, True)
+        if actions is None:
             # don't know MAC address yet, send ARP/ICMP message
             # and temporarily store the packets
-            if _4or6 == 4:
-                self._send_arp_request(msg.datapath, outport_no,
-                                       ipDestAddr)
-            else:
-                self._send_icmp_NS(msg.datapath, outport_no,
-                                   ipDestAddr)
-            switch.msg_buffer.append( (msg, pkt, outport_no, _4or6) )
+            request, dropped = self.pending.add(
+                dp.id, ipDestAddr, outport_no, msg, dp.ofproto.OFP_NO_BUFFER,
+                time.time())
+            if request:
+                self._resolve(dp, outport_no, ipDestAddr)
+            for pending in dropped:
+                self.drop_pkt(pending)
             return False
 
-        if _4or6 == 4:
-            # ip src exact match
-            wildcards = ofproto_v1_0.OFPFW_ALL
-            wildcards &= ~ofproto_v1_0.OFPFW_DL_TYPE
-            wildcards &= ~(0x3f << ofproto_v1_0.OFPFW_NW_DST_SHIFT)
-
-            match = dp.ofproto_parser.OFPMatch(
-                    # because of wildcards, parameters other than dl_type
-                    # and nw_dst could be any value
-                    wildcards = wildcards, in_port = 0,
-                    dl_src = 0, dl_dst = 0, dl_vlan = 0, dl_vlan_pcp = 0,
-                    dl_type = ether.ETH_TYPE_IP, nw_tos = 0, nw_proto = 0,
-                    nw_src = 0, nw_dst = ipDestAddr.value, tp_src = 0,
-                    tp_dst = 0)
-        else:
-            rule = nx_match.ClsRule()
-            rule.set_dl_type(ether.ETH_TYPE_IPV6)
-            rule.set_ipv6_dst(struct.unpack('!8H', ipDestAddr.packed))
-
-        actions = []
-        actions.append(dp.ofproto_parser.OFPActionSetDlSrc(
-                        switch.ports[outport_no].hw_addr.packed))
-        actions.append(dp.ofproto_parser.OFPActionSetDlDst(
-                        mac_addr.packed))
-        actions.append(dp.ofproto_parser.OFPActionOutput(outport_no))
-
-        if _4or6 == 4:
-            mod = dp.ofproto_parser.OFPFlowMod(
-                    datapath = dp, match = match, cookie = 0,
-                    command = dp.ofproto.OFPFC_MODIFY,
-                    idle_timeout = Routing.FLOW_IDLE_TIMEOUT,
-                    hard_timeout = Routing.FLOW_HARD_TIMEOUT,
-                    out_port = outport_no, actions = actions)
-        else:
-            mod = dp.ofproto_parser.NXTFlowMod(
-                    datapath = dp, cookie = 0,
-                    command = dp.ofproto.OFPFC_MODIFY,
-                    idle_timeout = Routing.FLOW_IDLE_TIMEOUT,
-                    hard_timeout = Routing.FLOW_HARD_TIMEOUT,
-                    out_port = outport_no, rule = rule,
-                    actions = actions)
-
-        out = dp.ofproto_parser.OFPPacketOut(
-            datapath = dp, buffer_id = msg.buffer_id,
-            in_port = msg.in_port, actions = actions)
-
-        dp.send_msg(mod)
-        dp.send_msg(out)
+        self._complete_setup(msg, actions)
         return True
 
+    def _install_last_hop(self, switch, ip_dst, outport_no, _4or6,
+                          punted=False):
+        """
+            deploy the entry of switch towards the host ip_dst on
+            outport_no; return the actions, or None if the MAC address
+            of the host is not known
+        """
+        host = self.neighbors.lookup(ip_dst, time.time())
+        if host is None:
+            return None
+        mac_addr = host.mac
+        dp = switch.dp
+        key, match, rule, priority = self._flow_match(dp, _4or6, ip_dst)
+        cookie = self.cookies.cookie(dp.id, dp.id, dp.id)
+        return self._send_flow_mod(dp, _4or6, key, match, rule, priority,
+                                   cookie, switch.ports[outport_no].hw_addr,
+                                   mac_addr, outport_no, punted)
+
     def find_switch_of_network(self, dst_addr, _4or6):
-        for dpid, switch in self.dpid_to_switch.iteritems():
-            for port_no, port in switch.ports.iteritems():
-                if _4or6 == 4:
-                    if port.gateway and dst_addr in port.gateway.gw_ip_network:
-                        if dst_addr == port.gateway.gw_ip:
-                            return self.dpid_to_switch[dpid], \
-                                    ofproto_v1_0.OFPP_LOCAL
-                        return self.dpid_to_switch[dpid], port_no
-                else:
-                    if port.gateway and dst_addr in port.gateway.gw_ipv6_network:
-                        if dst_addr == port.gateway.gw_ipv6:
-                            return self.dpid_to_switch[dpid], \
-                                    ofproto_v1_0.OFPP_LOCAL
-                        return self.dpid_to_switch[dpid], port_no
-        return None, None
+        # the longest gateway network of the version of dst_addr
+        found = self._batched_network('network', dst_addr,
+                                      self.switches.lookup_network, dst_addr)
+        if found is None:
+            return None, None
+        switch, port_no, gw_value = found
+        if dst_addr.value == gw_value:
+            return switch, ofproto_v1_0.OFPP_LOCAL
+        return switch, port_no
 
     def name_to_switch(self, switch_name):
-        for dpid, s in self.dpid_to_switch.iteritems():
-            if s.name == switch_name:
-                return s
-        return None
+        return self.switches.names.get(switch_name, None)
 
     def _handle_ip(self, msg, pkt, protocol_pkt):
         LOG.debug('Handling IP packet %s', protocol_pkt)
 
-        if isinstance(protocol_pkt, ipv4.ipv4):
+        if protocol_pkt.protocol_name == 'ipv4':
             _4or6 = 4
         else:
             _4or6 = 6
 
         src_switch = self.dpid_to_switch[msg.datapath.id]
-        self._remember_mac_addr(src_switch, pkt, _4or6)
+        self._remember_mac_addr(src_switch, msg.in_port, pkt, _4or6)
 
         if _4or6 == 4:
             icmp_layer = self.find_packet(pkt, 'icmp')
@@ -947,8 +1630,13 @@ class Routing(app_manager.RyuApp):
             LOG.debug('Forward IP packet to tap port')
             return
 
-        dst_switch, dst_port_no = self.find_switch_of_network(
-                                netaddr.IPAddress(protocol_pkt.dst), _4or6)
+        unroutable = self.unroutable.lookup(dst, time.time())
+        if unroutable is not None:
+            LOG.debug('Packet dropped because %s has no route', unroutable.network)
+            self._drop_unroutable(msg, unroutable, _4or6)
+            return
+
+        dst_switch, dst_port_no = self.find_switch_of_network(dst, _4or6)
 
         LOG.debug('First try of routing for dst %s, find switch %s, port %s',
                   protocol_pkt.dst, dst_switch, dst_port_no)
@@ -962,14 +1650,20 @@ class Routing(app_manager.RyuApp):
             # raise an event to `module B`
             req = dest_event.EventDestinationRequest(
                     netaddr.IPAddress(protocol_pkt.dst), _4or6)
-            reply = self.send_request(req)
+            reply = self._batched_network('destination', dst,
+                                          self._request_destination, req)
+            if len(reply.exits) > 1:
+                self._select_exit(src_switch, req.dest_addr, reply)
             if reply.dpid:
                 dst_switch = self.dpid_to_switch[reply.dpid]
             elif reply.switch_name:
                 dst_switch = self.name_to_switch(reply.switch_name)
             else:
-                LOG.debug('Packet dropped because dst_switch == None')
-                self.drop_pkt(msg)
+                LOG.debug('Packet dropped because of no route to %s', dst)
+                unroutable = self.unroutable.add(
+                    self._unroutable_network(dst, _4or6, reply.no_route_len),
+                    time.time())
+                self._drop_unroutable(msg, unroutable, _4or6)
                 return
 
             LOG.debug('dst_switch replied from B: %s', dst_switch)
@@ -977,18 +1671,142 @@ class Routing(app_manager.RyuApp):
                                                reply, msg, pkt, _4or6)
             return
         elif src_switch == dst_switch:
+            if Routing.BIDIRECTIONAL_SETUP:
+                self._deploy_reverse(msg, pkt, [src_switch], _4or6)
             self.last_switch_out(msg, pkt, dst_port_no, _4or6)
             return
 
-        result = self.routing_algo.find_route(src_switch, dst_switch)
+        result, outports, exact = self.find_route(src_switch, dst_switch,
+                                                  pkt, _4or6)
         LOG.debug('Second try of routing for dst %s, find route %s',
                   protocol_pkt.dst, result)
         if result:
-            self.deploy_flow_entry(msg, pkt, result, _4or6)
+            self.deploy_flow_entry(msg, pkt, result, _4or6, outports, exact,
+                                   last_outport_no=dst_port_no)
         else:
             LOG.debug('Packet dropped because of no route to the switch')
             self.drop_pkt(msg)
 
+    @set_ev_cls(dest_event.EventRouteWithdraw)
+    def route_withdraw_handler(self, event):
+        LOG.debug('Routes withdrawn by %s', event.neighbor_ip)
+        self._forget_batch_lookups()
+        self.setups.routes_changed()
+        self.flow_deletes.update(self.cookies.invalidate_exits(
+            [event.neighbor_ip]))
+
+    @set_ev_cls(dest_event.EventRouteAnnounce)
+    def route_announce_handler(self, event):
+        self._forget_batch_lookups()
+        self._cover_unroutable(event.networks)
+
+    def _gateway_networks(self, switch):
+        networks = []
+        for port in switch.ports.itervalues():
+            if port.gateway:
+                networks.append(port.gateway.gw_ip_network)
+                networks.append(port.gateway.gw_ipv6_network)
+        return networks
+
+    def _unroutable_network(self, dst, _4or6, no_route_len):
+        """
+            the network around dst to treat as unroutable, no wider than
+            what BGPer found without routes and not overlapping networks
+            of gateways or the local addresses
+        """
+        width = 32 if _4or6 == 4 else 128
+        length = width
+        if no_route_len is not None:
+            length = max(no_route_len, Routing.UNROUTABLE_PREFIX_LEN[_4or6])
+        networks = [netaddr.IPNetwork(util.bgper_config['local_ipv4']),
+                    netaddr.IPNetwork(util.bgper_config['local_ipv6'])]
+        for switch in self.dpid_to_switch.itervalues():
+            networks.extend(self._gateway_networks(switch))
+        for network in networks:
+            if network.version != dst.version or dst in network:
+                continue
+            common = width - (dst.value ^ network.first).bit_length()
+            length = max(length, common + 1)
+        return netaddr.IPNetwork('%s/%d' % (dst, min(length, width))).cidr
+
+    def _drop_unroutable(self, msg, unroutable, _4or6):
+        """
+            drop the packet of msg, and deploy a drop entry of the
+            unroutable network to its switch if there isn't one yet
+        """
+        dp = msg.datapath
+        now = time.time()
+        if Routing.DROP_FLOWS and dp.id not in unroutable.dpids:
+            unroutable.dpids.add(dp.id)
+            mod = dp.ofproto_parser.NXTFlowMod(
+                datapath = dp, cookie = 0,
+                command = dp.ofproto.OFPFC_ADD,
+                hard_timeout = max(1, int(unroutable.expires - now)),
+                priority = Routing.DROP_FLOW_PRIORITY,
+                rule = self._network_rule(unroutable.network, _4or6),
+                actions = [])
+            self.scheduler.send(dp, mod, flow_scheduler.REACTIVE, now)
+            LOG.info('Drop entry of %s deployed to %s', unroutable.network,
+                     dp.id)
+        self.drop_pkt(msg)
+
+    def _cover_unroutable(self, networks):
+        """
+            routes to 'networks' appeared, delete the drop entries of the
+            unroutable networks overlapping them
+        """
+        now = time.time()
+        for unroutable in self.unroutable.cover(networks):
+            _4or6 = unroutable.network.version
+            for dpid in unroutable.dpids:
+                switch = self.dpid_to_switch.get(dpid, None)
+                if switch is None:
+                    continue
+                dp = switch.dp
+                mod = dp.ofproto_parser.NXTFlowMod(
+                    datapath = dp, cookie = 0,
+                    command = dp.ofproto.OFPFC_DELETE_STRICT,
+                    priority = Routing.DROP_FLOW_PRIORITY,
+                    rule = self._network_rule(unroutable.network, _4or6))
+                self.scheduler.send(dp, mod, flow_scheduler.REACTIVE, now)
+
+    def _network_rule(self, network, _4or6):
+        rule = nx_match.ClsRule()
+        if _4or6 == 4:
+            rule.set_dl_type(ether.ETH_TYPE_IP)
+            rule.set_nw_dst_masked(network.network.value,
+                                   network.netmask.value)
+        else:
+            rule.set_dl_type(ether.ETH_TYPE_IPV6)
+            rule.set_ipv6_dst_masked(
+                struct.unpack('!8H', network.network.packed),
+                struct.unpack('!8H', network.netmask.packed))
+        return rule
+
+    def _select_exit(self, src_switch, dest_addr, reply):
+        """
+        Several neighbors announce the destination, choose one of them by
+        the load of the border port and the path cost to the border
+        switch, and fill it into the reply.
+        """
+        def cost(exit):
+            switch = self.name_to_switch(exit.switch_name)
+            if switch is None:
+                return float('inf')
+            return self.routing_algo.path_cost(src_switch, switch)
+
+        def utilization(exit):
+            switch = self.name_to_switch(exit.switch_name)
+            return self.port_stats.utilization(switch.dp.id, exit.outport_no)
+
+        exit = self.egress.select(dest_addr, reply.exits, cost,
+                                  utilization, time.time())
+        if exit is None:
+            return
+        reply.switch_name = exit.switch_name
+        reply.outport_no = exit.outport_no
+        reply.neighbor_ip = exit.neighbor_ip
+
     def write_to_tap(self, data, modifyMacAddress=False):
         # if modifyMacAddress is True, change the destination MAC address
         # to the address of tap port
@@ -1010,19 +1828,27 @@ class Routing(app_manager.RyuApp):
         In situation when a packet goes out of the AS
         """
         if src_switch != dst_switch:
-            result = self.routing_algo.find_route(src_switch, dst_switch)
-            if result:
-                self.deploy_flow_entry(msg, pkt, result, _4or6)
-            else:
+            result, outports, exact = self.find_route(src_switch,
+                                                      dst_switch, pkt, _4or6)
+            if not result:
                 LOG.debug('Packet dropped because of no route to the address out of AS')
                 self.drop_pkt(msg)
+                return
 
+        # the border switch first, the packet follows the path after
+        if src_switch == dst_switch and Routing.BIDIRECTIONAL_SETUP:
+            self._deploy_reverse(msg, pkt, [src_switch], _4or6)
         self.border_switch_out(msg, pkt, dst_switch, dst_reply, _4or6)
+        if src_switch != dst_switch:
+            exit = egress.Exit(dst_switch.name, dst_reply.outport_no,
+                               dst_reply.neighbor_ip)
+            self.deploy_flow_entry(msg, pkt, result, _4or6,
+                                   outports, exact, exit)
 
     def border_switch_out(self, msg, pkt, dst_switch, dst_reply, _4or6):
         """
-        Deploy the flow table on border switch and send the packet from
-        the initial switch.
+        Deploy the flow table on border switch, and send the packet out
+        if the border switch is the initial switch.
         """
         if _4or6 == 4:
             ip_layer = self.find_packet(pkt, 'ipv4')
@@ -1033,56 +1859,32 @@ class Routing(app_manager.RyuApp):
         initial_switch = self.dpid_to_switch[initial_dp.id]
         dp = dst_switch.dp
         ipDestAddr = netaddr.IPAddress(ip_layer.dst)
-        macAddr = dst_switch.ip_to_mac[ipDestAddr][0]
         outport_no = dst_reply.outport_no
-
-        if _4or6 == 4:
-            # ip src exact match
-            wildcards = ofproto_v1_0.OFPFW_ALL
-            wildcards &= ~ofproto_v1_0.OFPFW_DL_TYPE
-            wildcards &= ~(0x3f << ofproto_v1_0.OFPFW_NW_DST_SHIFT)
-
-            match = dp.ofproto_parser.OFPMatch(
-                    # because of wildcards, parameters other than dl_type
-                    # and nw_dst could be any value
-                    wildcards = wildcards, in_port = 0,
-                    dl_src = 0, dl_dst = 0, dl_vlan = 0, dl_vlan_pcp = 0,
-                    dl_type = ether.ETH_TYPE_IP, nw_tos = 0, nw_proto = 0,
-                    nw_src = 0, nw_dst = ipDestAddr.value, tp_src = 0,
-                    tp_dst = 0)
-        else:
-            rule = nx_match.ClsRule()
-            rule.set_dl_type(ether.ETH_TYPE_IPV6)
-            rule.set_ipv6_dst(struct.unpack('!8H', ipDestAddr.packed))
-
-        actions = []
-        actions.append(dp.ofproto_parser.OFPActionSetDlSrc(
-                       dst_switch.ports[outport_no].hw_addr.packed))
-        actions.append(dp.ofproto_parser.OFPActionSetDlDst(macAddr.packed))
-        actions.append(dp.ofproto_parser.OFPActionOutput(outport_no))
-
-        if _4or6 == 4:
-            mod = dp.ofproto_parser.OFPFlowMod(
-                    datapath = dp, match = match, cookie = 0,
-                    command = dp.ofproto.OFPFC_MODIFY,
-                    idle_timeout = Routing.FLOW_IDLE_TIMEOUT,
-                    hard_timeout = Routing.FLOW_HARD_TIMEOUT,
-                    out_port = outport_no, actions = actions)
-        else:
-            mod = dp.ofproto_parser.NXTFlowMod(
-                    datapath = dp, cookie = 0,
-                    command = dp.ofproto.OFPFC_MODIFY,
-                    idle_timeout = Routing.FLOW_IDLE_TIMEOUT,
-                    hard_timeout = Routing.FLOW_HARD_TIMEOUT,
-                    out_port = outport_no, rule = rule,
-                    actions = actions)
-
-        out = dp.ofproto_parser.OFPPacketOut(
-            datapath = dp, buffer_id = msg.buffer_id,
-            in_port = msg.in_port, actions = actions)
-
-        dp.send_msg(mod)
-        initial_dp.send_msg(out)
+        # the neighbor router is the next hop
+        next_hop = ipDestAddr
+        if dst_reply.neighbor_ip is not None:
+            next_hop = netaddr.IPAddress(dst_reply.neighbor_ip)
+        neighbor = self.neighbors.lookup(next_hop, time.time())
+        if neighbor is None:
+            # unknown or expired, the packets miss on the border switch
+            # until the reply comes
+            self._resolve(dp, outport_no, next_hop)
+            if dp is initial_dp:
+                self.drop_pkt(msg)
+            return
+        macAddr = neighbor.mac
+        exit = egress.Exit(dst_switch.name, outport_no, dst_reply.neighbor_ip)
+        cookie = self.cookies.cookie(dp.id, dp.id, dp.id, exit)
+
+        key, match, rule, priority = self._flow_match(dp, _4or6,
+                                                      ipDestAddr)
+        actions = self._send_flow_mod(dp, _4or6, key, match, rule, priority,
+                                      cookie,
+                                      dst_switch.ports[outport_no].hw_addr,
+                                      macAddr, outport_no,
+                                      dp is initial_dp)
+        if dp is initial_dp:
+            self._complete_setup(msg, actions)
 
     def drop_pkt(self, msg):
         # Note that this drop_pkt method only drops the packet,
@@ -1091,24 +1893,216 @@ class Routing(app_manager.RyuApp):
         out = dp.ofproto_parser.OFPPacketOut(datapath = dp,
                 buffer_id = msg.buffer_id, in_port = msg.in_port,
                 actions = [])
-        dp.send_msg(out)
+        self.scheduler.send(dp, out, flow_scheduler.PACKET_OUT, time.time())
 
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def packet_in_handler(self, event):
-        data = event.msg.data
-        pkt = packet.Packet(data)
+        msg = event.msg
+        pkt = headers.Headers(msg.data)
+        five_tuple = pkt.five_tuple()
+        bgp = five_tuple is not None and \
+            five_tuple[3] == inet.IPPROTO_TCP and \
+            BGP4.BGP_TCP_PORT in (five_tuple[4], five_tuple[5])
+        if not bgp and not self._admit(msg, five_tuple):
+            return
+        if Routing.BATCH_PACKET_INS:
+            self.packet_ins.put((msg, pkt, five_tuple, bgp))
+        else:
+            self._packet_in(msg, pkt, five_tuple, bgp)
+
+    def _handle_batches(self):
+        """
+        Take the packet ins queued by packet_in_handler in batches. In a
+        batch, packet ins from the same switch to the same destination
+        come one after another, so the first one sets up the flow and
+        the others follow it. Messages to switches are sent together at
+        the end of the batch.
+        """
+        while True:
+            batch = [self.packet_ins.get()]
+            deadline = time.time() + Routing.BATCH_TIME
+            while len(batch) < Routing.BATCH_SIZE:
+                try:
+                    batch.append(self.packet_ins.get(
+                        timeout=max(0, deadline - time.time())))
+                except green_queue.Empty:
+                    break
+            self._handle_batch(batch)
+
+    def _handle_batch(self, batch):
+        # stable, the packets of a flow keep their order
+        batch.sort(key=lambda p: (p[0].datapath.id, p[2] and p[2][2]))
+        self._batch = {}
+        self.scheduler.hold()
+        try:
+            for msg, pkt, five_tuple, bgp in batch:
+                try:
+                    self._packet_in(msg, pkt, five_tuple, bgp)
+                except Exception:
+                    # as Ryu does for a handler, the others go on
+                    LOG.exception('Error handling packet in')
+        finally:
+            self._batch = None
+            self.scheduler.release(time.time())
+
+    def _batched(self, name, key, func, *args):
+        """
+            func(*args), called once per batch for the key
+        """
+        if self._batch is None:
+            return func(*args)
+        lookups = self._batch.setdefault(name, {})
+        try:
+            return lookups[key]
+        except KeyError:
+            result = lookups[key] = func(*args)
+            return result
+
+    def _batched_network(self, name, addr, func, *args):
+        """
+            func(*args) returns the result for addr and the prefix length
+            of a network around addr whose addresses all have the result,
+            called once per batch for the network
+        """
+        if self._batch is None:
+            return func(*args)[0]
+        width = 32 if addr.version == 4 else 128
+        lookups = self._batch.setdefault(name, {})
+        for (version, prefixlen), results in lookups.iteritems():
+            if version != addr.version:
+                continue
+            shift = width - prefixlen
+            try:
+                return results[addr.value >> shift << shift]
+            except KeyError:
+                pass
+        result, prefixlen = func(*args)
+        shift = width - prefixlen
+        results = lookups.setdefault((addr.version, prefixlen), {})
+        results[addr.value >> shift << shift] = result
+        return result
+
+    def _request_destination(self, req):
+        # the reply and the network it holds for, only the address if
+        # BGPer doesn't tell
+        reply = self._send_request(req)
+        length = reply.network_len
+        if length is None:
+            length = 32 if req._4or6 == 4 else 128
+        return reply, length
+
+    def _send_request(self, req):
+        """
+        send_request, which waits for the reply of another app. The hold
+        of a batch is lifted meanwhile, so the messages of the other
+        green threads, e.g. of fast reroute, aren't held while it waits.
+        """
+        held = self.scheduler.held
+        if held:
+            self.scheduler.release(time.time())
+        try:
+            return self.send_request(req)
+        finally:
+            if held:
+                self.scheduler.hold()
+
+    def _forget_batch_lookups(self):
+        # routes or destinations changed during the batch
+        if self._batch is not None:
+            self._batch = {}
+
+    def _packet_in(self, msg, pkt, five_tuple, bgp):
+        setup = None
+        if bgp or not Routing.COALESCE_SETUPS:
+            # BGP packets are copied to the tap device
+            five_tuple = None
+        if five_tuple is not None:
+            key = msg.datapath.id, five_tuple[2]
+            now = time.time()
+            setup = self.setups.lookup(key, now)
+            if setup is not None and setup.matches(five_tuple):
+                if setup.completed is not None:
+                    self.setups.coalesced += 1
+                    self._release(setup.dp, setup.actions, [msg])
+                elif not self.setups.wait(setup, msg):
+                    self.drop_pkt(msg)
+                return
+            if setup is None:
+                setup = self.setups.start(key, msg, five_tuple, now)
+            else:
+                # another 5-tuple of a setup with 5-tuple entries
+                setup = None
+
+        self._handle_packet_in(msg, pkt)
+
+        if setup is not None and setup.dp is None:
+            # nothing was installed for the packet
+            for m in self.setups.abort(setup):
+                self.drop_pkt(m)
+
+    def _admit(self, msg, five_tuple):
+        """
+            return False if the packet in is shed, then the source or port
+            beyond its limit might get an entry suppressing its packet
+            ins; a shed packet is left in the buffer of the switch
+        """
+        dp = msg.datapath
+        mac_src = msg.data[6:12]
+        ip_src = None
+        if five_tuple is not None:
+            ip_src = five_tuple[1]
+        now = time.time()
+        over = self.admission.admit(dp.id, msg.in_port, mac_src, ip_src, now)
+        if over is None:
+            return True
+        level, key = over
+        if not Routing.SUPPRESS_PUNTS or level == admission.DATAPATH or \
+                not self.admission.suppress(level, key, now,
+                                            Routing.PUNT_SUPPRESS_TIMEOUT):
+            return False
+
+        rule = nx_match.ClsRule()
+        rule.set_in_port(msg.in_port)
+        if level == admission.MAC:
+            rule.set_dl_src(mac_src)
+        elif level == admission.IP and five_tuple[0] == 4:
+            rule.set_dl_type(ether.ETH_TYPE_IP)
+            rule.set_nw_src(struct.unpack('!I', ip_src)[0])
+        elif level == admission.IP:
+            rule.set_dl_type(ether.ETH_TYPE_IPV6)
+            rule.set_ipv6_src(struct.unpack('!8H', ip_src))
+        mod = dp.ofproto_parser.NXTFlowMod(
+            datapath = dp, cookie = 0,
+            command = dp.ofproto.OFPFC_ADD,
+            hard_timeout = Routing.PUNT_SUPPRESS_TIMEOUT,
+            priority = Routing.PUNT_SUPPRESS_PRIORITY,
+            rule = rule, actions = [])
+        self.scheduler.send(dp, mod, flow_scheduler.REACTIVE, now)
+        LOG.info('Packet ins over the %s limit at port %s of %s suppressed',
+                 level, msg.in_port, dp.id)
+        return False
+
+    def _handle_packet_in(self, msg, pkt):
+        """
+            'pkt' is the headers.Headers of msg, IP packets are handled
+            without parsing them by Ryu unless their ICMP is needed
+        """
+        if pkt.ip is not None:
+            self._handle_ip(msg, pkt, pkt.ip)
+            return
+
         LOG.debug("PacketIn: %s", pkt.protocols)
         # TODO
         # handle protocols in reverse order
         for p in pkt.protocols:
             if isinstance(p, arp.arp):
-                self._handle_arp(event.msg, pkt, p)
+                self._handle_arp(msg, pkt, p)
             # ipv4 and ipv6 also handle their corresponding icmp packets
             elif isinstance(p, ipv4.ipv4):
-                self._handle_ip(event.msg, pkt, p)
+                self._handle_ip(msg, pkt, p)
             elif isinstance(p, ipv6.ipv6):
-                self._handle_ip(event.msg, pkt, p)
+                self._handle_ip(msg, pkt, p)
             else:
                 # might be more classifications here, BGP/OSPF etc.
                 LOG.debug("Unhandled PacketIn %s", p)
@@ -49,7 +49,10 @@ class Port(switches.Port):
             raise AttributeError
 
         self.gateway = None
-        self.cost = float('inf')  # infinite
+        self.templates = None   # packet_templates.PortTemplates
+        self.base_cost = float('inf')  # by the speed of the port
+        self.cost = float('inf')  # infinite, base_cost raised by utilization
+        self.speed = None   # in bits per second
         self.isBorder = False
         LOG.debug('MAC address of this interface is %s', self.hw_addr)
 
@@ -86,24 +89,18 @@ class Switch(switches.Switch):
         # note that this variable overshadows super.ports
         self.ports = {}
 
-        # temporarily store packets we don't know MAC address yet.
-        self.msg_buffer = []
-
-        # ip_to_mac[ip_addr] = (mac_addr, time_stamp)
-        # maintains ARP table
-        self.ip_to_mac = {}
-
-    def update_from_config(self, config):
-        if self.name is None:
-            return
-
-        try:
-            d = config[self.name]
-        except KeyError:
-            LOG.warning('WARNING: %s is not configured.', self.name)
-            return
-        for k, v in self.ports.iteritems():
-            v.update_from_config(d)
+    def update_from_config(self, config, index=None):
+        # index is a SwitchIndex to be updated with the name and gateways
+        if self.name is not None:
+            try:
+                d = config[self.name]
+            except KeyError:
+                LOG.warning('WARNING: %s is not configured.', self.name)
+            else:
+                for k, v in self.ports.iteritems():
+                    v.update_from_config(d)
+        if index is not None:
+            index.update_switch(self)
 
     def __eq__(self, other):
         try:
@@ -0,0 +1,116 @@
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class SwitchIndex(object):
+    '''
+        the switches by name, and the gateway networks configured on
+        their ports for longest prefix matches; kept up to date by
+        Switch.update_from_config and remove_switch
+    '''
+    def __init__(self):
+        self.names = {}         # names[name] = Switch
+        # networks[version][prefixlen][network value] =
+        #     (Switch, port_no, gateway address value)
+        self.networks = {4: {}, 6: {}}
+        self.prefixlens = {4: [], 6: []}    # longest first
+        # (version, prefixlen, network value) of the networks with a
+        # longer one inside, None until looked up after a change
+        self.nested = None
+        self.by_dpid = {}       # by_dpid[dpid] = [(version, prefixlen,
+                                #                   network value)]
+
+    def update_switch(self, switch):
+        '''
+            index the name and the gateways of the ports of switch again
+        '''
+        self.remove_switch(switch.dp.id)
+        if switch.name is not None:
+            self.names[switch.name] = switch
+        keys = []
+        for port_no, port in switch.ports.iteritems():
+            if not port.gateway:
+                continue
+            for gw_ip, network in (
+                    (port.gateway.gw_ip, port.gateway.gw_ip_network),
+                    (port.gateway.gw_ipv6, port.gateway.gw_ipv6_network)):
+                network = network.cidr
+                table = self.networks[network.version].setdefault(
+                    network.prefixlen, {})
+                if network.value in table:
+                    LOG.warning('%s configured on %s and %s', network,
+                                table[network.value][0], switch)
+                table[network.value] = switch, port_no, gw_ip.value
+                keys.append((network.version, network.prefixlen,
+                             network.value))
+        self.by_dpid[switch.dp.id] = keys
+        self._sort_prefixlens()
+        self.nested = None
+
+    def remove_switch(self, dpid):
+        for name, switch in self.names.items():
+            if switch.dp.id == dpid:
+                del self.names[name]
+        for version, prefixlen, value in self.by_dpid.pop(dpid, ()):
+            table = self.networks[version].get(prefixlen, None)
+            if table is None:
+                continue
+            entry = table.get(value, None)
+            if entry is not None and entry[0].dp.id == dpid:
+                del table[value]
+            if not table:
+                del self.networks[version][prefixlen]
+        self._sort_prefixlens()
+        self.nested = None
+
+    def _sort_prefixlens(self):
+        for version, tables in self.networks.iteritems():
+            self.prefixlens[version] = sorted(tables, reverse=True)
+
+    def _find_nested(self):
+        self.nested = set()
+        for version, tables in self.networks.iteritems():
+            width = 32 if version == 4 else 128
+            prefixlens = self.prefixlens[version]
+            for i, prefixlen in enumerate(prefixlens):
+                for value in tables[prefixlen]:
+                    for shorter in prefixlens[i + 1:]:
+                        shift = width - shorter
+                        outer = value >> shift << shift
+                        if outer in tables[shorter]:
+                            self.nested.add((version, shorter, outer))
+
+    def lookup(self, addr):
+        '''
+            return (Switch, port_no, is the gateway address) of the
+            longest gateway network containing netaddr.IPAddress addr,
+            or None
+        '''
+        entry, prefixlen = self.lookup_network(addr)
+        if entry is None:
+            return None
+        switch, port_no, gw_value = entry
+        return switch, port_no, addr.value == gw_value
+
+    def lookup_network(self, addr):
+        '''
+            return ((Switch, port_no, gateway address value) or None,
+            prefixlen), where every address of the network of prefixlen
+            around addr gets the same entry; the network is addr alone
+            if no gateway network contains addr, or a longer one is
+            inside the network found
+        '''
+        if self.nested is None:
+            self._find_nested()
+        width = 32 if addr.version == 4 else 128
+        tables = self.networks[addr.version]
+        for prefixlen in self.prefixlens[addr.version]:
+            shift = width - prefixlen
+            value = addr.value >> shift << shift
+            entry = tables[prefixlen].get(value, None)
+            if entry is not None:
+                if (addr.version, prefixlen, value) in self.nested:
+                    return entry, width
+                return entry, prefixlen
+        return None, width
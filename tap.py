@@ -1,3 +1,4 @@
+import errno
 import fcntl
 import os
 import struct
@@ -66,11 +67,42 @@ class TapDevice(object):
         command = ['ifconfig', self.name, 'up']
         subprocess.check_call(command)
 
+    def fileno(self):
+        return self.tap.fileno()
+
+    def set_nonblocking(self):
+        set_nonblocking(self.tap.fileno())
+
     def read(self, size=2048):
         # note that size is the maximum size to read
         return os.read(self.tap.fileno(), size)
 
+    def read_available(self, limit, size=2048):
+        # the device must be non-blocking
+        return read_available(self.tap.fileno(), limit, size)
+
     def write(self, packetBytes):
         bytesWritten = os.write(self.tap.fileno(), packetBytes)
         if bytesWritten == 0:
             raise WriteError
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def read_available(fd, limit, size=2048):
+    """
+    Read the frames queued on the non-blocking fd, at most limit of them;
+    a tap device returns one frame per read.
+    """
+    frames = []
+    while len(frames) < limit:
+        try:
+            frames.append(os.read(fd, size))
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                break
+            raise
+    return frames